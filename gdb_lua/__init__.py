@@ -1,13 +1,49 @@
 #!/usr/bin/env python3
 import typing
 
-import gdb
+try:
+    import gdb
+except ImportError:
+    # Imported outside of gdb, only the offline tools (e.g.
+    # `python -m gdb_lua.snapshot`) can be used.
+    gdb = None
 
-from . import lua
-from . import printing
-from . import types
+if gdb is not None:
+    from . import allocprof
+    from . import backend
+    from . import bytecode
+    from . import cache
+    from . import find
+    from . import gc
+    from . import hashstats
+    from . import heap
+    from . import lua
+    from . import printing
+    from . import profile
+    from . import records
+    from . import refs
+    from . import stats
+    from . import threads
+    from . import types
+    from . import watch
 
 HELP_LUA = 'Commands to inspect Lua states.'
+HELP_SET_LUA = 'Generic command for setting Lua inspection options.'
+HELP_SHOW_LUA = 'Generic command for showing Lua inspection options.'
+HELP_CACHE_SIZE = '''\
+Maximum number of decoded Lua objects kept between stops.
+
+Strings, function locations and table summaries are cached by address until
+the inferior resumes or its memory is modified.  Zero disables the cache.\
+'''
+HELP_MEMORY = '''\
+Source of the memory read when decoding Lua objects.
+
+- gdb: read through gdb (default)
+- direct: read `/proc/PID/mem` for live processes and a memory map of the core
+  file for core dumps, which is much faster for heap walks and large tables.
+  Other targets (e.g. remote) are still read through gdb.\
+'''
 HELP_TYPE = ''''\
 Prints the type name corresponding to one of the `LUA_T*` constants.\
 '''
@@ -17,7 +53,286 @@ Prints the values on the stack associated with a Lua state.
 Positional arguments (all optional) are:
 
 - L: the expression identifying the current Lua state (default: `L`)
-- i: the stack index to print (default: all)\
+- i: the stack index to print (default: all)
+
+Options:
+
+- --range A:B: only print slots A to B, inclusive.  Either may be omitted and
+  negative indices are relative to the top of the stack.
+- --format F: `text` (default), `json` (an array) or `jsonl` (one object per
+  line).  Each slot is written as it is read, with its index, address, type
+  name, raw type tag, pointer or decoded scalar value and the source and line
+  of Lua functions.
+- --watch: print the slots pushed, popped or modified and the frames entered
+  or left since the previous stop at every stop, until `--unwatch`.\
+'''
+HELP_TABLE = '''\
+Prints the elements of a Lua table.
+
+Positional arguments are:
+
+- EXPR: an expression of type `TValue` or `Table` (or pointers to them)
+
+Options:
+
+- --offset N: skip the first N elements
+- --limit N: print at most N elements
+- --keys-only: only print the keys of each element
+
+Elements in the array part are listed first, followed by the hash part.\
+'''
+HELP_TABLE_COUNTS = '''\
+Whether table summaries include the number of elements.
+
+Counting requires reading both parts of every table printed, which can be slow
+for large tables.  `lua table` always includes them.\
+'''
+HELP_MAX_DEPTH = '''\
+Maximum depth of nested tables expanded when printing a value.
+
+Deeper tables are printed as a summary followed by `{...}`.  Tables which are
+already being expanded are printed as `<cycle ADDRESS>` at any depth.  Zero
+means unlimited.\
+'''
+HELP_PRINT_TIME = '''\
+Maximum number of milliseconds spent expanding tables for each printed value.
+
+Once it is exceeded, the remaining elements are omitted and
+`<print budget exceeded>` is printed.  Zero means unlimited.\
+'''
+HELP_PRINT_BYTES = '''\
+Estimated maximum number of bytes of table elements printed for each value.
+
+Once it is exceeded, the remaining elements are omitted and
+`<print budget exceeded>` is printed.  Zero means unlimited.\
+'''
+HELP_HEAP = '''\
+Prints the number and estimated size of the objects in a Lua state.
+
+The main thread and every object in the `allgc`, `finobj`, `tobefnz` and
+`fixedgc` collector lists are visited and counted per type, followed by the
+largest tables, strings and userdata.  Sizes are estimated from the allocation
+size of each object.
+
+Positional arguments (all optional) are:
+
+- L: the expression identifying the current Lua state (default: `L`)
+
+Options:
+
+- --top N: number of objects of each type to list (default: 10)\
+'''
+HELP_THREADS = '''\
+Prints the memory used by the stack and `CallInfo` list of every thread.
+
+Threads (i.e. coroutines) are found through the collector lists and `twups`.
+For each one, the allocated stack size, the used slots, the number of
+`CallInfo` entries (`nci`), the number of open upvalues and the status are
+read and its size estimated.  Totals, a histogram of sizes and the largest
+threads are printed.
+
+Positional arguments (all optional) are:
+
+- L: the expression identifying the current Lua state (default: `L`)
+
+Options:
+
+- --top N: number of threads to list (default: 20)\
+'''
+HELP_GC = '''\
+Prints the state of the garbage collector of a Lua state.
+
+The collector kind (incremental or generational), its current state, the
+bytes in use (`totalbytes` plus `GCdebt`), `GCestimate` and the tuning
+parameters (pause, step multiplier, etc.) are decoded from `global_State`.  In
+generational mode (5.4), the number of objects and bytes of each generation
+are also printed, both by position in the collector lists and by the age bits
+of each object.
+
+With `--sample`, the inferior is resumed instead for the given number of
+seconds, with breakpoints on `luaC_step` which record how often and for how
+long collection steps run, by collector state, without stopping it.
+
+Positional arguments (all optional) are:
+
+- L: the expression identifying the current Lua state (default: `L`)
+
+Options:
+
+- --sample S: sample collection steps for S seconds\
+'''
+HELP_HASHSTATS = '''\
+Prints statistics about the hash part of a table or of the string table.
+
+    lua hashstats EXPR
+    lua hashstats --strings [L]
+
+For a table, the number of live and dead keys, the load factor and the lengths
+of the collision chains (followed through the `next` field of each node) are
+printed, along with the sizes the array and hash parts would have after a
+rehash.  With `--strings`, the occupancy of the buckets of the short string
+table and its longest chains are printed instead.
+
+Positional arguments are:
+
+- EXPR: an expression of type `TValue` or `Table` (or pointers to them)
+- L: the expression identifying the current Lua state (default: `L`)
+
+Options:
+
+- --strings: analyze the string table of the state
+- --top N: number of string table chains to list (default: 5)\
+'''
+HELP_SNAPSHOT = '''\
+Appends a snapshot of every object in a Lua state to a file.
+
+Each object is recorded with its address, type, estimated size, the location
+of its function for closures and prototypes, and its outgoing references.
+Snapshots can be compared outside of gdb with:
+
+    python -m gdb_lua.snapshot diff A B
+
+Positional arguments are:
+
+- FILE: the path of the snapshot file
+- L: the expression identifying the current Lua state (default: `L`)\
+'''
+HELP_REFS = '''\
+Prints the objects which reference a Lua object and how it is reachable.
+
+Direct referrers are listed with the label of each reference (a table key,
+`upvalue[i]`, `user[i]`, `stack[i]`, `metatable`, etc.), followed by the
+shortest paths to the object from the roots: the registry, the main thread and
+the metatables of basic types.
+
+The reverse reference index of the whole heap is built on the first use after
+each stop and reused by subsequent commands.
+
+Positional arguments are:
+
+- EXPR: a `TValue`, a pointer to any object or an address
+- L: the expression identifying the current Lua state (default: `L`)
+
+Options:
+
+- --paths N: maximum number of paths to print (default: 5)
+- --referrers N: maximum number of referrers to print (default: 20)\
+'''
+HELP_FIND = '''\
+Finds the table slots or userdata which contain a value.
+
+    lua find --string S [L]
+    lua find --key K [L]
+    lua find --udata-name N [L]
+    lua find --pointer EXPR [L]
+
+`--string` lists the strings with contents S and the table slots whose value
+is one of them, `--key` the slots whose key is.  `--udata-name` lists the
+userdata whose metatable has a `__name` field equal to N, as set by
+`luaL_newmetatable`.  `--pointer` lists the slots whose key or value is the
+object or light userdata at an address (a `TValue`, a pointer or an integer).
+
+An index of the whole heap is built on the first use after each stop and
+reused by subsequent commands.  Only a hash of each string is kept, so that
+its size is independent of the contents of the heap.
+
+Positional arguments (all optional) are:
+
+- L: the expression identifying the current Lua state (default: `L`)
+
+Options:
+
+- --limit N: maximum number of results to print (default: 20)\
+'''
+HELP_PROTO = '''\
+Disassembles the function prototype of a Lua function.
+
+The constants, up-value descriptors (name, whether the up-value is in the
+stack of the enclosing function and its index) and nested functions of the
+prototype are listed, followed by each instruction with its source line,
+arguments and the constants, up-values, functions or jump targets they refer
+to.  A histogram of the instructions by class (table access, arithmetic,
+calls, etc.) is then printed, with the number of each inside loops, and
+warnings for table lookups, concatenations and closures created in loops.
+
+Positional arguments are:
+
+- EXPR: a `TValue` holding a Lua function, or a pointer to an `LClosure` or
+  `Proto`
+
+Options:
+
+- --summary: only print the histogram and warnings\
+'''
+HELP_PROFILE = '''\
+Samples the Lua call stacks of a running process.
+
+The inferior is resumed and interrupted with `SIGINT` at the given frequency,
+and the stack of the running Lua thread is recorded at each stop.  The result
+is written as folded stacks (`frame;frame;... count`), ready to be rendered as
+a flame graph.  Sampling stops early if the inferior exits or stops for any
+other reason.
+
+Positional arguments (all optional) are:
+
+- L: the Lua state to sample (default: the innermost variable named `L` in the
+  native call stack at each stop)
+
+Options:
+
+- --hz N: number of samples per second (default: 100)
+- --duration S: number of seconds to sample for (default: 10)
+- --output FILE: write the folded stacks to FILE instead of the console
+- --all-threads: also record the stacks of the coroutines which resumed the
+  running one, as a single stack starting at the main thread (L cannot be
+  given)\
+'''
+HELP_ALLOCPROF = '''\
+Profiles the allocations of a running process by Lua source line.
+
+    lua allocprof start [L] [--rate N]
+    lua allocprof stop
+    lua allocprof report [--top N]
+
+`start` sets breakpoints on the allocator of the state (`frealloc` in
+`global_State`) which record each call without stopping the inferior.  New
+blocks are attributed to the current line of the innermost Lua function and
+tracked until they are freed.  `report` prints the bytes allocated, freed and
+still live for each line, largest live first.  `stop` removes the breakpoints
+and keeps the results for `report`.
+
+Every allocator call hits a breakpoint, which slows the inferior down
+considerably.  Sampling reduces the additional cost of reading the call stack.
+
+Positional arguments of `start` (all optional) are:
+
+- L: the expression identifying the current Lua state (default: `L`)
+
+Options:
+
+- --rate N: attribute one in every N new blocks (default: 1)
+- --top N: number of lines to print (default: 20)\
+'''
+HELP_INSTRUMENTATION = '''\
+Whether the hot paths of the extension itself are instrumented.
+
+Calls, wall time and bytes read are counted per function and per command, see
+`lua stats`.  When off, the original functions are used.\
+'''
+HELP_STATS = '''\
+Prints the statistics recorded with `set lua instrumentation on`.
+
+    lua stats
+    lua stats reset
+    lua stats json [FILE]
+
+The number of calls, inclusive wall time and bytes read from memory of each
+instrumented function are printed for each command, slowest first, after the
+totals of the command.  Calls made outside of the `lua` commands (e.g. by the
+pretty printers) are listed under `(no command)`.  Functions which return
+iterators include the time spent producing each element.  `reset` clears the
+statistics and `json` writes them as a JSON object, by command and function,
+to FILE or to the console.\
 '''
 HELP_BACKTRACE = '''\
 Prints the current call stack associated with a Lua state.\
@@ -25,6 +340,18 @@ Prints the current call stack associated with a Lua state.\
 Positional arguments (all optional) are:
 
 - L: the expression identifying the current Lua state (default: `L`)
+
+`lua bt all [L]` prints the call stacks of every thread (i.e. coroutine) of
+the state instead.  Threads with identical stacks are grouped and counted and
+only the stack of the first thread of each group is printed.
+
+Options:
+
+- --format F: `text` (default), `json` (an array) or `jsonl` (one object per
+  line).  Each frame is written as it is read, with its level, `CallInfo` and
+  function addresses, type, source and current line and whether it was tail
+  called.  With `all`, the frames of every thread are written, ungrouped, with
+  the address of the thread.
 '''
 
 def _make_command(
@@ -37,36 +364,314 @@ def _make_command(
             super(Command, self).__init__(*args, **kwargs)
     Command.__doc__ = doc
     if invoke:
-        Command.invoke = invoke # type: ignore
+        Command.invoke = stats.command(args[0], invoke) # type: ignore
     Command()
 
+def _make_parameter(
+    doc: str,
+    name: str,
+    kind: int,
+    value: typing.Any,
+    on_set: typing.Optional[typing.Callable[[typing.Any], None]]=None,
+    *args,
+):
+    class Parameter(gdb.Parameter):
+        def __init__(self):
+            super(Parameter, self).__init__(
+                name, gdb.COMMAND_DATA, kind, *args)
+            self.value = value
+        def get_set_string(self) -> str:
+            if on_set:
+                on_set(self.value)
+            return ''
+    summary = doc.splitlines()[0]
+    summary = summary[0].lower() + summary[1:]
+    Parameter.__doc__ = doc
+    Parameter.set_doc = f'Set the {summary}'
+    Parameter.show_doc = f'Show the {summary}'
+    return Parameter()
+
+def _parse_args(
+    args: typing.Sequence[str],
+    options: dict[str, typing.Optional[typing.Callable[[str], typing.Any]]],
+) -> tuple[dict[str, typing.Any], list[str]]:
+    '''\
+Separates `--name [value]` options from positional arguments.
+
+Options which take no value are mapped to `None` in `options` and are `True`
+in the result if present.  Values can be given as `--name value` or
+`--name=value`.  Dashes in names are replaced with underscores.\
+'''
+    opts, pos = {}, []
+    it = iter(args)
+    for x in it:
+        name, eq, v = x.partition('=')
+        if name not in options:
+            pos.append(x)
+            continue
+        key, conv = name[2:].replace('-', '_'), options[name]
+        if conv is None:
+            opts[key] = True
+            continue
+        if not eq:
+            arg = next(it, None)
+            if arg is None:
+                raise Exception(f'missing value for option: {name}')
+            v = arg
+        opts[key] = conv(v)
+    return opts, pos
+
 def _cmd_type(_, arg: str, _from_tty):
     args = gdb.string_to_argv(arg)
     print(lua.lua().type(gdb.parse_and_eval(' '.join(args))))
 
 def _cmd_stack(_, arg: str, _from_tty):
+    opts, args = _parse_args(gdb.string_to_argv(arg), {
+        '--format': str, '--range': records.parse_range,
+        '--watch': None, '--unwatch': None})
+    if opts.get('unwatch'):
+        return watch.stop()
+    fmt = opts.get('format', 'text')
+    first, last = opts.get('range', (None, None))
+    l = lua.lua()
+    L = types.LuaState(gdb.parse_and_eval(lua.idx_or_none(args, 0) or 'L'))
+    if opts.get('watch'):
+        return watch.start(l, L)
+    i = lua.idx_or_none(args, 1)
+    if i is not None:
+        first = last = int(i)
+    if fmt == 'text':
+        l.dump_stack(L, i, first, last)
+    else:
+        records.write(records.iter_stack(l, int(L.v), first, last), fmt)
+
+def _cmd_table(_, arg: str, _from_tty):
+    opts, args = _parse_args(gdb.string_to_argv(arg), {
+        '--offset': int, '--limit': int, '--keys-only': None})
+    if not args:
+        raise Exception('missing table expression')
+    l = lua.lua()
+    l.dump_table(l.table_address(gdb.parse_and_eval(' '.join(args))), **opts)
+
+def _cmd_heap(_, arg: str, _from_tty):
+    opts, args = _parse_args(gdb.string_to_argv(arg), {'--top': int})
+    heap.dump(
+        lua.lua(),
+        types.LuaState(gdb.parse_and_eval(lua.idx_or_none(args, 0) or 'L')),
+        **opts)
+
+def _cmd_threads(_, arg: str, _from_tty):
+    opts, args = _parse_args(gdb.string_to_argv(arg), {'--top': int})
+    threads.dump_footprints(
+        lua.lua(),
+        types.LuaState(gdb.parse_and_eval(lua.idx_or_none(args, 0) or 'L')),
+        **opts)
+
+def _cmd_gc(_, arg: str, _from_tty):
+    opts, args = _parse_args(gdb.string_to_argv(arg), {'--sample': float})
+    l = lua.lua()
+    L = types.LuaState(gdb.parse_and_eval(lua.idx_or_none(args, 0) or 'L'))
+    if 'sample' in opts:
+        gc.sample(l, L, opts['sample'])
+    else:
+        gc.dump(l, L)
+
+def _cmd_hashstats(_, arg: str, _from_tty):
+    opts, args = _parse_args(gdb.string_to_argv(arg), {
+        '--strings': None, '--top': int})
+    l = lua.lua()
+    if opts.pop('strings', False):
+        hashstats.dump_strings(
+            l,
+            types.LuaState(gdb.parse_and_eval(lua.idx_or_none(args, 0) or 'L')),
+            **opts)
+        return
+    if not args:
+        raise Exception('missing table expression')
+    hashstats.dump_table(
+        l, l.table_address(gdb.parse_and_eval(' '.join(args))))
+
+def _cmd_snapshot(_, arg: str, _from_tty):
     args = gdb.string_to_argv(arg)
-    lua.lua().dump_stack(
+    if not args:
+        raise Exception('missing snapshot file')
+    heap.write_snapshot(
+        lua.lua(),
+        types.LuaState(gdb.parse_and_eval(lua.idx_or_none(args, 1) or 'L')),
+        args[0])
+
+def _cmd_refs(_, arg: str, _from_tty):
+    opts, args = _parse_args(gdb.string_to_argv(arg), {
+        '--paths': int, '--referrers': int})
+    if not args:
+        raise Exception('missing object expression')
+    l = lua.lua()
+    refs.dump(
+        l,
+        types.LuaState(gdb.parse_and_eval(lua.idx_or_none(args, 1) or 'L')),
+        l.object_address(gdb.parse_and_eval(args[0])),
+        **opts)
+
+def _cmd_find(_, arg: str, _from_tty):
+    opts, args = _parse_args(gdb.string_to_argv(arg), {
+        '--string': str, '--key': str, '--udata-name': str, '--pointer': str,
+        '--limit': int})
+    l = lua.lua()
+    if 'pointer' in opts:
+        opts['pointer'] = l.object_address(gdb.parse_and_eval(opts['pointer']))
+    find.find(
+        l,
         types.LuaState(gdb.parse_and_eval(lua.idx_or_none(args, 0) or 'L')),
-        lua.idx_or_none(args, 1))
+        **opts)
 
-def _cmd_backtrace(_, arg: str, _from_tty):
+def _cmd_proto(_, arg: str, _from_tty):
+    opts, args = _parse_args(gdb.string_to_argv(arg), {'--summary': None})
+    if not args:
+        raise Exception('missing function expression')
+    l = lua.lua()
+    bytecode.dump(
+        l, bytecode.proto_address(l, gdb.parse_and_eval(' '.join(args))),
+        code=not opts.get('summary', False))
+
+def _cmd_profile(_, arg: str, _from_tty):
+    opts, args = _parse_args(gdb.string_to_argv(arg), {
+        '--hz': float, '--duration': float, '--output': str,
+        '--all-threads': None})
+    L = None
+    if args:
+        L = types.LuaState(gdb.parse_and_eval(' '.join(args)))
+    profile.profile(lua.lua(), L, **opts)
+
+def _cmd_allocprof(_, arg: str, _from_tty):
+    opts, args = _parse_args(gdb.string_to_argv(arg), {
+        '--rate': int, '--top': int})
+    cmd = lua.idx_or_none(args, 0)
+    if cmd == 'start':
+        allocprof.start(
+            lua.lua(),
+            types.LuaState(gdb.parse_and_eval(lua.idx_or_none(args, 1) or 'L')),
+            **opts)
+    elif cmd == 'stop':
+        allocprof.stop()
+    elif cmd == 'report':
+        allocprof.report(**opts)
+    else:
+        raise Exception('usage: lua allocprof start|stop|report')
+
+def _cmd_stats(_, arg: str, _from_tty):
     args = gdb.string_to_argv(arg)
-    lua.lua().dump_call_stack(
-        types.LuaState(gdb.parse_and_eval(lua.idx_or_none(args, 0) or 'L')))
+    cmd = lua.idx_or_none(args, 0)
+    if cmd is None:
+        stats.dump()
+    elif cmd == 'reset':
+        stats.reset()
+    elif cmd == 'json':
+        stats.dump_json(lua.idx_or_none(args, 1))
+    else:
+        raise Exception('usage: lua stats [reset|json [FILE]]')
+
+def _cmd_backtrace(_, arg: str, _from_tty):
+    opts, args = _parse_args(gdb.string_to_argv(arg), {'--format': str})
+    fmt = opts.get('format', 'text')
+    l = lua.lua()
+    if args and args[0] == 'all':
+        L = types.LuaState(
+            gdb.parse_and_eval(lua.idx_or_none(args, 1) or 'L'))
+        if fmt == 'text':
+            threads.dump_all(l, L)
+        else:
+            records.write(records.iter_all_frames(l, L), fmt)
+        return
+    L = types.LuaState(gdb.parse_and_eval(lua.idx_or_none(args, 0) or 'L'))
+    if fmt == 'text':
+        l.dump_call_stack(L)
+    else:
+        records.write(records.iter_frames(l, int(L.v)), fmt)
 
 def _register_printers(obj):
-    gdb.printing.register_pretty_printer(obj, printing.TValuePrinter.create)
-    gdb.printing.register_pretty_printer(obj, printing.NodeKeyPrinter.create)
-
-_register_printers(gdb.current_objfile())
-_make_command(HELP_LUA, None, 'lua', gdb.COMMAND_RUNNING, prefix=True)
-_make_command(
-    HELP_TYPE, _cmd_type, 'lua type',
-    gdb.COMMAND_DATA, gdb.COMPLETE_EXPRESSION)
-_make_command(
-    HELP_STACK, _cmd_stack, 'lua stack',
-    gdb.COMMAND_DATA, gdb.COMPLETE_EXPRESSION)
-_make_command(
-    HELP_BACKTRACE, _cmd_backtrace, 'lua bt',
-    gdb.COMMAND_STACK, gdb.COMPLETE_EXPRESSION)
+    d = printing.Dispatcher()
+    gdb.printing.register_pretty_printer(obj, d)
+    gdb.events.new_objfile.connect(d.clear)
+    gdb.events.clear_objfiles.connect(d.clear)
+
+def _init():
+    _register_printers(gdb.current_objfile())
+    cache.connect()
+    backend.connect()
+    lua.connect()
+    _make_command(HELP_LUA, None, 'lua', gdb.COMMAND_RUNNING, prefix=True)
+    _make_command(
+        HELP_SET_LUA, None, 'set lua', gdb.COMMAND_DATA, prefix=True)
+    _make_command(
+        HELP_SHOW_LUA, None, 'show lua', gdb.COMMAND_DATA, prefix=True)
+    _make_parameter(
+        HELP_CACHE_SIZE, 'lua cache-size', gdb.PARAM_ZUINTEGER,
+        cache.DEFAULT_SIZE, cache.OBJECTS.resize)
+    _make_parameter(
+        HELP_MEMORY, 'lua memory', gdb.PARAM_ENUM,
+        backend.SOURCES[0], backend.set_source, backend.SOURCES)
+    _make_parameter(
+        HELP_TABLE_COUNTS, 'lua table-counts', gdb.PARAM_BOOLEAN,
+        False, printing.set_table_counts)
+    _make_parameter(
+        HELP_MAX_DEPTH, 'lua max-depth', gdb.PARAM_UINTEGER,
+        printing.DEFAULT_MAX_DEPTH, printing.set_max_depth)
+    _make_parameter(
+        HELP_PRINT_TIME, 'lua print-time', gdb.PARAM_UINTEGER,
+        printing.DEFAULT_TIME_BUDGET, printing.set_time_budget)
+    _make_parameter(
+        HELP_PRINT_BYTES, 'lua print-bytes', gdb.PARAM_UINTEGER,
+        printing.DEFAULT_BYTE_BUDGET, printing.set_byte_budget)
+    _make_parameter(
+        HELP_INSTRUMENTATION, 'lua instrumentation', gdb.PARAM_BOOLEAN,
+        False, stats.set_enabled)
+    # Expansions abandoned by an error must not count as cycles later.
+    gdb.events.before_prompt.connect(printing.EXPANSION.reset)
+    _make_command(
+        HELP_TYPE, _cmd_type, 'lua type',
+        gdb.COMMAND_DATA, gdb.COMPLETE_EXPRESSION)
+    _make_command(
+        HELP_STACK, _cmd_stack, 'lua stack',
+        gdb.COMMAND_DATA, gdb.COMPLETE_EXPRESSION)
+    _make_command(
+        HELP_TABLE, _cmd_table, 'lua table',
+        gdb.COMMAND_DATA, gdb.COMPLETE_EXPRESSION)
+    _make_command(
+        HELP_HEAP, _cmd_heap, 'lua heap',
+        gdb.COMMAND_DATA, gdb.COMPLETE_EXPRESSION)
+    _make_command(
+        HELP_THREADS, _cmd_threads, 'lua threads',
+        gdb.COMMAND_DATA, gdb.COMPLETE_EXPRESSION)
+    _make_command(
+        HELP_GC, _cmd_gc, 'lua gc',
+        gdb.COMMAND_DATA, gdb.COMPLETE_EXPRESSION)
+    _make_command(
+        HELP_HASHSTATS, _cmd_hashstats, 'lua hashstats',
+        gdb.COMMAND_DATA, gdb.COMPLETE_EXPRESSION)
+    _make_command(
+        HELP_SNAPSHOT, _cmd_snapshot, 'lua snapshot',
+        gdb.COMMAND_DATA, gdb.COMPLETE_FILENAME)
+    _make_command(
+        HELP_REFS, _cmd_refs, 'lua refs',
+        gdb.COMMAND_DATA, gdb.COMPLETE_EXPRESSION)
+    _make_command(
+        HELP_FIND, _cmd_find, 'lua find',
+        gdb.COMMAND_DATA, gdb.COMPLETE_EXPRESSION)
+    _make_command(
+        HELP_PROTO, _cmd_proto, 'lua proto',
+        gdb.COMMAND_DATA, gdb.COMPLETE_EXPRESSION)
+    _make_command(
+        HELP_PROFILE, _cmd_profile, 'lua profile',
+        gdb.COMMAND_RUNNING, gdb.COMPLETE_EXPRESSION)
+    _make_command(
+        HELP_ALLOCPROF, _cmd_allocprof, 'lua allocprof',
+        gdb.COMMAND_RUNNING, gdb.COMPLETE_EXPRESSION)
+    _make_command(
+        HELP_STATS, _cmd_stats, 'lua stats',
+        gdb.COMMAND_MAINTENANCE, gdb.COMPLETE_FILENAME)
+    _make_command(
+        HELP_BACKTRACE, _cmd_backtrace, 'lua bt',
+        gdb.COMMAND_STACK, gdb.COMPLETE_EXPRESSION)
+
+if gdb is not None:
+    _init()
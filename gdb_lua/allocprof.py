@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+'''\
+Allocation profiler for live inferiors.
+
+A breakpoint on the allocator of a state (`frealloc` in `global_State`) sees
+every allocation, reallocation and release of memory.  New blocks are sampled,
+attributed to the current line of the innermost Lua function and tracked by
+address until they are released, so that bytes allocated, freed and still live
+can be reported per line.
+
+The address of a new block is only known when the allocator returns, so
+breakpoints are also placed on the instructions which follow the indirect
+calls in the functions of `lmem.c`, i.e. where the allocator returns to.
+Without debug information for those, blocks cannot be tracked and only the
+bytes allocated are reported.\
+'''
+import functools
+import typing
+
+import gdb
+
+from . import backend
+from . import cache
+from . import debug
+from . import memory
+from . import profile
+from . import threads
+from . import types
+
+if typing.TYPE_CHECKING:
+    from . import lua
+
+DEFAULT_RATE = 1
+DEFAULT_TOP = 20
+# Block size used to read the call stack at each sample, small since only the
+# innermost frames are read.
+READ_SHIFT = 8
+# Argument and return value registers of the allocator, by architecture.
+ABIS = {
+    'i386:x86-64': (('rdi', 'rsi', 'rdx', 'rcx'), 'rax'),
+    'aarch64': (('x0', 'x1', 'x2', 'x3'), 'x0'),
+}
+MEMORY_FUNCTION = 'luaM_realloc_'
+NO_FRAME = '(no Lua function)'
+
+# Innermost Lua function of a sample: `(Proto, pc)`.
+Signature = typing.Optional[tuple[int, int]]
+
+class Site(object):
+    'Sampled allocations attributed to a source line.'
+    __slots__ = ('label', 'count', 'allocated', 'freed')
+
+    def __init__(self, label: str):
+        self.label = label
+        self.count = 0
+        self.allocated = 0
+        self.freed = 0
+
+# Site and size of a tracked block.
+Block = tuple[Site, int]
+# Site and size of an allocation, the address of the block being reallocated
+# and its previous entry, if it was tracked.
+Pending = tuple[Site, int, int, typing.Optional[Block]]
+
+class Hook(gdb.Breakpoint):
+    'Internal breakpoint which calls `hit` without stopping the inferior.'
+    def __init__(self, addr: int, hit: typing.Callable[[], None]):
+        super(Hook, self).__init__(f'*{addr:#x}', internal=True)
+        self.silent = True
+        self.hit = hit
+
+    def stop(self) -> bool:
+        # The inferior does not stop, so no event clears memory read through
+        # the direct backend or objects decoded since the last hit.
+        backend.clear()
+        cache.OBJECTS.clear()
+        self.hit()
+        return False
+
+def _is_indirect_call(arch: str, asm: str) -> bool:
+    op, _, arg = asm.partition(' ')
+    if arch == 'aarch64':
+        return op == 'blr'
+    return op.startswith('call') and not arg.strip().startswith('0x')
+
+def function_range(s: gdb.Symbol) -> tuple[int, int]:
+    b = gdb.block_for_pc(int(s.value().address))
+    while b.function is None:
+        b = b.superblock
+    return b.start, b.end
+
+def return_sites(lua: 'lua.Lua', arch: gdb.Architecture) -> list[int]:
+    '''\
+Addresses the allocator returns to: those following the indirect calls of the
+functions defined in `lmem.c`.\
+'''
+    s = lua.objfile.lookup_global_symbol(MEMORY_FUNCTION)
+    if s is None or s.symtab is None:
+        return []
+    symtab, name = s.symtab, arch.name()
+    ret: list[int] = []
+    for block in (symtab.global_block(), symtab.static_block()):
+        for f in block:
+            if not f.is_function or f.symtab.filename != symtab.filename:
+                continue
+            start, end = function_range(f)
+            ret.extend(
+                x['addr'] + x['length']
+                for x in arch.disassemble(start, end - 1)
+                if _is_indirect_call(name, x['asm']))
+    return sorted(set(ret))
+
+class Profiler(object):
+    '''\
+Aggregation of allocator calls per source line.
+
+Only one in every `rate` new blocks is sampled, which bounds the cost of
+reading the call stack; the totals of all calls are kept regardless.  Lines
+are identified by the signature of the innermost Lua frame, a prototype and
+instruction, and labeled once per signature.\
+'''
+    def __init__(
+        self, lua: 'lua.Lua', frealloc: int, rate: int=DEFAULT_RATE,
+    ):
+        if rate < 1:
+            raise Exception(f'invalid sampling rate: {rate}')
+        arch = gdb.selected_frame().architecture()
+        abi = ABIS.get(arch.name())
+        if abi is None:
+            raise Exception(f'unsupported architecture: {arch.name()}')
+        self.lua = lua
+        self.rate = rate
+        self.args, self.ret = abi
+        self.countdown = rate
+        self.calls = 0
+        self.allocated = 0
+        self.freed = 0
+        self.protos: dict[int, debug.Proto] = {}
+        self.proto = functools.partial(debug.cached_proto, self.protos)
+        self.frames: dict[Signature, Site] = {}
+        self.sites: dict[str, Site] = {}
+        # Tracked blocks by address and allocations waiting for the allocator
+        # to return, by thread, along with the block being reallocated.
+        self.blocks: dict[int, Block] = {}
+        self.pending: dict[int, Pending] = {}
+        sites = return_sites(lua, arch)
+        self.tracking = bool(sites)
+        self.breakpoints = [Hook(frealloc, self._enter)]
+        self.breakpoints.extend(Hook(x, self._return) for x in sites)
+
+    def stop(self):
+        for x in self.breakpoints:
+            x.delete()
+        self.breakpoints.clear()
+        self.pending.clear()
+
+    def _forget(self, p: int):
+        'Drops a released prototype, whose address may be reused.'
+        del self.protos[p]
+        self.frames = {
+            k: v for k, v in self.frames.items() if k is None or k[0] != p}
+
+    def _sample(self) -> bool:
+        self.countdown -= 1
+        if self.countdown:
+            return False
+        self.countdown = self.rate
+        return True
+
+    def _enter(self):
+        f = gdb.selected_frame()
+        _, ptr, osize, nsize = (int(f.read_register(x)) for x in self.args)
+        self.calls += 1
+        thread = gdb.selected_thread().global_num
+        self.pending.pop(thread, None)
+        block = self.blocks.pop(ptr, None) if ptr else None
+        if block is not None:
+            block[0].freed += block[1]
+        if ptr and not nsize and ptr in self.protos:
+            self._forget(ptr)
+        if ptr:
+            # `osize` is the type of the new object when `ptr` is null.
+            self.freed += osize
+        if not nsize:
+            return
+        self.allocated += nsize
+        if block is not None:
+            # Blocks which are already tracked remain so when reallocated and
+            # stay attributed to the line which allocated them.
+            site = block[0]
+        elif ptr or not self._sample():
+            return
+        else:
+            site = self._site()
+            site.count += 1
+        site.allocated += nsize
+        if self.tracking:
+            self.pending[thread] = (site, nsize, ptr, block)
+
+    def _return(self):
+        p = self.pending.pop(gdb.selected_thread().global_num, None)
+        if p is None:
+            return
+        addr = int(gdb.selected_frame().read_register(self.ret))
+        site, size, ptr, block = p
+        if addr:
+            self.blocks[addr] = (site, size)
+            return
+        # The allocation failed and the block, if any, is still valid:
+        # `luaM_realloc_` collects garbage and tries again.
+        site.allocated -= size
+        if block is None:
+            site.count -= 1
+        else:
+            block[0].freed -= block[1]
+            self.blocks[ptr] = block
+
+    def _site(self) -> Site:
+        L = profile.current_state(self.lua)
+        key = None
+        if L is not None:
+            r = memory.BlockReader(READ_SHIFT)
+            key = threads.lua_frame(self.lua, r, L, self.proto)
+        ret = self.frames.get(key)
+        if ret is None:
+            label = self._label(key)
+            ret = self.sites.get(label)
+            if ret is None:
+                ret = self.sites[label] = Site(label)
+            self.frames[key] = ret
+        return ret
+
+    def _label(self, key: Signature) -> str:
+        if key is None:
+            return NO_FRAME
+        p = self.proto(self.lua, key[0])
+        line = debug.current_line(p, key[1])
+        return f'{p.source}:{"?" if line is None else line}'
+
+    def write(self, write: typing.Callable[[str], typing.Any], top: int):
+        n = self.rate
+        write(
+            f'{self.calls} allocator calls, {self.allocated} bytes allocated,'
+            f' {self.freed} freed\n')
+        if n != 1:
+            write(f'1 in {n} allocations sampled, sizes scaled by {n}\n')
+        if not self.tracking:
+            write('allocator return sites not found, live bytes unknown\n')
+        write(
+            f'{"count":>10}{"allocated":>14}{"freed":>14}{"live":>14}'
+            '  line\n')
+        sites = sorted(
+            self.sites.values(),
+            key=lambda x: (x.allocated - x.freed, x.allocated), reverse=True)
+        for s in sites[:top]:
+            live = (s.allocated - s.freed) * n if self.tracking else '-'
+            write(
+                f'{s.count * n:>10}{s.allocated * n:>14}{s.freed * n:>14}'
+                f'{live:>14}  {s.label}\n')
+        if len(sites) > top:
+            write(f'({len(sites) - top} more lines)\n')
+
+PROFILER: typing.Optional[Profiler] = None
+
+def start(lua: 'lua.Lua', L: types.LuaState, rate: int=DEFAULT_RATE):
+    global PROFILER
+    if PROFILER is not None:
+        PROFILER.stop()
+    frealloc = int(L.v['l_G']['frealloc'])
+    PROFILER = Profiler(lua, frealloc, rate)
+    if not PROFILER.tracking:
+        gdb.write('allocator return sites not found, live bytes unknown\n')
+
+def stop():
+    if PROFILER is None:
+        raise Exception('allocation profiler not started')
+    PROFILER.stop()
+
+def report(top: int=DEFAULT_TOP):
+    if PROFILER is None:
+        raise Exception('allocation profiler not started')
+    PROFILER.write(gdb.write, top)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+'''\
+Sources of raw inferior memory.
+
+Every raw read (`types.read_struct`, `memory.BlockReader`, etc.) goes through
+the backend returned by `current`.  By default, memory is read through gdb.
+With `set lua memory direct`, the memory of live processes is read from
+`/proc/PID/mem` and that of core dumps from a memory map of the core file,
+bypassing gdb's target stack entirely.\
+'''
+import bisect
+import mmap
+import os
+import re
+import struct
+import typing
+
+import gdb
+
+SOURCES = ('gdb', 'direct')
+PAGE_SHIFT = 12
+MAX_PAGES = 4096
+CORE_RE = re.compile(r"Local core dump file:\s*`(.+)', file type")
+
+PT_LOAD = 1
+# `e_phoff`, `e_phentsize` and `e_phnum` of `Elf32_Ehdr`/`Elf64_Ehdr` and
+# `p_type`, `p_offset`, `p_vaddr`, `p_filesz` and `p_memsz` of the program
+# headers, by `EI_CLASS`.
+_ELF = {
+    1: ('28x I 10x H H', 'I I I 4x I I'),
+    2: ('32x Q 14x H H', 'I 4x Q Q 8x Q Q'),
+}
+
+def _error(addr: int) -> gdb.MemoryError:
+    return gdb.MemoryError(f'Cannot access memory at address {addr:#x}')
+
+class Memory(object):
+    def read(self, addr: int, n: int) -> bytes: raise NotImplementedError()
+    def clear(self): pass
+    def close(self): pass
+
+class InferiorMemory(Memory):
+    'Memory of the selected inferior, read through gdb.'
+    def read(self, addr: int, n: int) -> bytes:
+        return gdb.selected_inferior().read_memory(addr, n).tobytes()
+
+class ProcMemory(Memory):
+    '''\
+Memory of a live process, read from `/proc/PID/mem` through a cache of pages.
+
+Reads contained in a page are served from the cache, which must be cleared
+whenever the process runs (see `connect`).  Larger reads go directly to the
+file.\
+'''
+    def __init__(
+        self, pid: int, shift: int=PAGE_SHIFT, max_pages: int=MAX_PAGES,
+    ):
+        self.fd = os.open(f'/proc/{pid}/mem', os.O_RDONLY)
+        self.shift = shift
+        self.mask = (1 << shift) - 1
+        self.max_pages = max_pages
+        self.pages: dict[int, typing.Optional[bytes]] = {}
+
+    def _pread(self, addr: int, n: int) -> typing.Optional[bytes]:
+        try:
+            ret = os.pread(self.fd, n, addr)
+        except (OSError, OverflowError):
+            return None
+        return ret if len(ret) == n else None
+
+    def _page(self, i: int) -> typing.Optional[bytes]:
+        pages = self.pages
+        try:
+            return pages[i]
+        except KeyError:
+            pass
+        if len(pages) >= self.max_pages:
+            del pages[next(iter(pages))]
+        ret = pages[i] = self._pread(i << self.shift, 1 << self.shift)
+        return ret
+
+    def read(self, addr: int, n: int) -> bytes:
+        off = addr & self.mask
+        if off + n <= self.mask + 1:
+            p = self._page(addr >> self.shift)
+            if p is not None:
+                return p[off:off + n]
+        ret = self._pread(addr, n)
+        if ret is None:
+            raise _error(addr)
+        return ret
+
+    def clear(self):
+        self.pages.clear()
+
+    def close(self):
+        os.close(self.fd)
+
+class CoreMemory(Memory):
+    '''\
+Memory of a core dump, read from a memory map of its `PT_LOAD` segments.
+
+Ranges not contained in the file (e.g. read-only mappings of the executable,
+which are usually not dumped) are read from `fallback`.\
+'''
+    def __init__(self, path: str, fallback: Memory):
+        self.fallback = fallback
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        m = self.map
+        if m[:4] != b'\x7fELF':
+            raise Exception(f'not an ELF file: {path}')
+        order = '<' if m[5] == 1 else '>'
+        ehdr, phdr = (struct.Struct(order + x) for x in _ELF[m[4]])
+        phoff, phentsize, phnum = ehdr.unpack_from(m)
+        segments = []
+        for i in range(phnum):
+            t, off, vaddr, filesz, _ = \
+                phdr.unpack_from(m, phoff + i * phentsize)
+            if t == PT_LOAD and filesz:
+                segments.append((vaddr, vaddr + filesz, off))
+        segments.sort()
+        self.starts = [x[0] for x in segments]
+        self.segments = segments
+
+    def read(self, addr: int, n: int) -> bytes:
+        i = bisect.bisect_right(self.starts, addr) - 1
+        if i >= 0:
+            start, end, off = self.segments[i]
+            if addr + n <= end:
+                off += addr - start
+                return self.map[off:off + n]
+        return self.fallback.read(addr, n)
+
+    def close(self):
+        self.map.close()
+
+INFERIOR = InferiorMemory()
+_SOURCE = 'gdb'
+# Direct backend of the selected inferior, keyed by inferior and process.
+_DIRECT: typing.Optional[tuple[tuple[int, int], Memory]] = None
+
+def _core_file() -> typing.Optional[str]:
+    m = CORE_RE.search(gdb.execute('info target', to_string=True))
+    return None if m is None else m.group(1)
+
+def _direct(key: tuple[int, int]) -> Memory:
+    # The process of a core dump also has a pid, check for those first.
+    path = _core_file()
+    if path is not None:
+        return CoreMemory(path, INFERIOR)
+    _, pid = key
+    if not pid:
+        return INFERIOR
+    try:
+        return ProcMemory(pid)
+    except OSError:
+        # e.g. remote targets.
+        return INFERIOR
+
+def current() -> Memory:
+    global _DIRECT
+    if _SOURCE == 'gdb':
+        return INFERIOR
+    inf = gdb.selected_inferior()
+    key = inf.num, inf.pid
+    if _DIRECT is None or _DIRECT[0] != key:
+        reset()
+        _DIRECT = key, _direct(key)
+    return _DIRECT[1]
+
+def reset(*_):
+    'Closes the direct backend, which is recreated on the next read.'
+    global _DIRECT
+    if _DIRECT is not None:
+        _DIRECT[1].close()
+        _DIRECT = None
+
+def set_source(source: str):
+    global _SOURCE
+    if source not in SOURCES:
+        raise Exception(f'invalid memory source: {source}')
+    reset()
+    _SOURCE = source
+
+def clear(*_):
+    if _DIRECT is not None:
+        _DIRECT[1].clear()
+
+def connect():
+    'Clears cached pages when the inferior may have modified its memory.'
+    events = gdb.events
+    for e in (events.stop, events.memory_changed, events.inferior_call_post):
+        e.connect(clear)
+    for e in (events.new_objfile, events.clear_objfiles, events.exited):
+        e.connect(reset)
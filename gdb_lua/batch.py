@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+'''\
+Analysis of many core dumps of the same binary:
+
+    python -m gdb_lua.batch CORES... --binary BIN --report FILE
+
+The cores are distributed among a pool of `gdb --batch` workers, one per CPU
+by default.  Each worker loads the binary once and then opens its cores one by
+one, so symbols, the `lua.Lua` instance and its layout are shared by all cores
+of a worker.  For each core, the Lua state of the first thread which has one is
+found and its backtrace, stack and heap census are recorded.  The results are
+merged into a single report where cores with identical Lua backtraces are
+grouped.
+
+This module is imported outside of gdb by the driver and inside of gdb by the
+workers, so only the latter import the rest of the package.\
+'''
+import argparse
+import collections
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import typing
+
+ADDRESS_RE = re.compile(r'0x[0-9a-fA-F]+')
+MAX_CORES_LISTED = 8
+
+class Result(typing.NamedTuple):
+    core: str
+    error: typing.Optional[str]
+    thread: typing.Optional[int]
+    backtrace: str
+    stack: str
+    # Number and size of objects of each type.
+    heap: dict[str, tuple[int, int]]
+
+def _analyze(core: str) -> Result:
+    import gdb
+    from . import backend, cache, heap, lua, profile, types
+    gdb.execute(f'core-file {core}', to_string=True)
+    # Core files do not generate the events which invalidate caches.
+    cache.OBJECTS.clear()
+    cache.INDEXES.clear()
+    backend.reset()
+    l = lua.lua()
+    selected = gdb.selected_thread()
+    threads = sorted(
+        gdb.selected_inferior().threads(), key=lambda x: x != selected)
+    for t in threads:
+        t.switch()
+        L = profile.current_state(l)
+        if L is not None:
+            break
+    else:
+        return Result(core, 'no Lua state found', None, '', '', {})
+    expr = f'(lua_State *){L:#x}'
+    bt = gdb.execute(f'lua bt {expr}', to_string=True)
+    stack = gdb.execute(f'lua stack {expr}', to_string=True)
+    c = heap.census(l, types.LuaState(gdb.parse_and_eval(expr)), 0)
+    return Result(
+        core, None, t.num, bt, stack,
+        {k: (c.count[k], c.size[k]) for k in c.count})
+
+def worker(jobs: str, output: str):
+    'Entry point of each gdb worker: analyzes the cores listed in `jobs`.'
+    with open(jobs) as f:
+        cores = json.load(f)
+    with open(output, 'w') as out:
+        for core in cores:
+            try:
+                r = _analyze(core)
+            except Exception as e:
+                r = Result(core, f'{type(e).__name__}: {e}', None, '', '', {})
+            out.write(json.dumps(r._asdict()) + '\n')
+            out.flush()
+
+def _spawn(
+    gdb: str, binary: str, cores: list[str], tmp: str, i: int,
+) -> tuple[subprocess.Popen, str, str]:
+    jobs, output, errors = (
+        os.path.join(tmp, f'{x}.{i}') for x in ('jobs', 'out', 'err'))
+    with open(jobs, 'w') as f:
+        json.dump(cores, f)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    cmd = (
+        gdb, '--batch', '-nx', '-q', binary,
+        '-ex', f'python import sys; sys.path.insert(0, {root!r})',
+        '-ex', 'python import gdb_lua.batch as b;'
+            f' b.worker({jobs!r}, {output!r})')
+    # Warnings are written to a file: a pipe would block the worker once full
+    # until the driver waits for it.
+    with open(errors, 'wb') as err:
+        p = subprocess.Popen(
+            cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+            stderr=err)
+    return p, output, errors
+
+def run(
+    cores: typing.Sequence[str], binary: str,
+    jobs: int, gdb: str='gdb',
+) -> list[Result]:
+    'Analyzes `cores` with `jobs` parallel gdb workers.'
+    jobs = max(1, min(jobs, len(cores)))
+    ret: list[Result] = []
+    with tempfile.TemporaryDirectory(prefix='gdb_lua.') as tmp:
+        workers = [
+            _spawn(gdb, binary, list(cores[i::jobs]), tmp, i)
+            for i in range(jobs)]
+        for p, output, errors in workers:
+            if p.wait():
+                with open(errors, errors='replace') as f:
+                    sys.stderr.write(f.read())
+            try:
+                with open(output) as f:
+                    ret.extend(Result(**json.loads(x)) for x in f)
+            except OSError:
+                pass
+        done = {x.core for x in ret}
+        ret.extend(
+            Result(x, 'worker failed', None, '', '', {})
+            for x in cores if x not in done)
+    order = {x: i for i, x in enumerate(cores)}
+    return sorted(ret, key=lambda x: order[x.core])
+
+def _group_key(bt: str) -> str:
+    return ADDRESS_RE.sub('0x0', bt)
+
+def write_report(results: typing.Sequence[Result], out: typing.TextIO):
+    ok = [x for x in results if x.error is None]
+    out.write(f'{len(results)} cores, {len(ok)} with a Lua state\n')
+    groups: dict[str, list[Result]] = collections.defaultdict(list)
+    for x in ok:
+        groups[_group_key(x.backtrace)].append(x)
+    out.write(f'{len(groups)} distinct Lua backtraces\n')
+    for bt, rs in sorted(groups.items(), key=lambda x: -len(x[1])):
+        names = ', '.join(x.core for x in rs[:MAX_CORES_LISTED])
+        if len(rs) > MAX_CORES_LISTED:
+            names += f' (and {len(rs) - MAX_CORES_LISTED} more)'
+        out.write(
+            f'\n{len(rs)} core{"s" if len(rs) != 1 else ""}: {names}\n\n'
+            f'{bt}\nstack of {rs[0].core} (thread {rs[0].thread}):\n'
+            f'{rs[0].stack}')
+    count: collections.Counter = collections.Counter()
+    size: collections.Counter = collections.Counter()
+    for x in ok:
+        for k, (n, s) in x.heap.items():
+            count[k] += n
+            size[k] += s
+    if ok:
+        out.write('\nheap, all cores:\n')
+        out.write(f'{"type":<14}{"count":>14}{"bytes":>16}\n')
+        for k, s in size.most_common():
+            out.write(f'{k:<14}{count[k]:>14}{s:>16}\n')
+        out.write('\nheap per core:\n')
+        totals = (
+            (sum(n for n, _ in x.heap.values()),
+                sum(s for _, s in x.heap.values()), x.core)
+            for x in ok)
+        for n, s, core in sorted(totals, key=lambda x: -x[1]):
+            out.write(f'{n:>14}{s:>16}  {core}\n')
+    errors = [x for x in results if x.error is not None]
+    if errors:
+        out.write('\nerrors:\n')
+        for x in errors:
+            out.write(f'{x.core}: {x.error}\n')
+
+def main(args: typing.Sequence[str]) -> int:
+    p = argparse.ArgumentParser(
+        prog='python -m gdb_lua.batch',
+        description='Analyze the Lua states of many core dumps.')
+    p.add_argument('cores', nargs='+', help='core dump files')
+    p.add_argument(
+        '--binary', required=True, help='executable which produced the cores')
+    p.add_argument(
+        '--report', help='file to write the report to (default: stdout)')
+    p.add_argument(
+        '--jobs', type=int, default=os.cpu_count() or 1,
+        help='number of gdb workers (default: number of CPUs)')
+    p.add_argument(
+        '--gdb', default='gdb', help='gdb executable (default: gdb)')
+    opts = p.parse_args(args)
+    results = run(opts.cores, opts.binary, opts.jobs, opts.gdb)
+    if opts.report is None:
+        write_report(results, sys.stdout)
+    else:
+        with open(opts.report, 'w') as f:
+            write_report(results, f)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+'''\
+Disassembly of Lua function prototypes, see `luac.c`.
+
+The constants, nested prototypes and up-value descriptors of a `Proto` are
+each read in a single block and decoded once, then cached by address along
+with the code and line information of `debug.proto`.  Instructions between a
+backward jump and its target are counted as inside a loop, to point out the
+usual causes of slow loops.\
+'''
+import array
+import collections
+import typing
+
+import gdb
+
+from . import cache
+from . import debug
+from . import opcodes
+from . import printing
+from . import types
+
+if typing.TYPE_CHECKING:
+    from . import lua
+
+STRING_PREVIEW = 40
+# Opcode classes reported when they are executed in loops.
+LOOP_WARNINGS = (
+    ('table get', 'table lookups in loops, consider caching them in locals'),
+    ('concat', 'concatenations in loops, consider `table.concat`'),
+    ('closure', 'closures created in loops'),
+)
+WARNING_PCS = 8
+
+class Function(typing.NamedTuple):
+    'A `Proto` and everything else needed to disassemble it.'
+    proto: debug.Proto
+    numparams: int
+    is_vararg: bool
+    maxstacksize: int
+    # Formatted value of each constant.
+    constants: tuple[str, ...]
+    # Address of each nested prototype.
+    protos: tuple[int, ...]
+    # `(name, instack, idx)` of each up-value.
+    upvalues: tuple[tuple[str, int, int], ...]
+    # Whether each instruction is inside a loop.
+    loops: array.array
+
+def function(lua: 'lua.Lua', p: int) -> Function:
+    return cache.OBJECTS.get('function', p, lambda: _function(lua, p))
+
+def _function(lua: 'lua.Lua', p: int) -> Function:
+    l = lua.layout
+    f = types.read_fields(l.proto, p)
+    proto = debug.proto(lua, p)
+    k = types.read_array(l.tvalue, f['k'], f['sizek'])
+    upvalues = types.read_array(
+        l.upvaldesc_info, f['upvalues'], f['sizeupvalues'])
+    return Function(
+        proto, f['numparams'], bool(f['is_vararg']), f['maxstacksize'],
+        tuple(_constant(lua, tt, bits) for tt, bits in k),
+        tuple(x for x, in types.read_array(l.pointers, f['p'], f['sizep'])),
+        tuple((_name(lua, name), s, i) for name, s, i in upvalues),
+        loops(lua.opcodes, proto.code))
+
+def _name(lua: 'lua.Lua', addr: int) -> str:
+    return lua.read_string(addr).decode(errors='replace') if addr else '?'
+
+def _constant(lua: 'lua.Lua', tt: int, bits: int) -> str:
+    t, rtt = tt & types.TTYPE_MASK, types.RawTypeTag(tt)
+    if t == types.LUA_TNIL:
+        return 'nil'
+    if t == types.LUA_TBOOLEAN:
+        return 'true' if lua.raw_toboolean(bits, rtt) else 'false'
+    if t == types.LUA_TNUMBER:
+        if lua.isinteger(rtt):
+            return str(lua.raw_integer(bits))
+        return f'{lua.raw_number(bits):.14g}'
+    if t == types.LUA_TSTRING:
+        s = lua.read_string(lua.layout.pointer(bits))
+        if len(s) <= STRING_PREVIEW:
+            return printing.quote(s)
+        return printing.quote(s[:STRING_PREVIEW]) + '...'
+    return printing.format_value(lua, types.RawTValue(0, tt, bits))
+
+def loops(ops: opcodes.Opcodes, code: array.array) -> array.array:
+    'Marks the instructions between each backward jump and its target.'
+    n = len(code)
+    delta = array.array('i', [0]) * (n + 1)
+    for pc, i in enumerate(code):
+        t = ops.jump(i, pc)
+        if t is not None and 0 <= t <= pc:
+            delta[t] += 1
+            delta[pc + 1] -= 1
+    ret = array.array('B', [0]) * n
+    depth = 0
+    for pc in range(n):
+        depth += delta[pc]
+        ret[pc] = depth > 0
+    return ret
+
+def proto_address(lua: 'lua.Lua', v: gdb.Value) -> int:
+    'Address of the `Proto` of a Lua function value, `LClosure` or `Proto`.'
+    t = v.type.strip_typedefs()
+    if t.code == gdb.TYPE_CODE_PTR:
+        tag = t.target().strip_typedefs().tag
+        if tag == 'Proto':
+            return int(v)
+        if tag == 'LClosure':
+            return int(v['p'])
+        v = v.dereference()
+        t = v.type.strip_typedefs()
+    if t.tag == 'StackValue':
+        v = v['val']
+    tv = types.TValue(v)
+    if int(types.tt(tv).v) != types.LUA_VLCL | types.BIT_ISCOLLECTABLE:
+        raise Exception(f'value is not a Lua function: {v}')
+    return int(types.LClosure(lua, types.tvalue(tv)).v['p'])
+
+def _constant_at(f: Function, k: int) -> str:
+    return f.constants[k] if 0 <= k < len(f.constants) else f'K[{k}]?'
+
+def instruction(lua: 'lua.Lua', f: Function, pc: int) -> str:
+    'Formats an instruction with its arguments and what they refer to.'
+    ops, code = lua.opcodes, f.proto.code
+    i = code[pc]
+    name = ops.name(i)
+    args = ' '.join(map(str, ops.operands(i)))
+    if ops.k(i) and ops.mode(i) == 'ABC':
+        args += ' k'
+    notes = []
+    if name in ('GETUPVAL', 'SETUPVAL', 'GETTABUP', 'SETTABUP'):
+        u = ops.a(i) if name == 'SETTABUP' else ops.b(i)
+        notes.append(f.upvalues[u][0] if u < len(f.upvalues) else '?')
+    notes.extend(_constant_at(f, k) for k in ops.constants(i))
+    if name == 'LOADKX' and pc + 1 < len(code):
+        notes.append(_constant_at(f, ops.ax(code[pc + 1])))
+    elif name == 'CLOSURE':
+        p = ops.bx(i)
+        if p < len(f.protos):
+            notes.append(
+                f'{f.protos[p]:#x} {types.proto_location(lua, f.protos[p])}')
+    if (t := ops.jump(i, pc)) is not None:
+        notes.append(f'to {t + 1}')
+    line = debug.current_line(f.proto, pc)
+    ret = f'{pc + 1:>6} [{"-" if line is None else line}] {name:<10} {args}'
+    if notes:
+        ret = f'{ret:<40} ; {", ".join(notes)}'
+    return ret
+
+def histogram(
+    lua: 'lua.Lua', f: Function,
+) -> tuple[collections.Counter, collections.Counter]:
+    'Number of instructions of each opcode class, in total and in loops.'
+    ops = lua.opcodes
+    total: collections.Counter = collections.Counter()
+    in_loops: collections.Counter = collections.Counter()
+    for i, loop in zip(f.proto.code, f.loops):
+        c = opcodes.CLASSES.get(ops.name(i), 'other')
+        total[c] += 1
+        if loop:
+            in_loops[c] += 1
+    return total, in_loops
+
+def _write_warnings(lua: 'lua.Lua', f: Function, in_loops: collections.Counter):
+    ops = lua.opcodes
+    for cls, msg in LOOP_WARNINGS:
+        n = in_loops[cls]
+        if not n:
+            continue
+        pcs = [
+            pc + 1 for pc, (i, loop) in enumerate(zip(f.proto.code, f.loops))
+            if loop and opcodes.CLASSES.get(ops.name(i)) == cls]
+        lines = ' '.join(map(str, pcs[:WARNING_PCS]))
+        if len(pcs) > WARNING_PCS:
+            lines += ' ...'
+        gdb.write(f'  {n} {msg} (at {lines})\n')
+
+def dump(lua: 'lua.Lua', p: int, code: bool=True):
+    f = function(lua, p)
+    gdb.write(
+        f'function {types.proto_location(lua, p)} (proto {p:#x})\n'
+        f'  {len(f.proto.code)} instructions,'
+        f' {f.numparams}{"+" if f.is_vararg else ""} params,'
+        f' {f.maxstacksize} slots, {len(f.upvalues)} upvalues,'
+        f' {len(f.constants)} constants, {len(f.protos)} functions\n')
+    if code:
+        if f.constants:
+            gdb.write('constants:\n')
+            for i, k in enumerate(f.constants):
+                gdb.write(f'  {i:>4} {k}\n')
+        if f.upvalues:
+            gdb.write('upvalues:\n')
+            for i, (name, instack, idx) in enumerate(f.upvalues):
+                gdb.write(f'  {i:>4} {name} {instack} {idx}\n')
+        if f.protos:
+            gdb.write('functions:\n')
+            for i, child in enumerate(f.protos):
+                loc = types.proto_location(lua, child)
+                gdb.write(f'  {i:>4} {child:#x} {loc}\n')
+        gdb.write('code:\n')
+        for pc in range(len(f.proto.code)):
+            gdb.write(instruction(lua, f, pc) + '\n')
+    total, in_loops = histogram(lua, f)
+    gdb.write(f'{"class":<14}{"count":>8}{"in loops":>10}\n')
+    for cls, n in total.most_common():
+        gdb.write(f'{cls:<14}{n:>8}{in_loops[cls]:>10}\n')
+    if any(in_loops[cls] for cls, _ in LOOP_WARNINGS):
+        gdb.write('warnings:\n')
+        _write_warnings(lua, f, in_loops)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+import collections
+import typing
+
+import gdb
+
+T = typing.TypeVar('T')
+
+DEFAULT_SIZE = 1 << 16
+
+class Cache(object):
+    '''\
+LRU cache of decoded objects, keyed by kind and `GCObject` address.
+
+Entries are only valid while the inferior's memory is unchanged, see
+`connect`.  Core dumps never generate the events which clear it, so entries
+are kept for the whole session.\
+'''
+    __slots__ = ('size', 'd')
+
+    def __init__(self, size: int):
+        self.size = size
+        self.d: collections.OrderedDict = collections.OrderedDict()
+
+    def get(self, kind: str, addr: int, f: typing.Callable[[], T]) -> T:
+        d, k = self.d, (kind, addr)
+        try:
+            d.move_to_end(k)
+            return d[k]
+        except KeyError:
+            pass
+        ret = f()
+        if self.size:
+            d[k] = ret
+            if len(d) > self.size:
+                d.popitem(last=False)
+        return ret
+
+    def resize(self, size: int):
+        self.size = size
+        while len(self.d) > size:
+            self.d.popitem(last=False)
+
+    def clear(self, *_):
+        self.d.clear()
+
+OBJECTS = Cache(DEFAULT_SIZE)
+# Whole-heap indexes, few but large, kept apart so that they are not evicted
+# by individual objects.
+INDEXES = Cache(4)
+
+def connect():
+    'Clears the caches whenever the inferior may have modified its memory.'
+    events = gdb.events
+    for e in (
+        events.stop, events.memory_changed, events.inferior_call_post,
+        events.new_objfile, events.clear_objfiles,
+    ):
+        e.connect(OBJECTS.clear)
+        e.connect(INDEXES.clear)
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+'''\
+Line and name information of Lua functions, see `ldebug.c`.
+
+The parts of a `Proto` needed to resolve them are decoded in bulk and cached
+by address, so that many frames of the same function (e.g. in a deep
+recursion) share the work.\
+'''
+import array
+import struct
+import typing
+
+from . import cache
+from . import types
+
+if typing.TYPE_CHECKING:
+    from . import lua
+
+# Marker in `lineinfo` of instructions with an entry in `abslineinfo`.
+ABSLINEINFO = -0x80
+LUA_ENV = '_ENV'
+
+Name = tuple[str, str]
+
+class Proto(typing.NamedTuple):
+    'Decoded code and debug information of a function prototype.'
+    addr: int
+    source: str
+    linedefined: int
+    code_addr: int
+    code: array.array
+    # Line of each instruction, `None` if stripped.
+    lines: typing.Optional[array.array]
+    k: int
+    sizek: int
+    # `(varname, startpc, endpc)` of each local variable.
+    locvars: tuple[tuple[int, int, int], ...]
+    upvalues: tuple[int, ...]
+
+def proto(lua: 'lua.Lua', p: int) -> Proto:
+    return cache.OBJECTS.get('proto', p, lambda: _proto(lua, p))
+
+def cached_proto(protos: dict[int, Proto], lua: 'lua.Lua', p: int) -> Proto:
+    'Like `proto`, but kept in `protos` instead of the per-stop cache.'
+    ret = protos.get(p)
+    if ret is None:
+        ret = protos[p] = _proto(lua, p)
+    return ret
+
+def _ints(s: struct.Struct, addr: int, n: int) -> typing.Iterator[int]:
+    return (x for x, in types.read_array(s, addr, n))
+
+def _proto(lua: 'lua.Lua', p: int) -> Proto:
+    l = lua.layout
+    f = types.read_fields(l.proto, p)
+    return Proto(
+        p, types.chunk_name(lua, f['source']), f['linedefined'],
+        f['code'],
+        array.array('I', _ints(l.instruction, f['code'], f['sizecode'])),
+        _lines(lua, f), f['k'], f['sizek'],
+        tuple(types.read_array(l.locvar, f['locvars'], f['sizelocvars'])),
+        tuple(x for x, in types.read_array(
+            l.upvaldesc, f['upvalues'], f['sizeupvalues'])))
+
+def _lines(lua: 'lua.Lua', f: dict[str, int]) \
+    -> typing.Optional[array.array] \
+:
+    'Line of each instruction, see `luaG_getfuncline`.'
+    l = lua.layout
+    if not f['lineinfo']:
+        return None
+    info = _ints(l.lineinfo, f['lineinfo'], f['sizelineinfo'])
+    if l.abslineinfo is None:
+        return array.array('i', info)
+    abs_lines = dict(types.read_array(
+        l.abslineinfo, f['abslineinfo'], f['sizeabslineinfo']))
+    ret = array.array('i')
+    line = f['linedefined']
+    for pc, x in enumerate(info):
+        line = abs_lines.get(pc, line) if x == ABSLINEINFO else line + x
+        ret.append(line)
+    return ret
+
+def current_pc(lua: 'lua.Lua', p: Proto, savedpc: int) -> int:
+    return (savedpc - p.code_addr) // lua.layout.instruction.size - 1
+
+def current_line(p: Proto, pc: int) -> typing.Optional[int]:
+    if p.lines is None or not 0 <= pc < len(p.lines):
+        return None
+    return p.lines[pc]
+
+def _str(lua: 'lua.Lua', addr: int) -> str:
+    return lua.read_string(addr).decode(errors='replace')
+
+def local_name(lua: 'lua.Lua', p: Proto, n: int, pc: int) \
+    -> typing.Optional[str] \
+:
+    'Name of the `n`-th local variable active at `pc`, see `luaF_getlocalname`.'
+    for name, start, end in p.locvars:
+        if pc < start:
+            break
+        if pc < end:
+            n -= 1
+            if not n:
+                return _str(lua, name)
+    return None
+
+def upvalue_name(lua: 'lua.Lua', p: Proto, i: int) -> str:
+    if not 0 <= i < len(p.upvalues) or not p.upvalues[i]:
+        return '?'
+    return _str(lua, p.upvalues[i])
+
+def _kstring(lua: 'lua.Lua', p: Proto, i: int) -> typing.Optional[str]:
+    'Value of constant `i` if it is a string.'
+    if not 0 <= i < p.sizek:
+        return None
+    l = lua.layout
+    tt, bits = types.read_struct(l.tvalue, p.k + i * l.tvalue.size)
+    if tt & types.TTYPE_MASK != types.LUA_TSTRING:
+        return None
+    return _str(lua, l.pointer(bits))
+
+def _findsetreg(lua: 'lua.Lua', p: Proto, lastpc: int, reg: int) -> int:
+    'Last instruction before `lastpc` which unconditionally sets `reg`.'
+    ops = lua.opcodes
+    op, code = ops.op, p.code
+    if ops.mm[ops.opcode(code[lastpc])]:
+        # The previous instruction was not actually executed.
+        lastpc -= 1
+    loadnil, tforcall, jmp = op['LOADNIL'], op['TFORCALL'], op['JMP']
+    calls = (op['CALL'], op['TAILCALL'])
+    ret, jmptarget = -1, 0
+    for pc in range(lastpc):
+        i = code[pc]
+        o, a = ops.opcode(i), ops.a(i)
+        if o == loadnil:
+            change = a <= reg <= a + ops.b(i)
+        elif o == tforcall:
+            change = reg >= a + 2
+        elif o in calls:
+            change = reg >= a
+        elif o == jmp:
+            dest = pc + 1 + ops.sj(i)
+            if jmptarget < dest <= lastpc:
+                jmptarget = dest
+            change = False
+        else:
+            change = o < len(ops.sets_a) and ops.sets_a[o] and reg == a
+        if change:
+            # Code inside a jump cannot be known to set the register.
+            ret = pc if jmptarget <= pc else -1
+    return ret
+
+def _kname(lua: 'lua.Lua', p: Proto, pc: int, c: int) -> str:
+    'Name of the key in argument `c`: a constant or, in 5.3, an RK operand.'
+    bitrk = lua.opcodes.BITRK
+    if bitrk is not None and not c & bitrk:
+        return _rname(lua, p, pc, c)
+    if bitrk is not None:
+        c &= ~bitrk
+    ret = _kstring(lua, p, c)
+    return '?' if ret is None else ret
+
+def _rname(lua: 'lua.Lua', p: Proto, pc: int, c: int) -> str:
+    'Name of the key in register `c`, if it holds a constant.'
+    ret = getobjname(lua, p, pc, c)
+    return ret[1] if ret is not None and ret[0] == 'constant' else '?'
+
+def _gxf(lua: 'lua.Lua', p: Proto, pc: int, i: int, up: bool) -> str:
+    'Whether indexing the table in argument `B` is a global access.'
+    ops, t = lua.opcodes, lua.opcodes.b(i)
+    if up:
+        name: typing.Optional[str] = upvalue_name(lua, p, t)
+    elif ops.BITRK is not None:
+        name = local_name(lua, p, t + 1, pc)
+    else:
+        r = getobjname(lua, p, pc, t)
+        name = r and r[1]
+    return 'global' if name == LUA_ENV else 'field'
+
+def getobjname(lua: 'lua.Lua', p: Proto, lastpc: int, reg: int) \
+    -> typing.Optional[Name] \
+:
+    'Kind and name of the value in register `reg` at instruction `lastpc`.'
+    name = local_name(lua, p, reg + 1, lastpc)
+    if name is not None:
+        return 'local', name
+    pc = _findsetreg(lua, p, lastpc, reg)
+    if pc == -1:
+        return None
+    ops = lua.opcodes
+    i = p.code[pc]
+    op = ops.name(i)
+    if op == 'MOVE':
+        b = ops.b(i)
+        if b < ops.a(i):
+            return getobjname(lua, p, pc, b)
+    elif op == 'GETTABUP':
+        return _gxf(lua, p, pc, i, True), _kname(lua, p, pc, ops.c(i))
+    elif op == 'GETTABLE':
+        if ops.BITRK is not None:
+            key = _kname(lua, p, pc, ops.c(i))
+        else:
+            key = _rname(lua, p, pc, ops.c(i))
+        return _gxf(lua, p, pc, i, False), key
+    elif op == 'GETI':
+        return 'field', 'integer index'
+    elif op == 'GETFIELD':
+        return _gxf(lua, p, pc, i, False), _kname(lua, p, pc, ops.c(i))
+    elif op == 'GETUPVAL':
+        return 'upvalue', upvalue_name(lua, p, ops.b(i))
+    elif op in ('LOADK', 'LOADKX'):
+        if op == 'LOADK':
+            k = ops.bx(i)
+        else:
+            k = ops.ax(p.code[pc + 1])
+        if (s := _kstring(lua, p, k)) is not None:
+            return 'constant', s
+    elif op == 'SELF':
+        c = ops.c(i)
+        if ops.BITRK is None and not ops.k(i):
+            return 'method', _rname(lua, p, pc, c)
+        return 'method', _kname(lua, p, pc, c)
+    return None
+
+def funcname_from_code(lua: 'lua.Lua', p: Proto, pc: int) \
+    -> typing.Optional[Name] \
+:
+    'Kind and name of the function called by instruction `pc` of `p`.'
+    if not 0 <= pc < len(p.code):
+        return None
+    ops = lua.opcodes
+    i = p.code[pc]
+    op = ops.name(i)
+    if op in ('CALL', 'TAILCALL'):
+        return getobjname(lua, p, pc, ops.a(i))
+    if op == 'TFORCALL':
+        return 'for iterator', 'for iterator'
+    if op in ops.MM:
+        c = ops.c(i)
+        event = ops.TM_NAMES[c] if c < len(ops.TM_NAMES) else None
+    else:
+        event = ops.METAMETHODS.get(op)
+    if event is None:
+        return None
+    return 'metamethod', ops.TM_PREFIX + event
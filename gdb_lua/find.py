@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+'''\
+Inverted indexes of the values in a Lua heap.
+
+The collector lists are walked once per stop and only fixed-size integers are
+kept: a hash of the contents of each string, and the objects referenced by
+table keys, table values and userdata metatable names, each as parallel arrays
+sorted by the referenced address.  Strings are looked up by hash and then
+compared with their actual contents, so that no contents need to be kept.\
+'''
+import array
+import bisect
+import typing
+
+import gdb
+
+from . import cache
+from . import heap
+from . import memory
+from . import printing
+from . import types
+
+if typing.TYPE_CHECKING:
+    from . import lua
+
+# Only a prefix of each string is hashed, along with its length, to bound the
+# memory read while building the index.
+HASH_PREFIX = 256
+DEFAULT_LIMIT = 20
+NAME = b'__name'
+
+def _hash(n: int, prefix: bytes) -> int:
+    return hash((n, prefix))
+
+class Edges(object):
+    '''\
+References to objects, sorted by the address of the referenced object.
+
+Each entry is the referenced address, the referrer and the position of the
+reference in it: the 1-based index in the array part of a table, or `-(j + 1)`
+for node `j` of the hash part.\
+'''
+    __slots__ = ('dst', 'src', 'slot')
+
+    def __init__(self):
+        self.dst, self.src = array.array('Q'), array.array('Q')
+        self.slot = array.array('q')
+
+    def add(self, dst: int, src: int, slot: int):
+        self.dst.append(dst)
+        self.src.append(src)
+        self.slot.append(slot)
+
+    def sort(self):
+        dst, src, slot = self.dst, self.src, self.slot
+        order = sorted(range(len(dst)), key=dst.__getitem__)
+        self.dst = array.array('Q', (dst[i] for i in order))
+        self.src = array.array('Q', (src[i] for i in order))
+        self.slot = array.array('q', (slot[i] for i in order))
+
+    def get(self, addr: int) -> typing.Iterator[tuple[int, int]]:
+        'Referrers of the object at `addr` and the position in each.'
+        dst = self.dst
+        i = bisect.bisect_left(dst, addr)
+        j = bisect.bisect_right(dst, addr, i)
+        src, slot = self.src, self.slot
+        for k in range(i, j):
+            yield src[k], slot[k]
+
+class Index(object):
+    'String, table slot and userdata name indexes of a Lua state.'
+    def __init__(self, lua: 'lua.Lua', L: types.LuaState):
+        r = memory.BlockReader()
+        g = heap.global_state(lua, L)
+        self.hashes, self.strings = array.array('q'), array.array('Q')
+        self.values, self.keys, self.names = Edges(), Edges(), Edges()
+        # Name of each metatable seen, or zero.
+        names: dict[int, int] = {}
+        for addr, tt in heap.iter_objects(lua, r, g):
+            t = tt & types.TTYPE_MASK
+            if t == types.LUA_TSTRING:
+                self.hashes.append(_string_hash(lua, r, addr))
+                self.strings.append(addr)
+            elif t == types.LUA_TTABLE:
+                self._add_table(lua, r, addr)
+            elif t == types.LUA_TUSERDATA:
+                mt = r.unpack(lua.layout.udata, addr)[1]
+                if not mt:
+                    continue
+                name = names.get(mt)
+                if name is None:
+                    name = names[mt] = _metatable_name(lua, r, mt)
+                if name:
+                    self.names.add(name, addr, 0)
+        hashes, strings = self.hashes, self.strings
+        order = sorted(range(len(hashes)), key=hashes.__getitem__)
+        self.hashes = array.array('q', (hashes[i] for i in order))
+        self.strings = array.array('Q', (strings[i] for i in order))
+        for x in (self.values, self.keys, self.names):
+            x.sort()
+
+    def _add_table(self, lua: 'lua.Lua', r: memory.BlockReader, addr: int):
+        l = lua.layout
+        pointer, values, keys = l.pointer, self.values, self.keys
+        flags, lsizenode, asize, array_, node, _, _ = r.unpack(l.table, addr)
+        asize = lua.array_size(asize, flags)
+        for i, (tt, bits) in enumerate(r.iter_unpack(l.tvalue, array_, asize)):
+            if _is_pointer(tt):
+                values.add(pointer(bits), addr, i + 1)
+        nodes = r.iter_unpack(l.node, node, 1 << lsizenode)
+        for j, (tt, bits, ktt, kbits) in enumerate(nodes):
+            if tt & types.TTYPE_MASK == types.LUA_TNIL:
+                continue
+            if _is_pointer(tt):
+                values.add(pointer(bits), addr, -(j + 1))
+            if _is_pointer(ktt):
+                keys.add(pointer(kbits), addr, -(j + 1))
+
+    def find_strings(self, lua: 'lua.Lua', s: bytes) -> list[int]:
+        'Addresses of every string with contents `s`.'
+        h = _hash(len(s), s[:HASH_PREFIX])
+        hashes, strings = self.hashes, self.strings
+        i = bisect.bisect_left(hashes, h)
+        j = bisect.bisect_right(hashes, h, i)
+        return [
+            strings[k] for k in range(i, j)
+            if lua.read_string(strings[k]) == s]
+
+def _is_pointer(tt: int) -> bool:
+    return bool(tt & types.BIT_ISCOLLECTABLE) \
+        or tt & types.TTYPE_MASK == types.LUA_TLIGHTUSERDATA
+
+def _string_hash(lua: 'lua.Lua', r: memory.BlockReader, addr: int) -> int:
+    l = lua.layout
+    tt, shrlen, lnglen = r.unpack(l.tstring, addr)
+    n = lnglen if tt == types.LUA_VLNGSTR else shrlen
+    m = min(n, HASH_PREFIX)
+    return _hash(n, r.read(addr + l.tstring_contents, m) if m else b'')
+
+def _metatable_name(lua: 'lua.Lua', r: memory.BlockReader, mt: int) -> int:
+    'Address of the `__name` string of a metatable (see `luaL_newmetatable`).'
+    l = lua.layout
+    _, lsizenode, _, _, node, _, _ = r.unpack(l.table, mt)
+    for tt, bits, ktt, kbits in r.iter_unpack(l.node, node, 1 << lsizenode):
+        if tt & types.TTYPE_MASK != types.LUA_TSTRING \
+                or ktt & types.TTYPE_MASK != types.LUA_TSTRING:
+            continue
+        if lua.read_string(l.pointer(kbits)) == NAME:
+            return l.pointer(bits)
+    return 0
+
+def index(lua: 'lua.Lua', L: types.LuaState) -> Index:
+    'Value index of a Lua state, built once until the inferior resumes.'
+    g = int(L.v['l_G'])
+    return cache.INDEXES.get('find', g, lambda: Index(lua, L))
+
+def _slot(lua: 'lua.Lua', r: memory.BlockReader, t: int, slot: int) -> str:
+    'Label of a table slot: `[i]` or the key of a node, formatted.'
+    if slot > 0:
+        return f'[{slot}]'
+    l = lua.layout
+    node = r.unpack(l.table, t)[4]
+    _, _, ktt, kbits = r.unpack(l.node, node + (-slot - 1) * l.node.size)
+    return f'[{printing.format_value(lua, types.RawTValue(0, ktt, kbits))}]'
+
+def _write_slots(
+    lua: 'lua.Lua', r: memory.BlockReader,
+    slots: list[tuple[str, int, int]], limit: int,
+):
+    gdb.write(f'{len(slots)} table slots\n')
+    for kind, t, slot in slots[:limit]:
+        gdb.write(f'  {kind} table {t:#x}{_slot(lua, r, t, slot)}\n')
+    if len(slots) > limit:
+        gdb.write(f'  ... ({len(slots) - limit} more)\n')
+
+def _write_objects(addrs: list[int], kind: str, limit: int):
+    gdb.write(f'{len(addrs)} {kind}\n')
+    for x in addrs[:limit]:
+        gdb.write(f'  {x:#x}\n')
+    if len(addrs) > limit:
+        gdb.write(f'  ... ({len(addrs) - limit} more)\n')
+
+def find(
+    lua: 'lua.Lua', L: types.LuaState, *,
+    string: typing.Optional[str]=None, key: typing.Optional[str]=None,
+    udata_name: typing.Optional[str]=None,
+    pointer: typing.Optional[int]=None,
+    limit: int=DEFAULT_LIMIT,
+):
+    '''\
+Prints the table slots which contain a string (as a value or a key) or a
+pointer, or the userdata with a given metatable name.\
+'''
+    idx = index(lua, L)
+    r = memory.BlockReader()
+    slots: list[tuple[str, int, int]] = []
+    text = string if key is None else key
+    if text is not None:
+        s = text.encode()
+        addrs = idx.find_strings(lua, s)
+        _write_objects(addrs, f'strings equal to {printing.quote(s)}', limit)
+        edges = idx.values if key is None else idx.keys
+        kind = 'value in' if key is None else 'key in'
+        for x in addrs:
+            slots.extend((kind, t, i) for t, i in edges.get(x))
+        _write_slots(lua, r, slots, limit)
+    elif udata_name is not None:
+        s = udata_name.encode()
+        addrs = [
+            u for x in idx.find_strings(lua, s)
+            for u, _ in idx.names.get(x)]
+        _write_objects(addrs, f'userdata named {printing.quote(s)}', limit)
+    elif pointer is not None:
+        slots.extend(('value in', t, i) for t, i in idx.values.get(pointer))
+        slots.extend(('key in', t, i) for t, i in idx.keys.get(pointer))
+        _write_slots(lua, r, slots, limit)
+    else:
+        raise Exception(
+            'usage: lua find --string S|--key K|--udata-name N|--pointer P')
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+'''\
+State of the garbage collector, see `lgc.c`.
+
+The report decodes the collector fields of `global_State`.  In generational
+mode (5.4), the `allgc` and `finobj` lists are ordered by age and split by the
+pointers to their first survival, old1 and old objects, so each segment is
+walked to count its objects and bytes.
+
+Collection steps can also be sampled: breakpoints on the entry and return
+instructions of `luaC_step` record each step without stopping the inferior,
+which runs for a given time window.\
+'''
+import collections
+import threading
+import time
+import typing
+
+import gdb
+
+from . import allocprof
+from . import heap
+from . import memory
+from . import profile
+from . import types
+
+if typing.TYPE_CHECKING:
+    from . import lua
+
+STEP_FUNCTION = 'luaC_step'
+DEFAULT_DURATION = 10.0
+SEGMENTS = ('new', 'survival', 'old1', 'old')
+# Names of the age bits of `marked`, see `G_NEW` in `lgc.h`.
+AGES = ('new', 'survival', 'old0', 'old1', 'old', 'touched1', 'touched2')
+AGE_MASK = 7
+KGC_GEN = 1
+# Instruction prefixes which may precede a return, e.g. `rep ret` (GCC).
+PREFIXES = frozenset(('rep', 'repz', 'repe', 'bnd', 'notrack'))
+
+def _field(g: gdb.Value, name: str) -> typing.Optional[int]:
+    if not any(f.name == name for f in g.type.strip_typedefs().fields()):
+        return None
+    return int(g[name])
+
+def _name(names: tuple[str, ...], i: int) -> str:
+    return names[i] if 0 <= i < len(names) else str(i)
+
+class Generation(object):
+    __slots__ = ('count', 'size')
+
+    def __init__(self):
+        self.count = 0
+        self.size = 0
+
+def generations(lua: 'lua.Lua', g: gdb.Value) -> tuple[
+    dict[str, Generation], dict[str, Generation],
+]:
+    '''\
+Objects and bytes in each segment of the lists split by age and, separately,
+by the age bits of each object.\
+'''
+    r = memory.BlockReader()
+    s, sizes = lua.layout.gcobject, heap.sizers(lua)
+    segments = {k: Generation() for k in SEGMENTS}
+    ages: dict[str, Generation] = collections.defaultdict(Generation)
+    for name, bounds in lua.GC_AGES or ():
+        bounds_addr = [int(g[x]) for x in bounds]
+        p, i = int(g[name]), 0
+        while p:
+            while i < len(bounds_addr) and p == bounds_addr[i]:
+                i += 1
+            n, tt, marked = r.unpack(s, p)
+            f = sizes.get(tt & types.TTYPE_MASK)
+            size = f(lua, r, p, tt) if f else 0
+            age = ages[_name(AGES, marked & AGE_MASK)]
+            for x in (segments[SEGMENTS[i]], age):
+                x.count += 1
+                x.size += size
+            p = n
+    return segments, ages
+
+def dump(lua: 'lua.Lua', L: types.LuaState):
+    g = L.v['l_G'].dereference()
+    state, kind = int(g['gcstate']), int(g['gckind'])
+    total, debt = int(g['totalbytes']), int(g['GCdebt'])
+    gdb.write(
+        f'kind: {_name(lua.GC_KINDS, kind)}\n'
+        f'state: {_name(lua.GC_STATES, state)}\n')
+    running = _field(g, 'gcrunning')
+    if running is None:
+        # 5.4.4 replaced `gcrunning` with the reasons it is stopped.
+        running = _field(g, 'gcstp')
+        running = None if running is None else not running
+    if running is not None:
+        gdb.write(f'running: {"yes" if running else "no"}\n')
+    gdb.write(
+        f'bytes in use: {total + debt} (totalbytes {total}, GCdebt {debt})\n'
+        f'estimate: {int(g["GCestimate"])}\n')
+    if (x := _field(g, 'lastatomic')) is not None and x:
+        gdb.write(f'lastatomic: {x}\n')
+    for name, factor in lua.GC_PARAMS:
+        if (x := _field(g, name)) is not None:
+            gdb.write(f'{name}: {x * factor}\n')
+    if lua.GC_AGES is None or kind != KGC_GEN:
+        return
+    segments, ages = generations(lua, g)
+    gdb.write(f'\n{"generation":<12}{"count":>12}{"bytes":>16}\n')
+    for k, v in segments.items():
+        gdb.write(f'{k:<12}{v.count:>12}{v.size:>16}\n')
+    gdb.write(f'\n{"age bits":<12}{"count":>12}{"bytes":>16}\n')
+    for k in AGES:
+        if (age := ages.get(k)) is not None:
+            gdb.write(f'{k:<12}{age.count:>12}{age.size:>16}\n')
+
+def _is_return(asm: str) -> bool:
+    for x in asm.split():
+        if x not in PREFIXES:
+            return x.startswith('ret')
+    return False
+
+class StepSampler(object):
+    '''\
+Durations of the calls to `luaC_step`, by collector state at entry.
+
+Durations are measured between the breakpoints, so they include the cost of
+hitting them.  Steps which leave the function other than through a return
+instruction (e.g. a tail call or an error) are not matched.\
+'''
+    def __init__(self, lua: 'lua.Lua', g: int):
+        s = lua.objfile.lookup_global_symbol(STEP_FUNCTION) \
+            or lua.objfile.lookup_static_symbol(STEP_FUNCTION)
+        if s is None:
+            raise Exception(f'function not found: {STEP_FUNCTION}')
+        arch = gdb.selected_frame().architecture()
+        start, end = allocprof.function_range(s)
+        returns = [
+            x['addr'] for x in arch.disassemble(start, end - 1)
+            if _is_return(x['asm'])]
+        if not returns:
+            raise Exception(f'no return instructions in {STEP_FUNCTION}')
+        self.lua = lua
+        self.g = g
+        self.count: collections.Counter = collections.Counter()
+        self.seconds: collections.Counter = collections.Counter()
+        self.longest = 0.0
+        self.unmatched = 0
+        self.pending: dict[int, tuple[float, str]] = {}
+        self.breakpoints = [allocprof.Hook(start, self._enter)]
+        self.breakpoints.extend(
+            allocprof.Hook(x, self._return) for x in returns)
+
+    def stop(self):
+        for x in self.breakpoints:
+            x.delete()
+        self.breakpoints.clear()
+
+    def _enter(self):
+        state, _ = types.read_struct(
+            self.lua.layout.global_state_gc, self.g)
+        key = gdb.selected_thread().global_num
+        if key in self.pending:
+            self.unmatched += 1
+        name = _name(self.lua.GC_STATES, state)
+        self.count[name] += 1
+        self.pending[key] = time.perf_counter(), name
+
+    def _return(self):
+        p = self.pending.pop(gdb.selected_thread().global_num, None)
+        if p is None:
+            return
+        t = time.perf_counter() - p[0]
+        self.seconds[p[1]] += t
+        self.longest = max(self.longest, t)
+
+    def write(self, window: float):
+        n, t = sum(self.count.values()), sum(self.seconds.values())
+        gdb.write(
+            f'{n} steps in {window:.2f}s ({n / window:.1f}/s),'
+            f' {t:.4f}s collecting ({100 * t / window:.1f}%),'
+            f' longest {1000 * self.longest:.3f}ms\n')
+        if self.unmatched:
+            gdb.write(f'{self.unmatched} steps without a matching return\n')
+        gdb.write(f'{"state":<14}{"steps":>10}{"seconds":>12}{"mean ms":>10}\n')
+        for k, c in self.count.most_common():
+            s = self.seconds[k]
+            gdb.write(f'{k:<14}{c:>10}{s:>12.4f}{1000 * s / c:>10.3f}\n')
+
+def sample(lua: 'lua.Lua', L: types.LuaState, duration: float):
+    '''\
+Resumes the inferior for `duration` seconds, recording collection steps.
+
+Sampling stops early if the inferior exits or stops for any other reason.\
+'''
+    inf = gdb.selected_inferior()
+    if not inf.pid:
+        raise Exception('sampling requires a running process')
+    s = StepSampler(lua, int(L.v['l_G']))
+    t = threading.Timer(duration, profile.interrupt, (inf.pid,))
+    start = time.monotonic()
+    try:
+        t.start()
+        gdb.execute('continue', to_string=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        t.cancel()
+        s.stop()
+    s.write(time.monotonic() - start)
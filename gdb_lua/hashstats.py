@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+'''\
+Quality of the hash parts of tables and of the string table.
+
+Node arrays and string buckets are read in bulk and decoded once, so that
+tables with millions of slots can be analyzed.  Collision chains are followed
+through the relative `next` offsets of nodes (`hnext` pointers for strings).\
+'''
+import array
+import collections
+import heapq
+import typing
+
+import gdb
+
+from . import memory
+from . import printing
+from . import types
+
+if typing.TYPE_CHECKING:
+    from . import lua
+
+DEFAULT_TOP = 5
+# Strings printed for each of the longest string table chains.
+CHAIN_STRINGS = 3
+# See `MAXABITS` in `ltable.c`.
+MAXABITS = 31
+
+FREE, LIVE, DEAD = range(3)
+
+def ceillog2(x: int) -> int:
+    return (x - 1).bit_length()
+
+def compute_sizes(nums: typing.Sequence[int], na: int) -> tuple[int, int]:
+    '''\
+Optimal array size and number of integer keys in it, see `computesizes`.
+
+`nums[i]` is the number of integer keys in the range `(2^(i-1), 2^i]`.\
+'''
+    a = na_opt = optimal = 0
+    for i, n in enumerate(nums):
+        twotoi = 1 << i
+        if na <= twotoi // 2:
+            break
+        a += n
+        if a > twotoi // 2:
+            optimal, na_opt = twotoi, a
+    return optimal, na_opt
+
+class TableStats(typing.NamedTuple):
+    asize: int
+    array_used: int
+    sizenode: int
+    live: int
+    dead: int
+    # Number of chains of each length, in nodes.
+    chains: collections.Counter
+    # Sum of the position of each live key in its chain.
+    probes: int
+    # Sizes of the array and hash parts after a rehash.
+    rehash: tuple[int, int]
+
+def _chains(
+    state: bytearray, nxt: array.array, pred: bytearray,
+) -> tuple[collections.Counter, int]:
+    chains: collections.Counter = collections.Counter()
+    probes, n = 0, len(state)
+    for head in range(n):
+        if state[head] == FREE or pred[head]:
+            continue
+        i, length = head, 0
+        while True:
+            length += 1
+            if state[i] == LIVE:
+                probes += length
+            d = nxt[i]
+            if not d or length >= n or not 0 <= i + d < n:
+                break
+            i += d
+        chains[length] += 1
+    return chains, probes
+
+def table_stats(lua: 'lua.Lua', addr: int) -> TableStats:
+    l = lua.layout
+    flags, lsizenode, asize, arr, node, _, lastfree = \
+        types.read_struct(l.table, addr)
+    asize = lua.array_size(asize, flags)
+    # `nums[i]`: integer keys in `(2^(i-1), 2^i]`, see `numusearray`.
+    nums = [0] * (MAXABITS + 1)
+    array_used = 0
+    for i, (tt, _) in enumerate(types.read_array(l.tvalue, arr, asize), 1):
+        if tt & types.TTYPE_MASK != types.LUA_TNIL:
+            array_used += 1
+            nums[ceillog2(i)] += 1
+    # The shared dummy node (no `lastfree`) is not a hash part.
+    n = (1 << lsizenode) if lastfree else 0
+    state = bytearray(n)
+    pred = bytearray(n)
+    nxt = array.array('i', (0,)) * n
+    live = dead = na = 0
+    integer = l.integer
+    for i, (tt, ktt, kbits, d) in enumerate(
+        types.read_array(l.node_chain, node, n)
+    ):
+        if d:
+            nxt[i] = d
+            if 0 <= i + d < n:
+                pred[i + d] = 1
+        if tt & types.TTYPE_MASK != types.LUA_TNIL:
+            state[i] = LIVE
+            live += 1
+            if ktt & types.TTYPE_MASK == types.LUA_TNUMBER \
+                    and lua.isinteger(types.RawTypeTag(ktt)):
+                k = integer(kbits)
+                if 0 < k <= 1 << MAXABITS:
+                    nums[ceillog2(k)] += 1
+                    na += 1
+        elif ktt & types.TTYPE_MASK != types.LUA_TNIL:
+            # Removed keys (dead or not yet collected) stay in their chains.
+            state[i] = DEAD
+            dead += 1
+    chains, probes = _chains(state, nxt, pred)
+    new_asize, new_na = compute_sizes(nums, array_used + na)
+    nhash = array_used + live - new_na
+    rehash = new_asize, (1 << ceillog2(nhash)) if nhash else 0
+    return TableStats(
+        asize, array_used, n, live, dead, chains, probes, rehash)
+
+def _write_chains(chains: collections.Counter):
+    gdb.write('chain lengths:\n')
+    for length, count in sorted(chains.items()):
+        gdb.write(f'{length:>8}: {count}\n')
+
+def dump_table(lua: 'lua.Lua', addr: int):
+    s = table_stats(lua, addr)
+    gdb.write(
+        f'table {addr:#x}\n'
+        f'array: {s.asize} slots, {s.array_used} used\n'
+        f'hash: {s.sizenode} nodes, {s.live} live keys, {s.dead} dead keys,'
+        f' {s.sizenode - s.live - s.dead} free\n')
+    if s.sizenode:
+        chains = sum(s.chains.values())
+        gdb.write(
+            f'load factor: {s.live / s.sizenode:.2f}\n'
+            f'chains: {chains}, longest {max(s.chains, default=0)} nodes\n')
+        if s.live:
+            gdb.write(f'average lookup: {s.probes / s.live:.2f} nodes\n')
+        _write_chains(s.chains)
+    asize, sizenode = s.rehash
+    gdb.write(f'after a rehash: array {asize} slots, hash {sizenode} nodes\n')
+
+def dump_strings(lua: 'lua.Lua', L: types.LuaState, top: int=DEFAULT_TOP):
+    'Prints the occupancy of the buckets of the short string table.'
+    l = lua.layout
+    buckets, nuse, size = \
+        types.read_struct(l.stringtable, int(L.v['l_G']))
+    r = memory.BlockReader()
+    chains: collections.Counter = collections.Counter()
+    longest: list[tuple[int, int, int]] = []
+    for i, (p,) in enumerate(types.read_array(l.pointers, buckets, size)):
+        first, length = p, 0
+        while p and length <= nuse:
+            length += 1
+            _, _, p = r.unpack(l.tstring, p)
+        chains[length] += 1
+        if length:
+            x = (length, -i, first)
+            if len(longest) < top:
+                heapq.heappush(longest, x)
+            elif x > longest[0]:
+                heapq.heapreplace(longest, x)
+    used = size - chains[0]
+    gdb.write(
+        f'strings: {nuse} in {size} buckets, load factor {nuse / size:.2f}\n'
+        f'buckets: {used} used, {chains[0]} empty\n')
+    del chains[0]
+    _write_chains(chains)
+    if longest:
+        gdb.write('longest chains:\n')
+    for length, i, p in sorted(longest, reverse=True):
+        shown = []
+        for _ in range(CHAIN_STRINGS):
+            if not p:
+                break
+            shown.append(printing.quote(lua.read_string(p)))
+            _, _, p = r.unpack(l.tstring, p)
+        more = ', ...' if length > len(shown) else ''
+        gdb.write(f'  [{-i}] {length}: {", ".join(shown)}{more}\n')
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+import collections
+import heapq
+import typing
+
+import gdb
+
+from . import memory
+from . import printing
+from . import snapshot
+from . import types
+
+if typing.TYPE_CHECKING:
+    from . import lua
+
+GC_LISTS = ('allgc', 'finobj', 'tobefnz', 'fixedgc')
+TOP_KINDS = ('table', 'string', 'userdata')
+EXTRA_STACK = 5
+STRING_PREVIEW = 40
+
+Sizer = typing.Callable[
+    ['lua.Lua', memory.BlockReader, int, int], int]
+
+def global_state(lua: 'lua.Lua', L: types.LuaState) -> dict[str, int]:
+    return types.read_fields(lua.layout.global_state, int(L.v['l_G']))
+
+def iter_gc(
+    lua: 'lua.Lua',
+    r: memory.BlockReader,
+    g: dict[str, int],
+    lists: typing.Sequence[str]=GC_LISTS,
+) -> typing.Iterator[tuple[int, int]]:
+    'Yields the address and raw type tag of each object in the GC lists.'
+    s = lua.layout.gcobject
+    unpack = r.unpack
+    for name in lists:
+        p = g[name]
+        while p:
+            n, tt, _ = unpack(s, p)
+            yield p, tt
+            p = n
+
+def iter_objects(
+    lua: 'lua.Lua', r: memory.BlockReader, g: dict[str, int],
+) -> typing.Iterator[tuple[int, int]]:
+    '''\
+Yields the address and raw type tag of every object in the state.
+
+The main thread is allocated along with the global state and is not in any of
+the collector lists.\
+'''
+    if g['mainthread']:
+        yield g['mainthread'], types.LUA_TTHREAD
+    yield from iter_gc(lua, r, g)
+
+def kind_names(lua: 'lua.Lua') -> dict[int, str]:
+    'Names of every collectable type, indexed by type tag.'
+    ret = dict(enumerate(types.TYPE_NAMES))
+    if lua.TUPVAL is not None:
+        ret[lua.TUPVAL] = 'upvalue'
+    ret[lua.TPROTO] = 'proto'
+    return ret
+
+def _string_size(lua: 'lua.Lua', r, addr: int, tt: int) -> int:
+    l = lua.layout
+    _, shrlen, lnglen = r.unpack(l.tstring, addr)
+    n = lnglen if tt == types.LUA_VLNGSTR else shrlen
+    return l.tstring_contents + n + 1
+
+def _table_size(lua: 'lua.Lua', r, addr: int, _tt: int) -> int:
+    l, sizes = lua.layout, lua.layout.sizes
+    flags, lsizenode, asize, _, _, _, lastfree = r.unpack(l.table, addr)
+    ret = sizes['table'] + lua.array_size(asize, flags) * sizes['tvalue']
+    # The shared dummy node (no `lastfree`) is not owned by the table.
+    if lastfree:
+        ret += (1 << lsizenode) * sizes['node']
+    return ret
+
+def _function_size(lua: 'lua.Lua', r, addr: int, tt: int) -> int:
+    l, sizes = lua.layout, lua.layout.sizes
+    if tt == types.LUA_VCCL:
+        n, _ = r.unpack(l.cclosure, addr)
+        return l.cclosure_upvalue + n * sizes['tvalue']
+    n, _ = r.unpack(l.lclosure, addr)
+    return l.lclosure_upvals + n * sizes['pointer']
+
+def _userdata_size(lua: 'lua.Lua', r, addr: int, _tt: int) -> int:
+    l = lua.layout
+    u = r.unpack(l.udata, addr)
+    nuv = u[2] if len(u) > 2 else 0
+    return l.udata_uv + nuv * l.sizes['uvalue'] + u[0]
+
+def _thread_size(lua: 'lua.Lua', r, addr: int, _tt: int) -> int:
+    sizes = lua.layout.sizes
+    _, nci, _, _, _, stack_last, stack, _ = r.unpack(lua.layout.lua_state, addr)
+    n = (stack_last - stack) // sizes['stack'] + EXTRA_STACK if stack else 0
+    return sizes['thread'] + n * sizes['stack'] + nci * sizes['callinfo']
+
+def _upvalue_size(lua: 'lua.Lua', _r, _addr: int, _tt: int) -> int:
+    return lua.layout.sizes['upval']
+
+def _proto_size(lua: 'lua.Lua', r, addr: int, _tt: int) -> int:
+    s, sizes = lua.layout.proto, lua.layout.sizes
+    p = dict(zip(s.names, r.unpack(s, addr)))
+    return (
+        sizes['proto']
+        + p['sizecode'] * sizes['instruction']
+        + p['sizek'] * sizes['tvalue']
+        + p['sizep'] * sizes['pointer']
+        + p['sizelineinfo'] * sizes['lineinfo']
+        + p.get('sizeabslineinfo', 0) * sizes['abslineinfo']
+        + p['sizelocvars'] * sizes['locvar']
+        + p['sizeupvalues'] * sizes['upvaldesc'])
+
+def sizers(lua: 'lua.Lua') -> dict[int, Sizer]:
+    'Functions which estimate the size of each collectable type.'
+    ret: dict[int, Sizer] = {
+        types.LUA_TSTRING: _string_size,
+        types.LUA_TTABLE: _table_size,
+        types.LUA_TFUNCTION: _function_size,
+        types.LUA_TUSERDATA: _userdata_size,
+        types.LUA_TTHREAD: _thread_size,
+        lua.TPROTO: _proto_size,
+    }
+    if lua.TUPVAL is not None:
+        ret[lua.TUPVAL] = _upvalue_size
+    return ret
+
+class Census(object):
+    'Streaming aggregation of object counts and sizes per type.'
+    def __init__(self, top: int):
+        self.count: collections.Counter = collections.Counter()
+        self.size: collections.Counter = collections.Counter()
+        self.top_n = top
+        self.top: dict[str, list[tuple[int, int]]] = {k: [] for k in TOP_KINDS}
+
+    def add(self, kind: str, addr: int, size: int):
+        self.count[kind] += 1
+        self.size[kind] += size
+        h = self.top.get(kind)
+        if h is None or not self.top_n:
+            return
+        if len(h) < self.top_n:
+            heapq.heappush(h, (size, addr))
+        elif h[0][0] < size:
+            heapq.heapreplace(h, (size, addr))
+
+def census(lua: 'lua.Lua', L: types.LuaState, top: int) -> Census:
+    r = memory.BlockReader()
+    names, sizes = kind_names(lua), sizers(lua)
+    ret = Census(top)
+    for addr, tt in iter_objects(lua, r, global_state(lua, L)):
+        t = tt & types.TTYPE_MASK
+        f = sizes.get(t)
+        ret.add(names.get(t, 'unknown'), addr, f(lua, r, addr, tt) if f else 0)
+    return ret
+
+def _describe(lua: 'lua.Lua', kind: str, addr: int) -> str:
+    if kind == 'table':
+        return printing.table_summary(lua, addr, False)
+    if kind == 'string':
+        s = lua.read_string(addr)
+        if len(s) <= STRING_PREVIEW:
+            return printing.quote(s)
+        return printing.quote(s[:STRING_PREVIEW]) + '...'
+    return ''
+
+def dump(lua: 'lua.Lua', L: types.LuaState, top: int=10):
+    c = census(lua, L, top)
+    gdb.write(f'{"type":<14}{"count":>14}{"bytes":>16}\n')
+    for kind, size in c.size.most_common():
+        gdb.write(f'{kind:<14}{c.count[kind]:>14}{size:>16}\n')
+    gdb.write(
+        f'{"total":<14}{sum(c.count.values()):>14}'
+        f'{sum(c.size.values()):>16}\n')
+    for kind in TOP_KINDS:
+        h = c.top[kind]
+        if not h:
+            continue
+        gdb.write(f'\nlargest {kind} objects:\n')
+        for size, addr in sorted(h, reverse=True):
+            gdb.write(f'  {addr:#x} {size} {_describe(lua, kind, addr)}\n')
+
+KEY_LABEL_MAX = 64
+
+Refs = typing.Iterator[tuple[int, str]]
+RefsFn = typing.Callable[
+    ['lua.Lua', memory.BlockReader, int, int], Refs]
+
+def _key_label(lua: 'lua.Lua', tt: int, bits: int) -> str:
+    'Label for an edge through a hash key: strings as-is, others in brackets.'
+    t = tt & types.TTYPE_MASK
+    if t == types.LUA_TSTRING:
+        s = lua.read_string(lua.layout.pointer(bits))[:KEY_LABEL_MAX]
+        return s.decode(errors='replace')
+    if t in (types.LUA_TBOOLEAN, types.LUA_TNUMBER):
+        return f'[{printing.format_value(lua, types.RawTValue(0, tt, bits))}]'
+    return f'[{types.TYPE_NAMES[t] if t < len(types.TYPE_NAMES) else t}]'
+
+def _values(
+    lua: 'lua.Lua', it: typing.Iterable[tuple], label: str, start: int=0,
+) -> Refs:
+    'References from a sequence of `(tt, bits)` values.'
+    pointer = lua.layout.pointer
+    for i, (tt, bits) in enumerate(it, start):
+        if tt & types.BIT_ISCOLLECTABLE:
+            yield pointer(bits), f'{label}[{i}]'
+
+def _table_refs(lua: 'lua.Lua', r, addr: int, _tt: int) -> Refs:
+    l = lua.layout
+    flags, lsizenode, asize, array, node, mt, _ = r.unpack(l.table, addr)
+    if mt:
+        yield mt, 'metatable'
+    asize = lua.array_size(asize, flags)
+    yield from _values(lua, r.iter_unpack(l.tvalue, array, asize), '', 1)
+    pointer = l.pointer
+    for tt, bits, ktt, kbits in r.iter_unpack(l.node, node, 1 << lsizenode):
+        if tt & types.TTYPE_MASK == types.LUA_TNIL:
+            continue
+        if ktt & types.BIT_ISCOLLECTABLE:
+            yield pointer(kbits), '(key)'
+        if tt & types.BIT_ISCOLLECTABLE:
+            yield pointer(bits), _key_label(lua, ktt, kbits)
+
+def _upvalue_value(lua: 'lua.Lua', r, uv: int) -> typing.Optional[int]:
+    'Collectable value referenced by an `UpVal`, if any.'
+    l = lua.layout
+    v, = r.unpack(l.upval, uv)
+    if not v:
+        return None
+    tt, bits = r.unpack(l.tvalue, v)
+    return l.pointer(bits) if tt & types.BIT_ISCOLLECTABLE else None
+
+def _function_refs(lua: 'lua.Lua', r, addr: int, tt: int) -> Refs:
+    l = lua.layout
+    if tt == types.LUA_VCCL:
+        n, _ = r.unpack(l.cclosure, addr)
+        yield from _values(
+            lua, r.iter_unpack(l.tvalue, addr + l.cclosure_upvalue, n),
+            'upvalue')
+        return
+    n, p = r.unpack(l.lclosure, addr)
+    if p:
+        yield p, 'proto'
+    upvals = r.iter_unpack(l.pointers, addr + l.lclosure_upvals, n)
+    for i, (uv,) in enumerate(upvals):
+        if not uv:
+            continue
+        # Up-values are only collectable objects themselves in 5.4.
+        if lua.TUPVAL is not None:
+            yield uv, f'upvalue[{i}]'
+        elif (v := _upvalue_value(lua, r, uv)) is not None:
+            yield v, f'upvalue[{i}]'
+
+def _userdata_refs(lua: 'lua.Lua', r, addr: int, _tt: int) -> Refs:
+    l = lua.layout
+    u = r.unpack(l.udata, addr)
+    if u[1]:
+        yield u[1], 'metatable'
+    if l.uvalue is None:
+        yield from _values(lua, (r.unpack(l.udata_user, addr),), 'user')
+        return
+    yield from _values(
+        lua, r.iter_unpack(l.uvalue, addr + l.udata_uv, u[2]), 'user')
+
+def _thread_refs(lua: 'lua.Lua', r, addr: int, _tt: int) -> Refs:
+    l = lua.layout
+    _, _, top, _, _, _, stack, _ = r.unpack(l.lua_state, addr)
+    if not stack:
+        return
+    s = l.stack_value
+    yield from _values(
+        lua, r.iter_unpack(s, stack, (top - stack) // s.size), 'stack')
+
+def _upvalue_refs(lua: 'lua.Lua', r, addr: int, _tt: int) -> Refs:
+    if (v := _upvalue_value(lua, r, addr)) is not None:
+        yield v, 'value'
+
+def _proto_refs(lua: 'lua.Lua', r, addr: int, _tt: int) -> Refs:
+    l = lua.layout
+    p = dict(zip(l.proto.names, r.unpack(l.proto, addr)))
+    if p['source']:
+        yield p['source'], 'source'
+    yield from _values(lua, r.iter_unpack(l.tvalue, p['k'], p['sizek']), 'k')
+    protos = r.iter_unpack(l.pointers, p['p'], p['sizep'])
+    for i, (x,) in enumerate(protos):
+        if x:
+            yield x, f'p[{i}]'
+
+def _no_refs(*_) -> Refs:
+    return iter(())
+
+def ref_functions(lua: 'lua.Lua') -> dict[int, RefsFn]:
+    'Functions which list the outgoing references of each collectable type.'
+    ret: dict[int, RefsFn] = {
+        types.LUA_TSTRING: _no_refs,
+        types.LUA_TTABLE: _table_refs,
+        types.LUA_TFUNCTION: _function_refs,
+        types.LUA_TUSERDATA: _userdata_refs,
+        types.LUA_TTHREAD: _thread_refs,
+        lua.TPROTO: _proto_refs,
+    }
+    if lua.TUPVAL is not None:
+        ret[lua.TUPVAL] = _upvalue_refs
+    return ret
+
+def roots(
+    lua: 'lua.Lua', r: memory.BlockReader, g_addr: int, g: dict[str, int],
+) -> Refs:
+    'Root objects of the state: the registry, main thread and metatables.'
+    l = lua.layout
+    tt, bits = r.unpack(l.tvalue, g_addr + l.global_state_registry)
+    if tt & types.BIT_ISCOLLECTABLE:
+        yield l.pointer(bits), 'registry'
+    if g['mainthread']:
+        yield g['mainthread'], 'mainthread'
+    mt = r.iter_unpack(
+        l.pointers, g_addr + l.global_state_mt, l.global_state_nmt)
+    for i, (x,) in enumerate(mt):
+        if x:
+            yield x, f'mt[{types.TYPE_NAMES[i]}]'
+
+def site(lua: 'lua.Lua', r, addr: int, tt: int) -> typing.Optional[str]:
+    'Source location associated with an object: that of functions and protos.'
+    if tt == types.LUA_VLCL:
+        _, p = r.unpack(lua.layout.lclosure, addr)
+        return types.proto_location(lua, p) if p else None
+    if tt & types.TTYPE_MASK == lua.TPROTO:
+        return types.proto_location(lua, addr)
+    return None
+
+def write_snapshot(lua: 'lua.Lua', L: types.LuaState, path: str):
+    'Appends a record for every object in the state to the file at `path`.'
+    r = memory.BlockReader()
+    g_addr = int(L.v['l_G'])
+    g = types.read_fields(lua.layout.global_state, g_addr)
+    names, sizes, refs = kind_names(lua), sizers(lua), ref_functions(lua)
+    with open(path, 'ab') as f:
+        w = snapshot.Writer(f)
+        for addr, name in roots(lua, r, g_addr, g):
+            w.root(addr, name)
+        for addr, tt in iter_objects(lua, r, g):
+            t = tt & types.TTYPE_MASK
+            size, refs_fn = sizes.get(t), refs.get(t, _no_refs)
+            w.object(
+                addr, names.get(t, 'unknown'),
+                size(lua, r, addr, tt) if size else 0,
+                site(lua, r, addr, tt),
+                refs_fn(lua, r, addr, tt))
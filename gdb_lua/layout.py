@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import os
+import struct
+import typing
+
+import gdb
+
+from . import types
+
+if typing.TYPE_CHECKING:
+    from . import lua
+
+# Saved layouts are invalidated whenever any of these sources change.
+SOURCES = ('layout.py', 'lua.py', 'types.py')
+
+def _suffix(
+    l: 'lua.Lua', t: gdb.Type, field: typing.Optional[str],
+) -> int:
+    'Offset of a trailing data member or, if `None`, of the aligned suffix.'
+    if field is not None:
+        return types.offsetof(t, field)[0]
+    return max(t.sizeof, l.lookup_type('L_Umaxalign').sizeof)
+
+def _has_field(t: gdb.Type, name: str) -> bool:
+    return any(f.name == name for f in t.strip_typedefs().fields())
+
+def _target(t: gdb.Type, field: str) -> gdb.Type:
+    'Type of the objects pointed to by field `field` of `t`.'
+    ft = types.offsetof(t, field)[1].strip_typedefs()
+    if ft.code == gdb.TYPE_CODE_UNION:
+        ft = types.offsetof(ft, 'p')[1].strip_typedefs()
+    return ft.target()
+
+def _target_size(t: gdb.Type, field: str) -> int:
+    return _target(t, field).sizeof
+
+def _stack_type(lua_state: gdb.Type) -> gdb.Type:
+    'Type of stack slots: `TValue` in 5.3, `StackValue` in 5.4.'
+    return _target(lua_state, 'stack')
+
+def _sizeof(l: 'lua.Lua', *names: str) -> int:
+    'Size of the first of `names` which can be found.'
+    for x in names:
+        try:
+            return l.lookup_type(x).sizeof
+        except gdb.error:
+            pass
+    raise types.LuaInitializationFailed(f'types not found: {names}')
+
+class Layout(object):
+    '''\
+Offsets and sizes of the internal structures of a specific Lua version.
+
+Built once by `lua.Lua` from the field names declared by each version
+subclass, so that hot paths can decode raw memory directly instead of going
+through gdb's symbolic lookups.\
+'''
+    def __init__(self, l: 'lua.Lua'):
+        self.order = order = types.byte_order()
+        t = l.lookup_type
+        value = t('Value')
+        self.value_size = value.sizeof
+        self.value_bits = types.uint_struct(order, value.sizeof)
+        self.value_i = types.RawStruct(order, value, 'i', signed=('i',))
+        self.value_n = types.RawStruct(order, value, 'n')
+        gc = types.offsetof(value, 'gc')[1]
+        self.value_gc = None
+        if gc.sizeof != value.sizeof:
+            self.value_gc = types.RawStruct(order, value, 'gc')
+        self.value_b = None
+        if l.VALUE_BOOL is not None:
+            self.value_b = types.RawStruct(order, value, l.VALUE_BOOL)
+        self.tvalue = types.RawStruct(order, t('TValue'), 'tt_', 'value_')
+        self.node = types.RawStruct(
+            order, t('Node'), 'i_val.tt_', 'i_val.value_', *l.NODE_KEY)
+        self.node_chain = types.RawStruct(
+            order, t('Node'), 'i_val.tt_', *l.NODE_KEY, l.NODE_NEXT,
+            signed=(l.NODE_NEXT,))
+        self.gcobject = types.RawStruct(
+            order, t('GCObject'), 'next', 'tt', 'marked')
+        self.table = types.RawStruct(
+            order, t('Table'),
+            'flags', 'lsizenode', l.TABLE_ASIZE, 'array', 'node', 'metatable',
+            'lastfree')
+        tstring = t('TString')
+        self.tstring = types.RawStruct(
+            order, tstring, 'tt', 'shrlen', 'u.lnglen')
+        self.tstring_contents = _suffix(l, tstring, l.TSTRING_CONTENTS)
+        udata = t('Udata')
+        self.udata = types.RawStruct(
+            order, udata, 'len', 'metatable', *l.UDATA_EXTRA)
+        self.udata_uv = _suffix(l, udata, l.UDATA_UV)
+        self.callinfo = types.RawStruct(
+            order, t('CallInfo'),
+            'func', 'previous', 'callstatus', 'u.l.savedpc')
+        proto = t('Proto')
+        self.proto = types.RawStruct(
+            order, proto,
+            'source', 'linedefined', 'lastlinedefined',
+            'numparams', 'is_vararg', 'maxstacksize',
+            'code', 'sizecode', 'k', 'sizek', 'p', 'sizep',
+            'upvalues', 'sizeupvalues', 'lineinfo', 'sizelineinfo',
+            'locvars', 'sizelocvars', *l.PROTO_EXTRA)
+        self.locvar = types.RawStruct(
+            order, _target(proto, 'locvars'), 'varname', 'startpc', 'endpc',
+            signed=('startpc', 'endpc'))
+        self.upvaldesc = types.RawStruct(
+            order, _target(proto, 'upvalues'), 'name')
+        self.upvaldesc_info = types.RawStruct(
+            order, _target(proto, 'upvalues'), 'name', 'instack', 'idx')
+        self.lineinfo = types.int_struct(
+            order, _target_size(proto, 'lineinfo'))
+        self.abslineinfo = None
+        if _has_field(proto, 'abslineinfo'):
+            self.abslineinfo = types.RawStruct(
+                order, _target(proto, 'abslineinfo'), 'pc', 'line',
+                signed=('pc', 'line'))
+        self.instruction = types.uint_struct(
+            order, _target_size(proto, 'code'))
+        self.lclosure = types.RawStruct(
+            order, t('LClosure'), 'nupvalues', 'p')
+        self.lclosure_upvals = types.offsetof(t('LClosure'), 'upvals')[0]
+        self.cclosure = types.RawStruct(
+            order, t('CClosure'), 'nupvalues', 'f')
+        self.cclosure_upvalue = types.offsetof(t('CClosure'), 'upvalue')[0]
+        self.pointers = types.uint_struct(order, t('void').pointer().sizeof)
+        self.upval = types.RawStruct(order, t('UpVal'), 'v')
+        self.upval_next = types.RawStruct(order, t('UpVal'), 'u.open.next')
+        self.uvalue = None
+        if l.UDATA_USER is None:
+            self.uvalue = types.RawStruct(
+                order, t('UValue'), 'uv.tt_', 'uv.value_')
+        else:
+            self.udata_user = types.RawStruct(order, udata, *l.UDATA_USER)
+        global_state = t('global_State')
+        self.global_state = types.RawStruct(
+            order, global_state,
+            'allgc', 'finobj', 'tobefnz', 'fixedgc', 'mainthread', 'twups')
+        self.stringtable = types.RawStruct(
+            order, global_state, 'strt.hash', 'strt.nuse', 'strt.size')
+        self.global_state_gc = types.RawStruct(
+            order, global_state, 'gcstate', 'gckind')
+        self.global_state_registry = \
+            types.offsetof(global_state, 'l_registry')[0]
+        mt_off, mt = types.offsetof(global_state, 'mt')
+        self.global_state_mt = mt_off
+        self.global_state_nmt = mt.sizeof // self.pointers.size
+        lua_state = t('lua_State')
+        self.lua_state = types.RawStruct(
+            order, lua_state,
+            'status', 'nci', 'top', 'l_G', 'ci', 'stack_last', 'stack',
+            'openupval')
+        self.lua_state_base_ci = types.offsetof(lua_state, 'base_ci')[0]
+        self.lua_state_twups = types.RawStruct(order, lua_state, 'twups')
+        stack = _stack_type(lua_state)
+        self.stack_value = types.RawStruct(
+            order, stack,
+            *(('val.tt_', 'val.value_') if _has_field(stack, 'val')
+                else ('tt_', 'value_')))
+        # Element sizes, used to estimate the memory used by each object.
+        self.sizes = {
+            'pointer': t('void').pointer().sizeof,
+            'tvalue': self.tvalue.size,
+            'node': self.node.size,
+            'table': self.table.size,
+            'udata': udata.sizeof,
+            'uvalue': _sizeof(l, 'UValue', 'TValue'),
+            'upval': _sizeof(l, 'UpVal'),
+            'proto': proto.sizeof,
+            'instruction': _target_size(proto, 'code'),
+            'lineinfo': _target_size(proto, 'lineinfo'),
+            'abslineinfo': _sizeof(l, 'AbsLineInfo', 'int'),
+            'locvar': _target_size(proto, 'locvars'),
+            'upvaldesc': _target_size(proto, 'upvalues'),
+            'callinfo': self.callinfo.size,
+            'stack': _target_size(lua_state, 'stack'),
+            'thread': _sizeof(l, 'LX', 'lua_State'),
+        }
+
+    def integer(self, bits: int) -> int:
+        return self.value_i.unpack_from(self.value_bits.pack(bits))[0]
+
+    def number(self, bits: int) -> float:
+        return self.value_n.unpack_from(self.value_bits.pack(bits))[0]
+
+    def pointer(self, bits: int) -> int:
+        if self.value_gc is None:
+            return bits
+        return self.value_gc.unpack_from(self.value_bits.pack(bits))[0]
+
+    def boolean(self, bits: int) -> int:
+        if self.value_b is None:
+            raise Exception('booleans are not stored in values in this version')
+        return self.value_b.unpack_from(self.value_bits.pack(bits))[0]
+
+def _cache_dir() -> str:
+    base = os.environ.get('XDG_CACHE_HOME') \
+        or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'gdb_lua')
+
+def _cache_path(l: 'lua.Lua') -> typing.Optional[str]:
+    '''\
+Path of the saved layout of the current build, `None` if it has no build ID.
+
+Layouts are identified by the build ID of the object file which defines
+`lua_ident`, the version class and the sources which build them.\
+'''
+    build_id = l.objfile.build_id
+    if not build_id:
+        return None
+    h = hashlib.sha1(type(l).__name__.encode())
+    d = os.path.dirname(__file__)
+    for x in SOURCES:
+        with open(os.path.join(d, x), 'rb') as f:
+            h.update(f.read())
+    name = f'{build_id}-{h.hexdigest()[:16]}.json'
+    return os.path.join(_cache_dir(), name)
+
+def _encode(v: typing.Any) -> typing.Any:
+    if v is None or type(v) in (int, str):
+        return v
+    if isinstance(v, types.RawStruct):
+        return {'raw': v.as_dict()}
+    if isinstance(v, struct.Struct):
+        return {'struct': v.format}
+    if isinstance(v, dict):
+        return {'dict': v}
+    raise TypeError(f'cannot save layout value: {v!r}')
+
+def _decode(v: typing.Any) -> typing.Any:
+    'Inverse of `_encode`, raises `ValueError` for anything it cannot produce.'
+    if v is None or type(v) in (int, str):
+        return v
+    if not isinstance(v, dict) or len(v) != 1:
+        raise ValueError(f'invalid layout value: {v!r}')
+    (k, x), = v.items()
+    if k == 'raw':
+        return types.RawStruct.from_dict(x)
+    if k == 'struct' and isinstance(x, str):
+        try:
+            return struct.Struct(x)
+        except struct.error as e:
+            raise ValueError(f'invalid struct: {e}')
+    if k == 'dict' and isinstance(x, dict) \
+            and all(type(y) is int for y in x.values()):
+        return x
+    raise ValueError(f'invalid layout value: {v!r}')
+
+def _from_json(d: typing.Any) -> Layout:
+    'Layout saved as JSON, raises `ValueError` if it is invalid.'
+    if not isinstance(d, dict):
+        raise ValueError('invalid layout')
+    ret = Layout.__new__(Layout)
+    for k, v in d.items():
+        # Only data attributes, never methods or special attributes.
+        if not k.isidentifier() or k.startswith('_') or hasattr(Layout, k):
+            raise ValueError(f'invalid layout attribute: {k}')
+        setattr(ret, k, _decode(v))
+    return ret
+
+def load(l: 'lua.Lua') -> Layout:
+    '''\
+Layout of the current build, saved to the cache directory once built.
+
+Saved layouts let subsequent sessions (e.g. one per core dump of the same
+binary) skip the type lookups.  They are plain JSON (offsets, sizes and
+`struct` formats) and are validated when loaded, so that a file in the cache
+directory cannot do more than provide wrong offsets.\
+'''
+    path = _cache_path(l)
+    if path is not None:
+        try:
+            with open(path) as f:
+                return _from_json(json.load(f))
+        except (OSError, ValueError):
+            pass
+    ret = Layout(l)
+    if path is not None:
+        tmp = f'{path}.{os.getpid()}'
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp, 'w') as f:
+                json.dump({k: _encode(v) for k, v in vars(ret).items()}, f)
+            os.replace(tmp, path)
+        except OSError:
+            pass
+    return ret
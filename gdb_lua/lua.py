@@ -1,24 +1,41 @@
 #!/usr/bin/env python3
+import functools
+import itertools
 import re
 import typing
 
 import gdb
 
+from . import backend
+from . import cache
+from . import debug
+from . import layout
+from . import opcodes
 from . import printing
+from . import records
 from . import types
 
 VERSION_RE = re.compile(r'^"\$LuaVersion: Lua (\d+)\.(\d+)\.(\d+)')
+# Struct tags of `TValue` (`lua_TValue` in 5.3) and of stack slots.
+TVALUE_TAGS = ('TValue', 'lua_TValue', 'StackValue')
+# Table flag set when `alimit` is not the size of the array part (5.4).
+BITRAS = 1 << 7
 
-G: typing.Optional['Lua'] = None
+# Instances by program space, see `lua`.
+INSTANCES: dict[gdb.Progspace, 'Lua'] = {}
 
 def idx_or_none(v: typing.Sequence[typing.Any], i: int):
     return v[i] if (0 <= i and i < len(v)) else None
 
-def _version() -> tuple[int, int, int]:
-    ss, _ = gdb.lookup_symbol('lua_ident')
-    if ss is None:
-        raise types.LuaInitializationFailed('failed to lookup `lua_ident`')
-    s = str(ss.value())
+def _lua_ident(ps: gdb.Progspace) -> gdb.Symbol:
+    for o in ps.objfiles():
+        ret = o.lookup_global_symbol('lua_ident')
+        if ret is not None:
+            return ret
+    raise types.LuaInitializationFailed('failed to lookup `lua_ident`')
+
+def _version(ident: gdb.Symbol) -> tuple[int, int, int]:
+    s = str(ident.value())
     m = VERSION_RE.match(s)
     if m is None:
         raise types.LuaInitializationFailed(
@@ -35,12 +52,6 @@ def _stack(lua: 'Lua', L: types.LuaState) -> types.StkId:
 def _stack_top(lua: 'Lua', L: types.LuaState) -> types.StkId:
     return lua.stkidrel_to_stkid(types.StkIdRel(L.v['top']))
 
-def _iter_stack(lua: 'Lua', L: types.LuaState) -> typing.Iterator[types.StkId]:
-    s, t = _stack(lua, L).v + 1, _stack_top(lua, L).v
-    while s != t:
-        yield types.StkId(s)
-        s += 1
-
 def _stack_idx(lua: 'Lua', L: types.LuaState, i: int) \
     -> typing.Optional[types.StkId] \
 :
@@ -57,30 +68,102 @@ def _iter_call_stack(L: types.LuaState) -> typing.Iterator[types.CallInfo]:
         yield types.CallInfo(p.dereference())
         p = p['previous']
 
-def _getfuncname(
-    lua: 'Lua',
-    L: types.LuaState,
-    i: types.CallInfo,
-    tt: types.RawTypeTag,
-    v: types.TValue,
-) -> typing.Optional[str]:
-    if not types.is_lua_closure(tt):
+def _lua_function(lua: 'Lua', ci: types.CallInfo) \
+    -> typing.Optional[tuple[debug.Proto, int]] \
+:
+    'Prototype and current instruction of a call to a Lua function.'
+    f = lua.stkidrel_to_stkid(types.StkIdRel(ci.v['func']))
+    v = lua.stkid_to_value(f)
+    if int(v.v['tt_']) != types.LUA_VLCL | types.BIT_ISCOLLECTABLE:
         return None
-    ret = types.LClosure(lua, types.tvalue(v)).location(lua)
-    if ret is not None:
-        return ret
-    # TODO funcnamefromcode
-    return None
+    p = debug.proto(lua, int(types.LClosure(lua, types.tvalue(v)).v['p']))
+    return p, debug.current_pc(lua, p, int(ci.v['u']['l']['savedpc']))
+
+def _getfuncname(lua: 'Lua', ci: types.CallInfo) \
+    -> typing.Optional[debug.Name] \
+:
+    'Kind and name of the function of `ci`, from the instruction calling it.'
+    if lua.is_tail(ci.callstatus()):
+        return None
+    prev = ci.v['previous']
+    if not prev:
+        return None
+    caller = _lua_function(lua, types.CallInfo(prev.dereference()))
+    if caller is None:
+        return None
+    return debug.funcname_from_code(lua, *caller)
+
+def _frame_description(lua: 'Lua', ci: types.CallInfo) -> str:
+    'Current line and name of a frame, as in `luaL_traceback`.'
+    ret, f = '', _lua_function(lua, ci)
+    if f is not None:
+        p, pc = f
+        line = debug.current_line(p, pc)
+        ret = f' {p.source}' if line is None else f' {p.source}:{line}'
+    if (name := _getfuncname(lua, ci)) is not None:
+        ret += " in {} '{}'".format(*name)
+    elif f is not None:
+        p = f[0]
+        if p.linedefined == 0:
+            ret += ' in main chunk'
+        else:
+            ret += f' in function <{p.source}:{p.linedefined}>'
+    return ret
 
 class Lua(object):
-    def __init__(self):
-        self.lua_state = gdb.lookup_type('lua_State')
-        self.tvalue = gdb.lookup_type('TValue')
-        gc_union = gdb.lookup_type('union GCUnion')
-        self.gc_union_p = gc_union.pointer()
-        self.int_t = gdb.lookup_type('int')
-        self.void_p = gdb.lookup_type('void').pointer()
-        self.char_p = gdb.lookup_type('char').pointer()
+    # Version-specific field names, see `layout.Layout`.
+    NODE_KEY: tuple[str, ...]
+    NODE_NEXT: str
+    TABLE_ASIZE: str
+    TSTRING_CONTENTS: typing.Optional[str]
+    UDATA_UV: typing.Optional[str]
+    UDATA_EXTRA: tuple[str, ...]
+    UDATA_USER: typing.Optional[tuple[str, str]]
+    VALUE_BOOL: typing.Optional[str]
+    PROTO_EXTRA: tuple[str, ...]
+    # Tags of internal collectable types.
+    TUPVAL: typing.Optional[int]
+    TPROTO: int
+    OPCODES: type[opcodes.Opcodes]
+    # Names of `gcstate` and `gckind` values, tuning parameters of the
+    # collector with the factor they are stored divided by and the lists which
+    # are split in generations, with their boundaries.
+    GC_STATES: tuple[str, ...]
+    GC_KINDS: tuple[str, ...]
+    GC_PARAMS: tuple[tuple[str, int], ...]
+    GC_AGES: typing.Optional[tuple[tuple[str, tuple[str, str, str]], ...]]
+
+    def __init__(self, ident: gdb.Symbol):
+        # Types are looked up lazily, starting from the compilation unit which
+        # defines `lua_ident`, so that those of other builds are not found.
+        self.objfile = ident.symtab.objfile
+        self.block = ident.symtab.global_block()
+        self.opcodes = self.OPCODES()
+
+    def lookup_type(self, name: str) -> gdb.Type:
+        return gdb.lookup_type(name, self.block)
+
+    @functools.cached_property
+    def lua_state(self) -> gdb.Type: return self.lookup_type('lua_State')
+    @functools.cached_property
+    def tvalue(self) -> gdb.Type: return self.lookup_type('TValue')
+    @functools.cached_property
+    def tvalue_p(self) -> gdb.Type: return self.tvalue.pointer()
+    @functools.cached_property
+    def value_t(self) -> gdb.Type: return self.lookup_type('Value')
+    @functools.cached_property
+    def node_p(self) -> gdb.Type: return self.lookup_type('Node').pointer()
+    @functools.cached_property
+    def gc_union_p(self) -> gdb.Type:
+        return self.lookup_type('union GCUnion').pointer()
+    @functools.cached_property
+    def int_t(self) -> gdb.Type: return self.lookup_type('int')
+    @functools.cached_property
+    def void_p(self) -> gdb.Type: return self.lookup_type('void').pointer()
+    @functools.cached_property
+    def char_p(self) -> gdb.Type: return self.lookup_type('char').pointer()
+    @functools.cached_property
+    def layout(self) -> layout.Layout: return layout.load(self)
 
     @staticmethod
     def stkidrel_to_stkid(v: types.StkIdRel) -> types.StkId:
@@ -90,15 +173,16 @@ class Lua(object):
     def toboolean(_self, _v, _tt) -> bool: raise NotImplementedError()
     def isinteger(_self, _tt: types.RawTypeTag) -> bool:
         raise NotImplementedError()
-    def string_contents(_self, _s: types.TString) -> gdb.Value:
+    def raw_toboolean(_self, _bits: int, _tt: types.RawTypeTag) -> bool:
         raise NotImplementedError()
-    def alimit(self, _h: types.Hash) -> gdb.Value: raise NotImplementedError()
-    def uv(_self, _v: gdb.Value) -> tuple[gdb.Value, typing.Optional[int]]:
+    def node_key_at(_self, _addr: int) -> gdb.Value:
         raise NotImplementedError()
+    def alimit(self, _h: types.Hash) -> gdb.Value: raise NotImplementedError()
     @staticmethod
-    def hash_kv(n: types.HashNode) -> typing.Optional[
-        tuple[types.TValue, types.TValue]
-    ]:
+    def array_size(asize: int, _flags: int) -> int:
+        'Size of the array part of a table from its raw fields.'
+        return asize
+    def uv(_self, _v: gdb.Value) -> tuple[gdb.Value, typing.Optional[int]]:
         raise NotImplementedError()
     @staticmethod
     def is_tail(s: types.CallStatus) -> bool:
@@ -113,6 +197,49 @@ class Lua(object):
     def gc(self, v: types.Value) -> types.GC:
         return types.GC(v.v['gc'].cast(self.gc_union_p))
 
+    def udata_uv(self, v: gdb.Value) -> gdb.Value:
+        return (v.address.cast(self.char_p) + self.layout.udata_uv) \
+            .cast(self.void_p)
+
+    def tvalue_at(self, addr: int) -> gdb.Value:
+        return gdb.Value(addr).cast(self.tvalue_p).dereference()
+
+    def value_from_bits(self, bits: int) -> types.Value:
+        return types.Value(
+            gdb.Value(self.layout.value_bits.pack(bits), self.value_t))
+
+    def raw_integer(self, bits: int) -> int:
+        return self.layout.integer(bits)
+
+    def raw_number(self, bits: int) -> float:
+        return self.layout.number(bits)
+
+    def string_contents(self, s: types.TString) -> gdb.Value:
+        return s.v.address.cast(self.char_p) + self.layout.tstring_contents
+
+    def read_string(self, addr: int) -> bytes:
+        'Contents of the `TString` at `addr`, read as raw memory.'
+        return cache.OBJECTS.get(
+            'string', addr, lambda: self._read_string(addr))
+
+    def string_length(self, addr: int) -> int:
+        'Length of the `TString` at `addr`, read as raw memory.'
+        tt, shrlen, lnglen = types.read_struct(self.layout.tstring, addr)
+        return lnglen if tt == types.LUA_VLNGSTR else shrlen
+
+    def _read_string(self, addr: int) -> bytes:
+        n = self.string_length(addr)
+        if not n:
+            return b''
+        return backend.current().read(addr + self.layout.tstring_contents, n)
+
+    def read_table(self, addr: int) -> tuple[int, int, int, int]:
+        'Array capacity, hash capacity, array and node addresses of a table.'
+        t = types.read_fields(self.layout.table, addr)
+        return (
+            self.array_size(t[self.TABLE_ASIZE], t['flags']),
+            1 << t['lsizenode'], t['array'], t['node'])
+
     def _dump_stack_idx(self, i: int, v: types.StkId):
         val = self.stkid_to_value(v)
         tt = types.ttype(val)
@@ -124,25 +251,85 @@ class Lua(object):
             raise Exception(f'invalid stack index: {i}')
         self._dump_stack_idx(i, v)
 
-    def dump_stack(self, L: types.LuaState, i: typing.Optional[int]=None):
+    def dump_stack(
+        self, L: types.LuaState, i: typing.Optional[int]=None,
+        first: typing.Optional[int]=None, last: typing.Optional[int]=None,
+    ):
         if i is not None:
             return self.dump_stack_idx(L, int(i))
-        for i, v in enumerate(_iter_stack(self, L)):
-            gdb.write(f'{i + 1}: {v.v} ')
+        _, first, last = records.stack_bounds(self, int(L.v), first, last)
+        s = _stack(self, L).v
+        for i in range(first, last + 1):
+            v = types.StkId(s + i)
+            gdb.write(f'{i}: {v.v} ')
             self._dump_stack_idx(i, v)
 
+    def table_address(self, v: gdb.Value) -> int:
+        'Address of the table referenced by a `TValue` or `Table` value.'
+        t = v.type.strip_typedefs()
+        if t.code == gdb.TYPE_CODE_PTR:
+            if t.target().strip_typedefs().tag == 'Table':
+                return int(v)
+            v = v.dereference()
+            t = v.type.strip_typedefs()
+        if t.tag == 'Table':
+            return int(v.address)
+        if t.tag == 'StackValue':
+            v = v['val']
+        tv = types.TValue(v)
+        if not types.is_table(types.ttype(tv)):
+            raise Exception(f'value is not a table: {v}')
+        return int(types.tvalue(tv).v['gc'])
+
+    def object_address(self, v: gdb.Value) -> int:
+        '''\
+Address of the object referenced by a `TValue` or a pointer.
+
+Integers and pointers to other types are taken to be the address of the
+object itself.\
+'''
+        t = v.type.strip_typedefs()
+        if t.code == gdb.TYPE_CODE_INT:
+            return int(v)
+        if t.code == gdb.TYPE_CODE_PTR:
+            if t.target().strip_typedefs().tag not in TVALUE_TAGS:
+                return int(v)
+            v = v.dereference()
+            t = v.type.strip_typedefs()
+        if t.tag not in TVALUE_TAGS:
+            return int(v.address)
+        if t.tag == 'StackValue':
+            v = v['val']
+        tv = types.TValue(v)
+        if not types.is_collectable(types.tt(tv).v):
+            raise Exception(f'value is not collectable: {v}')
+        return int(types.tvalue(tv).v['gc'])
+
+    def dump_table(
+        self, addr: int,
+        offset: int=0, limit: typing.Optional[int]=None,
+        keys_only: bool=False,
+    ):
+        summary = printing.table_summary(self, addr, True)
+        gdb.write(f'table {addr:#x} {summary}\n')
+        end = None if limit is None else offset + limit
+        it = printing.iter_table(self, addr, end or 0)
+        for k, v in itertools.islice(it, offset, end):
+            if isinstance(k, int):
+                key = str(k)
+            else:
+                key = printing.format_value(self, k)
+            if keys_only:
+                gdb.write(f'[{key}]\n')
+            else:
+                gdb.write(f'[{key}] = {printing.format_value(self, v)}\n')
+
     def dump_call_stack(self, L: types.LuaState):
         l = lua()
         for i, info in enumerate(_iter_call_stack(L)):
             if f := self.stkidrel_to_stkid(types.StkIdRel(info.v['func'])):
                 v = l.stkid_to_value(f)
-                tt = types.RawTypeTag(int(v.v['tt_']))
-                gdb.write(f'#{i}  {v.v}')
-                lua_name = _getfuncname(self, L, info, tt, v)
-                if lua_name is not None:
-                    gdb.write(' ')
-                    gdb.write(lua_name)
-                gdb.write('\n')
+                gdb.write(f'#{i}  {v.v}{_frame_description(self, info)}\n')
             if l.is_tail(info.callstatus()):
                 gdb.write('(... tail calls ...)\n')
 
@@ -152,95 +339,136 @@ class LuaWithoutStkIdRel(object):
         return types.StkId(v.v)
 
 class Lua53(LuaWithoutStkIdRel, Lua):
-    def __init__(self):
-        super(Lua53, self).__init__()
-        max_align = gdb.lookup_type('L_Umaxalign')
-        tstring = gdb.lookup_type('TString')
-        udata = gdb.lookup_type('Udata')
-        self.tstring_size = max(tstring.sizeof, max_align.sizeof)
-        self.udata_size = max(udata.sizeof, max_align.sizeof)
+    NODE_KEY = ('i_key.tvk.tt_', 'i_key.tvk.value_')
+    NODE_NEXT = 'i_key.nk.next'
+    TABLE_ASIZE = 'sizearray'
+    TSTRING_CONTENTS = None
+    UDATA_UV = None
+    UDATA_EXTRA = ()
+    UDATA_USER = ('ttuv_', 'user_')
+    VALUE_BOOL = 'b'
+    PROTO_EXTRA = ()
+    TUPVAL = None
+    TPROTO = types.LUA_NUMTAGS
+    OPCODES = opcodes.Opcodes53
+    GC_STATES = (
+        'propagate', 'atomic', 'swpallgc', 'swpfinobj', 'swptobefnz',
+        'swpend', 'callfin', 'pause')
+    GC_KINDS = ('normal', 'emergency')
+    GC_PARAMS = (('gcpause', 1), ('gcstepmul', 1))
+    GC_AGES = None
 
     def stkid_to_value(self, v: types.StkId) -> types.TValue:
         return types.TValue(v.v.dereference())
     def toboolean(self, v: types.Value, _tt: types.RawTypeTag) -> bool:
         return bool(v.v['b'])
+    def raw_toboolean(self, bits: int, _tt: types.RawTypeTag) -> bool:
+        return bool(self.layout.boolean(bits))
+    def node_key_at(self, addr: int) -> gdb.Value:
+        return gdb.Value(addr).cast(self.node_p).dereference()['i_key']['tvk']
     def isinteger(self, tt: types.RawTypeTag) -> bool:
         return bool(types.variant(tt).v)
-    def string_contents(self, s: types.TString) -> gdb.Value:
-        return self.data_suffix(s.v.address, self.tstring_size) \
-            .cast(self.char_p)
     def alimit(self, h: types.Hash) -> gdb.Value:
         return h.v['sizearray']
     def uv(self, v: gdb.Value) -> tuple[gdb.Value, typing.Optional[int]]:
-        return (self.data_suffix(v.address, self.udata_size), None)
-    def data_suffix(self, ptr, size):
-        return (ptr.cast(self.char_p) + size).cast(self.void_p)
+        return (self.udata_uv(v), None)
     @staticmethod
     def is_tail(s: types.CallStatus) -> bool:
         return bool(s.v & (1 << 5))
 
-    @staticmethod
-    def hash_kv(n: types.HashNode) -> typing.Optional[
-        tuple[types.TValue, types.TValue]
-    ]:
-        v = n.value()
-        if not types.is_nil(types.ttype(v)):
-            return types.TValue(n.v['i_key']['tvk']), v
-        return None
-
 class Lua54(Lua):
+    NODE_KEY = ('u.key_tt', 'u.key_val')
+    NODE_NEXT = 'u.next'
+    TABLE_ASIZE = 'alimit'
+    TSTRING_CONTENTS = 'contents'
+    UDATA_UV = 'uv'
+    UDATA_EXTRA = ('nuvalue',)
+    UDATA_USER = None
+    VALUE_BOOL = None
+    PROTO_EXTRA = ('abslineinfo', 'sizeabslineinfo')
+    TUPVAL = types.LUA_NUMTAGS
+    TPROTO = types.LUA_NUMTAGS + 1
+    OPCODES = opcodes.Opcodes54
+    GC_STATES = (
+        'propagate', 'enteratomic', 'atomic', 'swpallgc', 'swpfinobj',
+        'swptobefnz', 'swpend', 'callfin', 'pause')
+    GC_KINDS = ('incremental', 'generational')
+    # Parameters are stored divided by 4, see `getgcparam`.
+    GC_PARAMS = (
+        ('gcpause', 4), ('gcstepmul', 4), ('gcstepsize', 1),
+        ('genminormul', 1), ('genmajormul', 4))
+    # Boundaries of the generations in each list, see `lgc.c`.
+    GC_AGES = (
+        ('allgc', ('survival', 'old1', 'reallyold')),
+        ('finobj', ('finobjsur', 'finobjold1', 'finobjrold')))
+
     def stkid_to_value(self, v: types.StkId) -> types.TValue:
         return types.TValue(v.v['val'])
     def toboolean(self, _v: types.Value, tt: types.RawTypeTag) -> bool:
         return bool(types.variant(tt).v)
+    def raw_toboolean(self, _bits: int, tt: types.RawTypeTag) -> bool:
+        return bool(types.variant(tt).v)
+    def node_key_at(self, addr: int) -> gdb.Value:
+        return gdb.Value(addr).cast(self.node_p).dereference()['u']
     def isinteger(self, tt: types.RawTypeTag) -> bool:
         return not bool(types.variant(tt).v)
-    def string_contents(self, s: types.TString) -> gdb.Value:
-        return s.v['contents'].cast(self.char_p)
     def alimit(self, h: types.Hash) -> gdb.Value:
-        # TODO isrealasize
-        return h.v['alimit']
+        return gdb.Value(
+            self.array_size(int(h.v['alimit']), int(h.v['flags'])))
+    @staticmethod
+    def array_size(asize: int, flags: int) -> int:
+        'See `luaH_realasize`: `alimit` may be a hint smaller than the size.'
+        if not flags & BITRAS or not asize & (asize - 1):
+            return asize
+        return 1 << asize.bit_length()
     @staticmethod
     def is_tail(s: types.CallStatus) -> bool:
         return bool(s.v & (1 << 5))
 
     def uv(self, v: gdb.Value) -> tuple[gdb.Value, typing.Optional[int]]:
-        return (
-            v['uv']['uv'].address.cast(self.void_p),
-            int(v['nuvalue']),
-        )
-
-    @staticmethod
-    def hash_kv(n: types.HashNode) -> typing.Optional[
-        tuple[types.TValue, types.TValue]
-    ]:
-        v = n.value()
-        if not types.is_nil(types.ttype(v)):
-            return types.TValue(n.v['u']), v
-        return None
+        return (self.udata_uv(v), int(v['nuvalue']))
 
 class Lua54_le1(LuaWithoutStkIdRel, Lua54):
+    # `old1` and `finobjold1` were named `old` and `finobjold` before 5.4.2.
+    GC_AGES = (
+        ('allgc', ('survival', 'old', 'reallyold')),
+        ('finobj', ('finobjsur', 'finobjold', 'finobjrold')))
+
     @staticmethod
     def is_tail(s: types.CallStatus) -> bool:
         return bool(s.v & (1 << 4))
 
 class Lua54_lt5(LuaWithoutStkIdRel, Lua54): pass
 
+def _create(ps: gdb.Progspace) -> Lua:
+    ident = _lua_ident(ps)
+    v = _version(ident)
+    if v[0] == 5:
+        if v[1] == 3:
+            return Lua53(ident)
+        elif v[1] == 4:
+            if v[2] <= 1:
+                return Lua54_le1(ident)
+            elif v[2] <= 4:
+                return Lua54_lt5(ident)
+            else:
+                return Lua54(ident)
+    raise types.LuaInitializationFailed(
+        'unsupported Lua version: ' + '.'.join(map(str, v)))
+
 def lua() -> Lua:
-    global G
-    if G is None:
-        v = _version()
-        if v[0] == 5:
-            if v[1] == 3:
-                G = Lua53()
-            elif v[1] == 4:
-                if v[2] <= 1:
-                    G = Lua54_le1()
-                elif v[2] <= 4:
-                    G = Lua54_lt5()
-                else:
-                    G = Lua54()
-        if G is None:
-            raise types.LuaInitializationFailed(
-                'unsupported Lua version: ' + '.'.join(map(str, v)))
-    return G
+    'Instance for the Lua version of the current program space.'
+    ps = gdb.current_progspace()
+    ret = INSTANCES.get(ps)
+    if ret is None:
+        ret = INSTANCES[ps] = _create(ps)
+    return ret
+
+def _forget(ps: gdb.Progspace):
+    INSTANCES.pop(ps, None)
+
+def connect():
+    'Discards the instance of a program space when its object files change.'
+    gdb.events.new_objfile.connect(
+        lambda e: _forget(e.new_objfile.progspace))
+    gdb.events.clear_objfiles.connect(lambda e: _forget(e.progspace))
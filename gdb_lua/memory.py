@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+import typing
+
+import gdb
+
+from . import backend
+from . import types
+
+BLOCK_SHIFT = 16
+MAX_BLOCKS = 1024
+
+class BlockReader(object):
+    '''\
+Reads inferior memory through a cache of aligned blocks.
+
+Walking linked structures such as the collector lists touches many small,
+mostly nearby objects; reading whole blocks turns most of those accesses into
+buffer slices.  Blocks which cannot be read entirely (e.g. at the end of a
+mapping) fall back to reading only the requested range.\
+'''
+    __slots__ = ('mem', 'shift', 'mask', 'max_blocks', 'blocks')
+
+    def __init__(self, shift: int=BLOCK_SHIFT, max_blocks: int=MAX_BLOCKS):
+        self.mem = backend.current()
+        self.shift = shift
+        self.mask = (1 << shift) - 1
+        self.max_blocks = max_blocks
+        self.blocks: dict[int, typing.Optional[bytes]] = {}
+
+    def _block(self, i: int) -> typing.Optional[bytes]:
+        blocks = self.blocks
+        try:
+            return blocks[i]
+        except KeyError:
+            pass
+        if len(blocks) >= self.max_blocks:
+            del blocks[next(iter(blocks))]
+        try:
+            ret = self.mem.read(i << self.shift, 1 << self.shift)
+        except gdb.MemoryError:
+            ret = None
+        blocks[i] = ret
+        return ret
+
+    def read(self, addr: int, n: int) -> bytes:
+        off = addr & self.mask
+        if off + n <= self.mask + 1:
+            b = self._block(addr >> self.shift)
+            if b is not None:
+                return b[off:off + n]
+        return self.mem.read(addr, n)
+
+    def iter_unpack(self, s: types.Struct, addr: int, n: int) \
+        -> typing.Iterator[tuple] \
+    :
+        'Decodes `n` contiguous `s` objects.'
+        if not n:
+            return iter(())
+        size = n * s.size
+        if size <= self.mask + 1:
+            return s.iter_unpack(self.read(addr, size))
+        return types.read_array(s, addr, n)
+
+    def unpack(self, s: types.Struct, addr: int) -> tuple:
+        off = addr & self.mask
+        if off + s.size <= self.mask + 1:
+            b = self._block(addr >> self.shift)
+            if b is not None:
+                return s.unpack_from(b, off)
+        return s.unpack_from(self.mem.read(addr, s.size))
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+'''\
+Instruction formats of each Lua version, see `lopcodes.h`.
+
+Only the fields needed to decode instructions are described here, the
+opcodes themselves are identified by name so that code which inspects them
+can be shared between versions.\
+'''
+import typing
+
+# Class of each opcode of every version, for instruction histograms.
+CLASSES = {
+    name: cls for cls, names in (
+        ('load', (
+            'MOVE', 'LOADK', 'LOADKX', 'LOADBOOL', 'LOADNIL', 'LOADI',
+            'LOADF', 'LOADFALSE', 'LFALSESKIP', 'LOADTRUE', 'VARARG',
+            'VARARGPREP')),
+        ('upvalue', ('GETUPVAL', 'SETUPVAL', 'CLOSE', 'TBC')),
+        ('table get', ('GETTABUP', 'GETTABLE', 'GETI', 'GETFIELD', 'SELF')),
+        ('table set', (
+            'SETTABUP', 'SETTABLE', 'SETI', 'SETFIELD', 'SETLIST')),
+        ('table new', ('NEWTABLE',)),
+        ('arithmetic', (
+            'ADD', 'SUB', 'MUL', 'MOD', 'POW', 'DIV', 'IDIV', 'BAND', 'BOR',
+            'BXOR', 'SHL', 'SHR', 'UNM', 'BNOT', 'NOT', 'LEN', 'ADDI', 'ADDK',
+            'SUBK', 'MULK', 'MODK', 'POWK', 'DIVK', 'IDIVK', 'BANDK', 'BORK',
+            'BXORK', 'SHRI', 'SHLI', 'MMBIN', 'MMBINI', 'MMBINK')),
+        ('concat', ('CONCAT',)),
+        ('compare', (
+            'EQ', 'LT', 'LE', 'EQK', 'EQI', 'LTI', 'LEI', 'GTI', 'GEI',
+            'TEST', 'TESTSET')),
+        ('jump', ('JMP',)),
+        ('loop', (
+            'FORLOOP', 'FORPREP', 'TFORPREP', 'TFORCALL', 'TFORLOOP')),
+        ('call', ('CALL', 'TAILCALL')),
+        ('return', ('RETURN', 'RETURN0', 'RETURN1')),
+        ('closure', ('CLOSURE',)),
+    )
+    for name in names
+}
+
+def _mask(n: int) -> int:
+    return (1 << n) - 1
+
+class Opcodes(object):
+    NAMES: tuple[str, ...]
+    # Opcodes which do not set register `A` (`testAMode` is false).
+    NOT_A: frozenset[str]
+    # Opcodes which follow the instruction which called the metamethod
+    # (`testMMMode`, 5.4 only).
+    MM: frozenset[str] = frozenset()
+    # Events of the metamethods called by each opcode (`funcnamefromcode`)
+    # and the prefix of their names in debug information.
+    METAMETHODS: dict[str, str]
+    TM_PREFIX: str
+    # Events in `TMS` order, indexed by the argument of `MM` opcodes.
+    TM_NAMES: tuple[str, ...] = ()
+    # Register/constant argument flag (`ISK`, 5.3 only).
+    BITRK: typing.Optional[int] = None
+    # Format of the opcodes which are not `iABC` (`luaP_opmodes`): `ABx`,
+    # `AsBx`, `Ax` or `sJ`.
+    MODES: dict[str, str]
+    SIZE_OP: int
+    POS_A: int
+    SIZE_A = 8
+    POS_B: int
+    SIZE_B: int
+    POS_C: int
+    SIZE_C: int
+    POS_BX: int
+    SIZE_BX: int
+    POS_AX: int
+    SIZE_AX: int
+
+    def __init__(self):
+        self.op = {name: i for i, name in enumerate(self.NAMES)}
+        self.sets_a = tuple(x not in self.NOT_A for x in self.NAMES)
+        self.mm = tuple(x in self.MM for x in self.NAMES)
+
+    def opcode(self, i: int) -> int: return i & _mask(self.SIZE_OP)
+    def name(self, i: int) -> str:
+        op = self.opcode(i)
+        return self.NAMES[op] if op < len(self.NAMES) else str(op)
+    def a(self, i: int) -> int: return (i >> self.POS_A) & _mask(self.SIZE_A)
+    def b(self, i: int) -> int: return (i >> self.POS_B) & _mask(self.SIZE_B)
+    def c(self, i: int) -> int: return (i >> self.POS_C) & _mask(self.SIZE_C)
+    def bx(self, i: int) -> int:
+        return (i >> self.POS_BX) & _mask(self.SIZE_BX)
+    def sbx(self, i: int) -> int: return self.bx(i) - (_mask(self.SIZE_BX) >> 1)
+    def ax(self, i: int) -> int:
+        return (i >> self.POS_AX) & _mask(self.SIZE_AX)
+    def sj(self, i: int) -> int: return self.sbx(i)
+    # Constant flag of `iABC` instructions (5.4 only).
+    def k(self, _i: int) -> int: return 0
+    def mode(self, i: int) -> str: return self.MODES.get(self.name(i), 'ABC')
+
+    def operands(self, i: int) -> tuple[int, ...]:
+        'Arguments of an instruction, according to its format.'
+        mode = self.mode(i)
+        if mode == 'ABx':
+            return self.a(i), self.bx(i)
+        if mode == 'AsBx':
+            return self.a(i), self.sbx(i)
+        if mode == 'Ax':
+            return self.ax(i),
+        if mode == 'sJ':
+            return self.sj(i),
+        return self.a(i), self.b(i), self.c(i)
+
+    def constants(self, i: int) -> list[int]:
+        'Indices of the constants referenced by an instruction.'
+        raise NotImplementedError()
+
+    def jump(self, i: int, pc: int) -> typing.Optional[int]:
+        'Target of the instruction at `pc` if it is a jump.'
+        raise NotImplementedError()
+
+class Opcodes53(Opcodes):
+    NAMES = (
+        'MOVE', 'LOADK', 'LOADKX', 'LOADBOOL', 'LOADNIL', 'GETUPVAL',
+        'GETTABUP', 'GETTABLE', 'SETTABUP', 'SETUPVAL', 'SETTABLE',
+        'NEWTABLE', 'SELF', 'ADD', 'SUB', 'MUL', 'MOD', 'POW', 'DIV', 'IDIV',
+        'BAND', 'BOR', 'BXOR', 'SHL', 'SHR', 'UNM', 'BNOT', 'NOT', 'LEN',
+        'CONCAT', 'JMP', 'EQ', 'LT', 'LE', 'TEST', 'TESTSET', 'CALL',
+        'TAILCALL', 'RETURN', 'FORLOOP', 'FORPREP', 'TFORCALL', 'TFORLOOP',
+        'SETLIST', 'CLOSURE', 'VARARG', 'EXTRAARG',
+    )
+    NOT_A = frozenset((
+        'SETTABUP', 'SETUPVAL', 'SETTABLE', 'JMP', 'EQ', 'LT', 'LE', 'TEST',
+        'RETURN', 'TFORCALL', 'SETLIST', 'EXTRAARG',
+    ))
+    METAMETHODS = {
+        'SELF': 'index', 'GETTABUP': 'index', 'GETTABLE': 'index',
+        'SETTABUP': 'newindex', 'SETTABLE': 'newindex',
+        **{x: x.lower() for x in (
+            'ADD', 'SUB', 'MUL', 'MOD', 'POW', 'DIV', 'IDIV', 'BAND', 'BOR',
+            'BXOR', 'SHL', 'SHR', 'UNM', 'BNOT', 'LEN', 'CONCAT', 'EQ', 'LT',
+            'LE')},
+    }
+    TM_PREFIX = '__'
+    SIZE_OP = 6
+    POS_A = 6
+    POS_C, SIZE_C = 14, 9
+    POS_B, SIZE_B = 23, 9
+    POS_BX, SIZE_BX = 14, 18
+    POS_AX, SIZE_AX = 6, 26
+    BITRK = 1 << 8
+    MODES = {
+        'LOADK': 'ABx', 'LOADKX': 'ABx', 'CLOSURE': 'ABx', 'JMP': 'AsBx',
+        'FORLOOP': 'AsBx', 'FORPREP': 'AsBx', 'TFORLOOP': 'AsBx',
+        'EXTRAARG': 'Ax',
+    }
+    # Arguments which can be constants (`RK(B)`/`RK(C)`).
+    RK = {
+        'GETTABUP': 'c', 'GETTABLE': 'c', 'SETTABUP': 'bc', 'SETTABLE': 'bc',
+        'SELF': 'c', 'EQ': 'bc', 'LT': 'bc', 'LE': 'bc',
+        **{x: 'bc' for x in (
+            'ADD', 'SUB', 'MUL', 'MOD', 'POW', 'DIV', 'IDIV', 'BAND', 'BOR',
+            'BXOR', 'SHL', 'SHR')},
+    }
+    JUMPS = frozenset(('JMP', 'FORLOOP', 'FORPREP', 'TFORLOOP'))
+
+    def constants(self, i: int) -> list[int]:
+        name = self.name(i)
+        if name == 'LOADK':
+            return [self.bx(i)]
+        ret = []
+        for x in self.RK.get(name, ''):
+            v = self.b(i) if x == 'b' else self.c(i)
+            if v & self.BITRK:
+                ret.append(v & ~self.BITRK)
+        return ret
+
+    def jump(self, i: int, pc: int) -> typing.Optional[int]:
+        if self.name(i) in self.JUMPS:
+            return pc + 1 + self.sbx(i)
+        return None
+
+class Opcodes54(Opcodes):
+    NAMES = (
+        'MOVE', 'LOADI', 'LOADF', 'LOADK', 'LOADKX', 'LOADFALSE',
+        'LFALSESKIP', 'LOADTRUE', 'LOADNIL', 'GETUPVAL', 'SETUPVAL',
+        'GETTABUP', 'GETTABLE', 'GETI', 'GETFIELD', 'SETTABUP', 'SETTABLE',
+        'SETI', 'SETFIELD', 'NEWTABLE', 'SELF', 'ADDI', 'ADDK', 'SUBK',
+        'MULK', 'MODK', 'POWK', 'DIVK', 'IDIVK', 'BANDK', 'BORK', 'BXORK',
+        'SHRI', 'SHLI', 'ADD', 'SUB', 'MUL', 'MOD', 'POW', 'DIV', 'IDIV',
+        'BAND', 'BOR', 'BXOR', 'SHL', 'SHR', 'MMBIN', 'MMBINI', 'MMBINK',
+        'UNM', 'BNOT', 'NOT', 'LEN', 'CONCAT', 'CLOSE', 'TBC', 'JMP', 'EQ',
+        'LT', 'LE', 'EQK', 'EQI', 'LTI', 'LEI', 'GTI', 'GEI', 'TEST',
+        'TESTSET', 'CALL', 'TAILCALL', 'RETURN', 'RETURN0', 'RETURN1',
+        'FORLOOP', 'FORPREP', 'TFORPREP', 'TFORCALL', 'TFORLOOP', 'SETLIST',
+        'CLOSURE', 'VARARG', 'VARARGPREP', 'EXTRAARG',
+    )
+    NOT_A = frozenset((
+        'SETUPVAL', 'SETTABUP', 'SETTABLE', 'SETI', 'SETFIELD', 'MMBIN',
+        'MMBINI', 'MMBINK', 'CLOSE', 'TBC', 'JMP', 'EQ', 'LT', 'LE', 'EQK',
+        'EQI', 'LTI', 'LEI', 'GTI', 'GEI', 'TEST', 'RETURN', 'RETURN0',
+        'RETURN1', 'TFORPREP', 'TFORCALL', 'SETLIST', 'EXTRAARG',
+    ))
+    MM = frozenset(('MMBIN', 'MMBINI', 'MMBINK'))
+    METAMETHODS = {
+        'SELF': 'index', 'GETTABUP': 'index', 'GETTABLE': 'index',
+        'GETI': 'index', 'GETFIELD': 'index',
+        'SETTABUP': 'newindex', 'SETTABLE': 'newindex', 'SETI': 'newindex',
+        'SETFIELD': 'newindex',
+        'UNM': 'unm', 'BNOT': 'bnot', 'LEN': 'len', 'CONCAT': 'concat',
+        'EQ': 'eq', 'LT': 'lt', 'LTI': 'lt', 'GTI': 'lt',
+        'LE': 'le', 'LEI': 'le', 'GEI': 'le',
+        'CLOSE': 'close', 'RETURN': 'close',
+    }
+    TM_PREFIX = ''
+    TM_NAMES = (
+        'index', 'newindex', 'gc', 'mode', 'len', 'eq', 'add', 'sub', 'mul',
+        'mod', 'pow', 'div', 'idiv', 'band', 'bor', 'bxor', 'shl', 'shr',
+        'unm', 'bnot', 'lt', 'le', 'concat', 'call', 'close',
+    )
+    SIZE_OP = 7
+    POS_A = 7
+    POS_K = 15
+    POS_B, SIZE_B = 16, 8
+    POS_C, SIZE_C = 24, 8
+    POS_BX, SIZE_BX = 15, 17
+    POS_AX, SIZE_AX = 7, 25
+    SIZE_SJ = 25
+    MODES = {
+        'LOADI': 'AsBx', 'LOADF': 'AsBx', 'LOADK': 'ABx', 'LOADKX': 'ABx',
+        'FORLOOP': 'ABx', 'FORPREP': 'ABx', 'TFORPREP': 'ABx',
+        'TFORLOOP': 'ABx', 'CLOSURE': 'ABx', 'JMP': 'sJ', 'EXTRAARG': 'Ax',
+    }
+    # Arguments which are always constants.
+    K = {
+        'GETTABUP': 'c', 'GETFIELD': 'c', 'SETTABUP': 'b', 'SETFIELD': 'b',
+        'EQK': 'b', 'MMBINK': 'b',
+        **{x: 'c' for x in (
+            'ADDK', 'SUBK', 'MULK', 'MODK', 'POWK', 'DIVK', 'IDIVK', 'BANDK',
+            'BORK', 'BXORK')},
+    }
+    # Opcodes whose `C` is a constant if `k` is set (`RKC`).
+    RKC = frozenset(('SETTABUP', 'SETTABLE', 'SETI', 'SETFIELD', 'SELF'))
+
+    def k(self, i: int) -> int: return (i >> self.POS_K) & 1
+    def sj(self, i: int) -> int:
+        return self.ax(i) - (_mask(self.SIZE_SJ) >> 1)
+
+    def constants(self, i: int) -> list[int]:
+        name = self.name(i)
+        if name == 'LOADK':
+            return [self.bx(i)]
+        ret = [
+            self.b(i) if x == 'b' else self.c(i)
+            for x in self.K.get(name, '')]
+        if name in self.RKC and self.k(i):
+            ret.append(self.c(i))
+        return ret
+
+    def jump(self, i: int, pc: int) -> typing.Optional[int]:
+        'See `OP_FORLOOP`, `OP_FORPREP`, etc. in `lvm.c`.'
+        name = self.name(i)
+        if name == 'JMP':
+            return pc + 1 + self.sj(i)
+        if name in ('FORLOOP', 'TFORLOOP'):
+            return pc + 1 - self.bx(i)
+        if name == 'FORPREP':
+            return pc + 2 + self.bx(i)
+        if name == 'TFORPREP':
+            return pc + 1 + self.bx(i)
+        return None
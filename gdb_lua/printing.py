@@ -1,12 +1,91 @@
 #!/usr/bin/env python3
-import itertools
+import math
+import sys
+import time
 import typing
 
 import gdb
+import gdb.printing
 
+from . import cache
 from . import lua
 from . import types
 
+TableKey = typing.Union[int, types.RawTValue]
+
+DEFAULT_MAX_DEPTH = 8
+DEFAULT_TIME_BUDGET = 2000
+DEFAULT_BYTE_BUDGET = 1 << 20
+# Estimated size of the output of values other than strings.
+VALUE_SIZE = 16
+
+_TABLE_COUNTS = False
+_ESCAPES = {
+    '"': '\\"', '\\': '\\\\', '\n': '\\n', '\r': '\\r', '\t': '\\t',
+}
+
+def set_table_counts(v: bool):
+    'Sets whether table summaries include the number of elements.'
+    global _TABLE_COUNTS
+    _TABLE_COUNTS = v
+    cache.OBJECTS.clear()
+
+class Expansion(object):
+    '''\
+Limits of the recursive expansion of tables by the printers.
+
+gdb expands the children of a value depth-first while it is formatted, so the
+tables being expanded at any point form a stack: a table already in it is a
+cycle, and its size is the current depth.  A new budget of time and output
+size starts whenever the stack is empty, i.e. for each `print` command.\
+'''
+    __slots__ = (
+        'max_depth', 'time_budget', 'byte_budget', 'active', 'deadline',
+        'left')
+
+    def __init__(self):
+        self.max_depth: typing.Optional[int] = DEFAULT_MAX_DEPTH
+        # Milliseconds and bytes, `None` for unlimited.
+        self.time_budget: typing.Optional[int] = DEFAULT_TIME_BUDGET
+        self.byte_budget: typing.Optional[int] = DEFAULT_BYTE_BUDGET
+        self.active: list[int] = []
+        self.deadline = 0.0
+        self.left = 0
+
+    def can_expand(self) -> bool:
+        if self.active and (self.deadline < 0 or self.left < 0):
+            return False
+        return self.max_depth is None or len(self.active) < self.max_depth
+
+    def enter(self, addr: int):
+        if not self.active:
+            t, b = self.time_budget, self.byte_budget
+            self.deadline = \
+                math.inf if t is None else time.monotonic() + t / 1000
+            self.left = sys.maxsize if b is None else b
+        self.active.append(addr)
+
+    def leave(self):
+        self.active.pop()
+
+    def spend(self, n: int) -> bool:
+        'Accounts for `n` bytes of output, returns whether the budget is over.'
+        self.left -= n
+        if self.left < 0 or time.monotonic() > self.deadline:
+            self.deadline, self.left = -1, -1
+            return True
+        return False
+
+    def reset(self, *_):
+        self.active.clear()
+
+EXPANSION = Expansion()
+_TRUNCATED = (('', '...'), ('', '<print budget exceeded>'))
+
+def set_max_depth(v: typing.Optional[int]): EXPANSION.max_depth = v
+def set_time_budget(v: typing.Optional[int]): EXPANSION.time_budget = v
+def set_byte_budget(v: typing.Optional[int]): EXPANSION.byte_budget = v
+
 class ValuePrinter(object):
     'Shared implementation of printers for types that contain a `struct Value`.'
     def __init__(self, v: types.Value, tt: types.RawTypeTag):
@@ -22,30 +101,61 @@ class ValuePrinter(object):
         return None
 
     def to_string(self):
-        return dump(lua.lua(), self.v, self.tt)
+        ret = dump(lua.lua(), self.v, self.tt)
+        if not types.is_table(types.TypeTag(self.tt)):
+            return ret
+        addr = int(self.v.v['gc'])
+        if addr in EXPANSION.active:
+            return f'<cycle {addr:#x}>'
+        if not EXPANSION.can_expand():
+            return f'{ret} {{...}}'
+        return ret
 
     def children(self) -> typing.Union[tuple, typing.Iterator]:
         if not types.is_table(types.TypeTag(self.tt)):
             return ()
-        l = lua.lua()
-        h = l.gc(self.v).to_hash()
-        cap, hcap = types.array_cap(l, h), types.hash_cap(h)
-        hash_kv = l.hash_kv
-        return itertools.chain(
-            itertools.chain.from_iterable(
-                (('', str(i)), ('', x.v.dereference()))
-                for i, x in _iter_array(h, cap)),
-            itertools.chain.from_iterable(
-                (('', x[0].v), ('', x[1].v))
-                for x in map(hash_kv, _iter_hash(h, hcap)) if x))
+        addr = int(self.v.v['gc'])
+        if addr in EXPANSION.active or not EXPANSION.can_expand():
+            return ()
+        return _expand(lua.lua(), addr)
+
+def _size(lua: 'lua.Lua', v: types.RawTValue) -> int:
+    'Estimated size of the output of a key or value.'
+    if v.tt & types.TTYPE_MASK == types.LUA_TSTRING:
+        return lua.string_length(lua.layout.pointer(v.bits)) + 2
+    return VALUE_SIZE
+
+def _expand(lua: 'lua.Lua', addr: int) \
+    -> typing.Iterator[tuple[str, typing.Any]] \
+:
+    'Children of a table, within the limits of `EXPANSION`.'
+    e = EXPANSION
+    e.enter(addr)
+    try:
+        cap, hcap, array, node = lua.read_table(addr)
+        value_at, key_at = lua.tvalue_at, lua.node_key_at
+        # gdb stops consuming children at `print elements`, read only those.
+        first = gdb.parameter('print elements') or 0
+        for i, x in _iter_array(lua, array, cap, first):
+            if e.spend(_size(lua, x)):
+                yield from _TRUNCATED
+                return
+            yield '', str(i)
+            yield '', _raw_child(lua, x, value_at)
+        for k, x in _iter_hash(lua, node, hcap, first):
+            if e.spend(_size(lua, k) + _size(lua, x)):
+                yield from _TRUNCATED
+                return
+            yield '', _raw_child(lua, k, key_at)
+            yield '', _raw_child(lua, x, value_at)
+    finally:
+        e.leave()
 
 class TValuePrinter(object):
     'Printer for tagged values.'
     @classmethod
-    def create(cls, v: gdb.Value) -> typing.Optional['TValuePrinter']:
-        if str(v.type.unqualified()) in ('TValue', 'struct TValue'):
-            return cls(types.TValue(v))
-        return None
+    def create(cls, v: gdb.Value) -> 'TValuePrinter':
+        return cls(types.TValue(v))
 
     def __init__(self, v: types.TValue):
         self.value = ValuePrinter(types.tvalue(v), types.tt(v))
@@ -57,10 +167,8 @@ class TValuePrinter(object):
 class NodeKeyPrinter(object):
     'Printer for hash table nodes.'
     @classmethod
-    def create(cls, v: gdb.Value) -> typing.Optional['NodeKeyPrinter']:
-        if str(v.type.unqualified()) in ('NodeKey', 'struct NodeKey'):
-            return cls(types.HashNode(v))
-        return None
+    def create(cls, v: gdb.Value) -> 'NodeKeyPrinter':
+        return cls(types.HashNode(v))
 
     def __init__(self, v: types.HashNode):
         self.value = ValuePrinter(v.key_value(), v.key_tt())
@@ -69,6 +177,51 @@ class NodeKeyPrinter(object):
     def to_string(self): return self.value.to_string()
     def children(self): return self.value.children()
 
+Printer = typing.Union[TValuePrinter, NodeKeyPrinter]
+
+class Dispatcher(gdb.printing.PrettyPrinter):
+    '''\
+Lookup function of the printers of Lua types.
+
+gdb calls it for every value it formats, so unrelated types are rejected as
+cheaply as possible: by type code, then by name and finally by the object file
+which defines them, which must be the one which defines `lua_ident`.  The
+result for each name and object file is cached until object files change.\
+'''
+    CODES = frozenset((
+        gdb.TYPE_CODE_STRUCT, gdb.TYPE_CODE_UNION, gdb.TYPE_CODE_TYPEDEF))
+    NAMES: dict[str, type[Printer]] = {
+        'TValue': TValuePrinter,
+        'NodeKey': NodeKeyPrinter,
+    }
+
+    def __init__(self):
+        super(Dispatcher, self).__init__('gdb_lua')
+        self.types: dict[tuple, typing.Optional[type[Printer]]] = {}
+
+    def __call__(self, v: gdb.Value) -> typing.Optional[Printer]:
+        t = v.type
+        if t.code not in self.CODES or t.name not in self.NAMES:
+            return None
+        key = t.name, t.objfile
+        try:
+            f = self.types[key]
+        except KeyError:
+            f = self.types[key] = self._resolve(*key)
+        return None if f is None else f.create(v)
+
+    def _resolve(
+        self, name: str, objfile: typing.Optional[gdb.Objfile],
+    ) -> typing.Optional[type[Printer]]:
+        try:
+            l = lua.lua()
+        except types.LuaInitializationFailed:
+            return None
+        return self.NAMES[name] if objfile == l.objfile else None
+
+    def clear(self, *_):
+        self.types.clear()
+
 def _lookup_fn_loc(f: types.CFunction) -> typing.Optional[str]:
     ret = gdb.find_pc_line(int(f.v))
     tab, line = ret.symtab, ret.line
@@ -76,37 +229,71 @@ def _lookup_fn_loc(f: types.CFunction) -> typing.Optional[str]:
         return f'at {tab.filename}:{line}'
     return None
 
-def _getfuncname(
+def _raw_child(
     lua: 'lua.Lua',
-    L: types.LuaState,
-    i: types.CallInfo,
-    tt: types.RawTypeTag,
-    v: types.TValue,
-) -> typing.Optional[str]:
-    if not types.is_lua_closure(tt):
-        return None
-    ret = types.LClosure(lua, types.tvalue(v)).location(lua)
-    if ret is not None:
-        return ret
-    # TODO funcnamefromcode
-    return None
+    v: types.RawTValue,
+    at: typing.Callable[[int], gdb.Value],
+):
+    'Decodes scalars from the raw value, other types are read lazily via `at`.'
+    tt = types.RawTypeTag(v.tt)
+    t = types.TypeTag(tt).v
+    if t == types.LUA_TBOOLEAN:
+        return int(lua.raw_toboolean(v.bits, tt))
+    if t == types.LUA_TNUMBER:
+        if lua.isinteger(tt):
+            return lua.raw_integer(v.bits)
+        return lua.raw_number(v.bits)
+    return at(v.addr)
+
+def quote(s: bytes) -> str:
+    'Formats the contents of a Lua string as a quoted literal.'
+    ret = ['"']
+    for c in s.decode(errors='surrogateescape'):
+        if c in _ESCAPES:
+            ret.append(_ESCAPES[c])
+        elif c.isprintable():
+            ret.append(c)
+        else:
+            ret.extend(
+                f'\\{b:03}' for b in c.encode(errors='surrogateescape'))
+    ret.append('"')
+    return ''.join(ret)
+
+def format_value(lua: 'lua.Lua', v: types.RawTValue) -> str:
+    'Formats a raw value on a single line, without expanding tables.'
+    tt = types.RawTypeTag(v.tt)
+    if types.is_string(types.TypeTag(tt)):
+        return quote(lua.read_string(lua.layout.pointer(v.bits)))
+    return str(dump(lua, lua.value_from_bits(v.bits), tt))
 
-def _iter_array(h: types.Hash, cap: int) \
-    -> typing.Iterator[tuple[int, types.TValue]] \
+def iter_table(lua: 'lua.Lua', addr: int, first: int=0) \
+    -> typing.Iterator[tuple[TableKey, types.RawTValue]] \
 :
-    a = h.to_array()
-    for i in range(1, cap + 1):
-        v = types.TValue(a)
-        if types.is_nil(types.ttype(v)):
+    'Yields the index or key and the value of each element of a table.'
+    cap, hcap, array, node = lua.read_table(addr)
+    yield from _iter_array(lua, array, cap, first)
+    yield from _iter_hash(lua, node, hcap, first)
+
+def _iter_array(lua: 'lua.Lua', a: int, cap: int, first: int=0) \
+    -> typing.Iterator[tuple[int, types.RawTValue]] \
+:
+    s = lua.layout.tvalue
+    for i, (tt, bits) in enumerate(types.read_array(s, a, cap, first)):
+        if tt & types.TTYPE_MASK == types.LUA_TNIL:
             break
-        yield i, v
-        a += 1
+        yield i + 1, types.RawTValue(a + i * s.size, tt, bits)
 
-def _iter_hash(h: types.Hash, cap: int) -> typing.Iterator[types.HashNode]:
-    n = h.to_hash()
-    for _ in range(0, cap):
-        yield types.HashNode(n)
-        n += 1
+def _iter_hash(lua: 'lua.Lua', n: int, cap: int, first: int=0) \
+    -> typing.Iterator[tuple[types.RawTValue, types.RawTValue]] \
+:
+    'Yields the key and value of each non-empty node.'
+    s = lua.layout.node
+    nodes = types.read_array(s, n, cap, first)
+    for i, (tt, bits, ktt, kbits) in enumerate(nodes):
+        if tt & types.TTYPE_MASK == types.LUA_TNIL:
+            continue
+        addr = n + i * s.size
+        yield types.RawTValue(addr, ktt, kbits), types.RawTValue(addr, tt, bits)
 
 def iter_call_stack(L: types.LuaState) -> typing.Iterator[types.CallInfo]:
     p, b = L.v['ci'], L.v['base_ci'].address
@@ -135,12 +322,22 @@ def _dump_string(lua, v: types.Value, _tt: types.RawTypeTag):
     return lua.string_contents(lua.gc(v).to_string())
 
 def _dump_table(lua, v: types.Value, _tt: types.RawTypeTag):
-    h = lua.gc(v).to_hash()
-    cap, hcap = types.array_cap(lua, h), types.hash_cap(h)
-    len = sum(1 for _ in _iter_array(h, cap))
-    hlen = sum(
-        1 for x in _iter_hash(h, hcap)
-        if not types.is_nil(types.ttype(x.value())))
+    addr = int(v.v['gc'])
+    return cache.OBJECTS.get(
+        'table', addr, lambda: table_summary(lua, addr, _TABLE_COUNTS))
+
+def table_summary(lua, addr: int, counts: bool) -> str:
+    '''\
+Capacities of both parts of a table, read from its header.
+
+The number of elements requires a walk over both parts, so it is only
+included if `counts` is set.\
+'''
+    cap, hcap, array, node = lua.read_table(addr)
+    if not counts:
+        return f'(array_capacity: {cap}, hash_capacity: {hcap})'
+    len = sum(1 for _ in _iter_array(lua, array, cap))
+    hlen = sum(1 for _ in _iter_hash(lua, node, hcap))
     return (
         f'(array_capacity: {cap}, length: {len},'
         f' hash_capacity: {hcap}, hash_length: {hlen})')
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+'''\
+Sampling profiler for live inferiors.
+
+The inferior is repeatedly resumed and interrupted with `SIGINT`, which gdb
+does not pass to the program by default, and the Lua call stack is captured at
+each stop.  Samples are aggregated as folded stacks (`frame;frame;... count`),
+the input format of flame graph tools.\
+'''
+import collections
+import functools
+import os
+import signal
+import threading
+import time
+import typing
+
+import gdb
+
+from . import debug
+from . import memory
+from . import threads
+from . import types
+
+if typing.TYPE_CHECKING:
+    from . import lua
+
+DEFAULT_HZ = 100
+DEFAULT_DURATION = 10.0
+# Number of native frames searched for `lua_State` variables.
+MAX_FRAMES = 64
+
+LCL = types.LUA_VLCL | types.BIT_ISCOLLECTABLE
+CCL = types.LUA_VCCL | types.BIT_ISCOLLECTABLE
+
+def _iter_states(lua: 'lua.Lua') -> typing.Iterator[int]:
+    'The `lua_State` variables named `L` in the native call stack.'
+    t = lua.lua_state.pointer()
+    f = gdb.newest_frame()
+    for _ in range(MAX_FRAMES):
+        if f is None:
+            break
+        try:
+            v = f.read_var('L')
+        except (ValueError, gdb.error):
+            pass
+        else:
+            if v.type.strip_typedefs() == t and v:
+                yield int(v)
+        f = f.older()
+
+def current_state(lua: 'lua.Lua') -> typing.Optional[int]:
+    'The innermost `lua_State` variable named `L` in the native call stack.'
+    return next(_iter_states(lua), None)
+
+def resume_chain(lua: 'lua.Lua') -> list[int]:
+    '''\
+The running thread followed by each thread which resumed the next one, as
+found in the native call stack (`lua_resume` is called with the coroutine as
+`L` from a function which has the resuming thread as `L`).\
+'''
+    return list(dict.fromkeys(_iter_states(lua)))
+
+def _c_name(addr: int) -> str:
+    try:
+        b = gdb.block_for_pc(addr)
+    except RuntimeError:
+        b = None
+    while b is not None and b.function is None:
+        b = b.superblock
+    if b is not None:
+        return b.function.name
+    s = gdb.execute(f'info symbol {addr:#x}', to_string=True)
+    if s.startswith('No symbol'):
+        return f'{addr:#x}'
+    return s.split(' ', 1)[0]
+
+class Profiler(object):
+    '''\
+Aggregation of samples into folded stacks.
+
+Prototypes, frame labels and C function names are kept for the whole profile
+(instead of in `cache.OBJECTS`, which is cleared at every stop), so each sample
+only reads the call stack itself.  With `chain`, the stacks of the threads
+which resumed the running one are appended to its own, so that each sample is
+a single stack starting at the main thread.\
+'''
+    def __init__(
+        self, lua: 'lua.Lua',
+        state: typing.Optional[int]=None, chain: bool=False,
+    ):
+        self.lua = lua
+        self.state = state
+        self.chain = chain
+        self.protos: dict[int, debug.Proto] = {}
+        self.proto = functools.partial(debug.cached_proto, self.protos)
+        self.labels: dict[tuple, str] = {}
+        self.c_names: dict[int, str] = {}
+        self.stacks: collections.Counter = collections.Counter()
+        self.samples = 0
+        self.empty = 0
+        self.elapsed = 0.0
+
+    def _states(self) -> typing.Iterable[int]:
+        if self.chain:
+            return resume_chain(self.lua)
+        if self.state is not None:
+            return (self.state,)
+        L = current_state(self.lua)
+        return () if L is None else (L,)
+
+    def sample(self):
+        start = time.perf_counter()
+        r = memory.BlockReader()
+        frames: list[threads.Frame] = []
+        for L in self._states():
+            status, x = threads.stack(self.lua, r, L, self.proto)
+            # Suspended coroutines are not running.
+            if not status:
+                frames.extend(x)
+        if frames:
+            self.stacks[self._fold(tuple(frames))] += 1
+        self.samples += 1
+        self.empty += not frames
+        self.elapsed += time.perf_counter() - start
+
+    def _fold(self, frames: tuple[threads.Frame, ...]) -> str:
+        n = len(frames)
+        return ';'.join(
+            self._label(frames[i], frames[i + 1] if i + 1 < n else None)
+            for i in reversed(range(n)))
+
+    def _label(
+        self, f: threads.Frame, caller: typing.Optional[threads.Frame],
+    ) -> str:
+        tt, fn, _, tail = f
+        key = (tt, fn, None if tail or caller is None else caller[:3])
+        ret = self.labels.get(key)
+        if ret is None:
+            ret = self.labels[key] = \
+                self._make_label(tt, fn, key[2]).replace(';', ',')
+        return ret
+
+    def _make_label(
+        self, tt: int, fn: int, caller: typing.Optional[tuple],
+    ) -> str:
+        lua = self.lua
+        name = None
+        if caller is not None and caller[0] == LCL:
+            p = self.proto(lua, caller[1])
+            if (x := debug.funcname_from_code(lua, p, caller[2])) is not None:
+                name = x[1]
+        if tt == LCL:
+            p = self.proto(lua, fn)
+            if not p.linedefined:
+                return f'main chunk ({p.source})'
+            where = f'{p.source}:{p.linedefined}'
+            return f'{name} ({where})' if name else where
+        if tt in (CCL, types.LUA_VLCF):
+            ret = self.c_names.get(fn)
+            if ret is None:
+                ret = self.c_names[fn] = _c_name(fn)
+            return ret
+        return name or '?'
+
+    def write(self, write: typing.Callable[[str], typing.Any]):
+        for stack, n in sorted(self.stacks.items()):
+            write(f'{stack} {n}\n')
+
+def interrupt(pid: int):
+    try:
+        os.kill(pid, signal.SIGINT)
+    except ProcessLookupError:
+        pass
+
+def run(p: Profiler, hz: float, duration: float):
+    '''\
+Samples the selected inferior `hz` times per second for `duration` seconds.
+
+Sampling stops early if the inferior exits or stops for any other reason
+(e.g. a breakpoint), leaving it stopped there.\
+'''
+    inf = gdb.selected_inferior()
+    if not inf.pid:
+        raise Exception('profiling requires a running process')
+    last: list[gdb.StopEvent] = []
+    def on_stop(ev: gdb.StopEvent):
+        last[:] = (ev,)
+    gdb.events.stop.connect(on_stop)
+    try:
+        end = time.monotonic() + duration
+        while time.monotonic() < end:
+            last.clear()
+            t = threading.Timer(1 / hz, interrupt, (inf.pid,))
+            t.start()
+            try:
+                gdb.execute('continue', to_string=True)
+            finally:
+                t.cancel()
+            if not inf.pid or not last:
+                break
+            ev = last[0]
+            if not (
+                isinstance(ev, gdb.SignalEvent)
+                and ev.stop_signal == 'SIGINT'
+            ):
+                break
+            p.sample()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        gdb.events.stop.disconnect(on_stop)
+
+def profile(
+    lua: 'lua.Lua', L: typing.Optional[types.LuaState],
+    hz: float=DEFAULT_HZ, duration: float=DEFAULT_DURATION,
+    output: typing.Optional[str]=None, all_threads: bool=False,
+):
+    if L is not None and all_threads:
+        raise Exception('a state cannot be given with --all-threads')
+    p = Profiler(lua, None if L is None else int(L.v), all_threads)
+    run(p, hz, duration)
+    if output is None:
+        p.write(gdb.write)
+    else:
+        with open(output, 'w') as f:
+            p.write(f.write)
+    ms = 1000 * p.elapsed / p.samples if p.samples else 0
+    gdb.write(
+        f'{p.samples} samples, {p.empty} outside of Lua,'
+        f' {ms:.2f} ms per capture\n')
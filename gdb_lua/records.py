@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+'''\
+Machine-readable output of stacks and call stacks.
+
+Slots and frames are read directly from memory and written as they are
+decoded, one JSON object each, so that arbitrarily large stacks can be
+exported without building the whole result.  Both JSON lines (`jsonl`) and a
+single JSON array (`json`) are supported.\
+'''
+import json
+import typing
+
+import gdb
+
+from . import debug
+from . import heap
+from . import memory
+from . import threads
+from . import types
+
+if typing.TYPE_CHECKING:
+    from . import lua
+
+Record = dict[str, typing.Any]
+
+def parse_range(s: str) -> tuple[typing.Optional[int], typing.Optional[int]]:
+    'Parses `A:B` (either may be empty) into a pair of stack indices.'
+    a, sep, b = s.partition(':')
+    if not sep:
+        raise Exception(f'invalid range: {s}')
+    return (int(a) if a else None), (int(b) if b else None)
+
+def _index(i: typing.Optional[int], n: int, default: int) -> int:
+    if i is None:
+        return default
+    return n + i if i < 0 else i
+
+def stack_bounds(
+    lua: 'lua.Lua', L: int,
+    first: typing.Optional[int]=None, last: typing.Optional[int]=None,
+) -> tuple[int, int, int]:
+    '''\
+Address of the first slot of a state and the valid indices in `[first, last]`.
+
+Negative indices are relative to the top, as in the Lua API.\
+'''
+    s = types.read_fields(lua.layout.lua_state, L)
+    base, size = s['stack'], lua.layout.stack_value.size
+    n = (s['top'] - base) // size
+    first, last = _index(first, n, 1), _index(last, n, n - 1)
+    return base, max(1, first), min(n - 1, last)
+
+def _value(
+    lua: 'lua.Lua', r: memory.BlockReader, tt: int, bits: int,
+    ret: Record,
+) -> Record:
+    'Adds the type and decoded value of a raw value to `ret`.'
+    l = lua.layout
+    t, rtt = tt & types.TTYPE_MASK, types.RawTypeTag(tt)
+    ret['type'] = types.TYPE_NAMES[t] if t < len(types.TYPE_NAMES) else None
+    ret['tt'] = tt
+    if t == types.LUA_TBOOLEAN:
+        ret['value'] = lua.raw_toboolean(bits, rtt)
+    elif t == types.LUA_TNUMBER:
+        if lua.isinteger(rtt):
+            ret['value'] = lua.raw_integer(bits)
+        else:
+            # NaN and infinities are not valid JSON.
+            n = lua.raw_number(bits)
+            ret['value'] = n if n - n == 0 else repr(n)
+    elif t == types.LUA_TSTRING:
+        p = l.pointer(bits)
+        ret['pointer'] = p
+        ret['value'] = lua.read_string(p).decode(errors='replace')
+    elif tt == types.LUA_VLCF or t == types.LUA_TLIGHTUSERDATA:
+        ret['pointer'] = l.pointer(bits)
+    elif types.is_collectable(tt):
+        p = ret['pointer'] = l.pointer(bits)
+        if tt == types.LUA_VLCL | types.BIT_ISCOLLECTABLE:
+            proto = debug.proto(lua, r.unpack(l.lclosure, p)[1])
+            ret['source'] = proto.source
+            ret['linedefined'] = proto.linedefined
+    return ret
+
+def iter_stack(
+    lua: 'lua.Lua', L: int,
+    first: typing.Optional[int]=None, last: typing.Optional[int]=None,
+) -> typing.Iterator[Record]:
+    'Records of the stack slots of a state, optionally in `[first, last]`.'
+    r = memory.BlockReader()
+    base, first, last = stack_bounds(lua, L, first, last)
+    s = lua.layout.stack_value
+    slots = types.read_array(s, base + first * s.size, last - first + 1)
+    for i, (tt, bits) in enumerate(slots, first):
+        addr = base + i * s.size
+        yield _value(lua, r, tt, bits, {'index': i, 'address': addr})
+
+def iter_frames(lua: 'lua.Lua', L: int) -> typing.Iterator[Record]:
+    'Records of the frames of a state, innermost first.'
+    r = memory.BlockReader()
+    l = lua.layout
+    ci = types.read_fields(l.lua_state, L)['ci']
+    base = L + l.lua_state_base_ci
+    level = 0
+    while ci and ci != base:
+        func, prev, callstatus, savedpc = r.unpack(l.callinfo, ci)
+        tt, bits = r.unpack(l.stack_value, func)
+        ret = _value(
+            lua, r, tt, bits,
+            {'level': level, 'callinfo': ci, 'address': func})
+        if tt == types.LUA_VLCL | types.BIT_ISCOLLECTABLE:
+            p = debug.proto(lua, r.unpack(l.lclosure, l.pointer(bits))[1])
+            ret['line'] = debug.current_line(
+                p, debug.current_pc(lua, p, savedpc))
+        ret['tail'] = lua.is_tail(types.CallStatus(callstatus))
+        yield ret
+        ci, level = prev, level + 1
+
+def iter_all_frames(lua: 'lua.Lua', L: types.LuaState) \
+    -> typing.Iterator[Record] \
+:
+    'Records of the frames of every thread of a state, with its address.'
+    r = memory.BlockReader()
+    for addr in threads.iter_threads(lua, r, heap.global_state(lua, L)):
+        for x in iter_frames(lua, addr):
+            x['thread'] = addr
+            yield x
+
+def write(
+    records: typing.Iterable[Record], fmt: str,
+    write: typing.Callable[[str], typing.Any]=gdb.write,
+):
+    'Writes each record as it is produced, as JSON lines or a JSON array.'
+    if fmt == 'jsonl':
+        for x in records:
+            write(json.dumps(x) + '\n')
+        return
+    if fmt != 'json':
+        raise Exception(f'invalid format: {fmt}')
+    sep = '[\n'
+    for x in records:
+        write(sep + json.dumps(x))
+        sep = ',\n'
+    write('[]\n' if sep == '[\n' else '\n]\n')
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+import array
+import bisect
+import collections
+import typing
+
+import gdb
+
+from . import cache
+from . import heap
+from . import memory
+from . import types
+
+if typing.TYPE_CHECKING:
+    from . import lua
+
+TAG_BITS = 8
+TAG_MASK = (1 << TAG_BITS) - 1
+
+Path = tuple[str, list[tuple[int, str]]]
+
+class Index(object):
+    '''\
+Reverse references between all objects of a Lua state.
+
+The index is built in a single pass over the collector lists.  Objects are
+identified by their position in the sorted array `addrs`.  Referrers are
+stored in compressed sparse row form: those of object `i` are
+`src[start[i]:start[i + 1]]`, with the label of each edge in the same position
+of `label` (an index into `labels`).\
+'''
+    def __init__(self, lua: 'lua.Lua', L: types.LuaState):
+        r = memory.BlockReader()
+        g_addr = int(L.v['l_G'])
+        g = types.read_fields(lua.layout.global_state, g_addr)
+        refs = heap.ref_functions(lua)
+        self.labels: list[str] = []
+        labels: dict[str, int] = {}
+        objs = array.array('Q')
+        esrc, edst, elabel = \
+            array.array('Q'), array.array('Q'), array.array('I')
+        for addr, tt in heap.iter_objects(lua, r, g):
+            objs.append(addr << TAG_BITS | tt)
+            f = refs.get(tt & types.TTYPE_MASK)
+            if f is None:
+                continue
+            for x, label in f(lua, r, addr, tt):
+                i = labels.get(label)
+                if i is None:
+                    i = labels[label] = len(self.labels)
+                    self.labels.append(label)
+                esrc.append(addr)
+                edst.append(x)
+                elabel.append(i)
+        objs = array.array('Q', sorted(objs))
+        self.addrs = array.array('Q', (x >> TAG_BITS for x in objs))
+        self.tags = array.array('B', (x & TAG_MASK for x in objs))
+        del objs
+        self._build(esrc, edst, elabel)
+        self.roots = [
+            (i, name) for addr, name in heap.roots(lua, r, g_addr, g)
+            if (i := self.find(addr)) >= 0]
+
+    def _build(self, esrc: array.array, edst: array.array, elabel: array.array):
+        n, find = len(self.addrs), self.find
+        dst = array.array('q', map(find, edst))
+        start = array.array('I', [0]) * (n + 1)
+        for d in dst:
+            if d >= 0:
+                start[d + 1] += 1
+        for i in range(n):
+            start[i + 1] += start[i]
+        pos = array.array('I', start)
+        src = array.array('I', [0]) * start[n]
+        label = array.array('I', [0]) * start[n]
+        for s, d, l in zip(esrc, dst, elabel):
+            if d < 0:
+                continue
+            j = pos[d]
+            pos[d] = j + 1
+            src[j] = find(s)
+            label[j] = l
+        self.start, self.src, self.label = start, src, label
+
+    def __len__(self) -> int:
+        return len(self.addrs)
+
+    def find(self, addr: int) -> int:
+        'Position of the object at `addr`, or -1 if it is not in the index.'
+        addrs = self.addrs
+        i = bisect.bisect_left(addrs, addr)
+        return i if i < len(addrs) and addrs[i] == addr else -1
+
+    def referrers(self, i: int) -> typing.Iterator[tuple[int, str]]:
+        'Objects which reference object `i` and the label of each reference.'
+        labels, src, label = self.labels, self.src, self.label
+        for j in range(self.start[i], self.start[i + 1]):
+            yield src[j], labels[label[j]]
+
+    def paths(self, target: int, n: int) -> list[Path]:
+        '''\
+Shortest paths from the roots to object `target`, at most `n`.
+
+A breadth-first search is done backwards from the target, so each object is
+visited at most once and paths are returned in order of length.  Each path is
+the name of the root and the objects and labels of the edges which follow it.
+Paths do not go through other roots.\
+'''
+        roots = dict(self.roots)
+        nxt: dict[int, typing.Optional[tuple[int, str]]] = {target: None}
+        q = collections.deque((target,))
+        ret: list[Path] = []
+        while q and len(ret) < n:
+            i = q.popleft()
+            name = roots.get(i)
+            if name is not None:
+                ret.append((name, _walk(nxt, i)))
+                continue
+            for s, label in self.referrers(i):
+                if s not in nxt:
+                    nxt[s] = (i, label)
+                    q.append(s)
+        return ret
+
+def _walk(
+    nxt: dict[int, typing.Optional[tuple[int, str]]], i: int,
+) -> list[tuple[int, str]]:
+    ret = []
+    while (e := nxt[i]) is not None:
+        i, label = e
+        ret.append((i, label))
+    return ret
+
+def index(lua: 'lua.Lua', L: types.LuaState) -> Index:
+    'Reference index of a Lua state, built once until the inferior resumes.'
+    g = int(L.v['l_G'])
+    return cache.INDEXES.get('refs', g, lambda: Index(lua, L))
+
+def format_path(root: str, edges: typing.Iterable[tuple[int, str]]) -> str:
+    'Formats a path as an expression: `registry[2].name.upvalue[0]`.'
+    ret = [root]
+    for _, label in edges:
+        ret.append(label if label.startswith('[') else '.' + label)
+    return ''.join(ret)
+
+def dump(
+    lua: 'lua.Lua', L: types.LuaState, addr: int,
+    paths: int=5, referrers: int=20,
+):
+    idx = index(lua, L)
+    i = idx.find(addr)
+    if i < 0:
+        raise Exception(f'not a collectable object: {addr:#x}')
+    names = heap.kind_names(lua)
+    def kind(i: int) -> str:
+        return names.get(idx.tags[i] & types.TTYPE_MASK, 'unknown')
+    refs = list(idx.referrers(i))
+    gdb.write(f'{kind(i)} {addr:#x} referenced by {len(refs)} objects\n')
+    for s, label in refs[:referrers]:
+        gdb.write(f'  {idx.addrs[s]:#x} {kind(s)} {label}\n')
+    if len(refs) > referrers:
+        gdb.write(f'  ... ({len(refs) - referrers} more)\n')
+    found = idx.paths(i, paths)
+    if not found:
+        gdb.write('not reachable from any root\n')
+        return
+    gdb.write('paths from roots:\n')
+    for root, edges in found:
+        gdb.write(f'  {format_path(root, edges)}\n')
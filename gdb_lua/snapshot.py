@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+'''\
+Heap snapshot file format and offline analysis.
+
+Snapshots are written by `lua snapshot FILE` and can be read without gdb:
+
+    python -m gdb_lua.snapshot diff A B
+
+A file is a magic string followed by a sequence of self-delimiting records,
+so it can be streamed, appended to (each `lua snapshot` appends a new
+snapshot) and read up to the last complete record.  All integers are
+little-endian.
+
+- `B` `<d`: beginning of a snapshot (timestamp), resets the string table
+- `S` `<II` + data: interned string (id, length), id `0` is reserved for none
+- `R` `<QI`: root object (address, name string id)
+- `O` `<QIQII` + `n * <QI`: object (address, type string id, size, site string
+  id, number of references `n`) followed by references (address, label string
+  id)\
+'''
+import argparse
+import collections
+import re
+import struct
+import sys
+import time
+import typing
+
+MAGIC = b'gdb_lua snapshot\0\1'
+UNREACHABLE = '(unreachable)'
+INDEX_RE = re.compile(r'\[\d+\]')
+
+_BEGIN = struct.Struct('<d')
+_STRING = struct.Struct('<II')
+_ROOT = struct.Struct('<QI')
+_OBJECT = struct.Struct('<QIQII')
+_REF = struct.Struct('<QI')
+
+class Object(typing.NamedTuple):
+    kind: str
+    size: int
+    site: typing.Optional[str]
+    refs: list[tuple[int, str]]
+
+class Writer(object):
+    'Writes records for one snapshot to a binary file opened for appending.'
+    def __init__(self, f: typing.BinaryIO):
+        self.f = f
+        self.strings: dict[str, int] = {}
+        if not f.tell():
+            f.write(MAGIC)
+        f.write(b'B' + _BEGIN.pack(time.time()))
+
+    def intern(self, s: typing.Optional[str]) -> int:
+        if s is None:
+            return 0
+        ret = self.strings.get(s)
+        if ret is None:
+            ret = self.strings[s] = len(self.strings) + 1
+            b = s.encode(errors='surrogateescape')
+            self.f.write(b'S' + _STRING.pack(ret, len(b)) + b)
+        return ret
+
+    def root(self, addr: int, name: str):
+        self.f.write(b'R' + _ROOT.pack(addr, self.intern(name)))
+
+    def object(
+        self, addr: int, kind: str, size: int, site: typing.Optional[str],
+        refs: typing.Iterable[tuple[int, str]],
+    ):
+        intern = self.intern
+        data = b''.join(_REF.pack(x, intern(label)) for x, label in refs)
+        self.f.write(
+            b'O'
+            + _OBJECT.pack(
+                addr, intern(kind), size, intern(site),
+                len(data) // _REF.size)
+            + data)
+
+class Snapshot(object):
+    'All objects and roots of one snapshot.'
+    def __init__(self, timestamp: float):
+        self.timestamp = timestamp
+        self.roots: list[tuple[int, str]] = []
+        self.objects: dict[int, Object] = {}
+
+def _read(f: typing.BinaryIO, n: int) -> bytes:
+    ret = f.read(n)
+    if len(ret) != n:
+        raise EOFError()
+    return ret
+
+def read(path: str) -> typing.Iterator[Snapshot]:
+    'Yields each snapshot in a file, ignoring a truncated last record.'
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'not a snapshot file: {path}')
+        strings: dict[int, typing.Optional[str]] = {0: None}
+        ret: typing.Optional[Snapshot] = None
+        try:
+            while tag := f.read(1):
+                if tag == b'B':
+                    if ret is not None:
+                        yield ret
+                    ret = Snapshot(*_BEGIN.unpack(_read(f, _BEGIN.size)))
+                    strings = {0: None}
+                elif ret is None:
+                    raise ValueError(f'record outside of snapshot: {tag!r}')
+                elif tag == b'S':
+                    i, n = _STRING.unpack(_read(f, _STRING.size))
+                    strings[i] = _read(f, n).decode(errors='surrogateescape')
+                elif tag == b'R':
+                    addr, name = _ROOT.unpack(_read(f, _ROOT.size))
+                    ret.roots.append((addr, strings[name] or ''))
+                elif tag == b'O':
+                    addr, kind, size, site, n = \
+                        _OBJECT.unpack(_read(f, _OBJECT.size))
+                    data = _read(f, n * _REF.size)
+                    refs = [
+                        (x, strings[label] or '')
+                        for x, label in _REF.iter_unpack(data)]
+                    ret.objects[addr] = Object(
+                        strings[kind] or '', size, strings[site], refs)
+                else:
+                    raise ValueError(f'invalid record: {tag!r}')
+        except EOFError:
+            pass
+        if ret is not None:
+            yield ret
+
+def load(path: str, index: int=-1) -> Snapshot:
+    'Reads one snapshot from a file (by default, the last one).'
+    ret = list(read(path))
+    if not ret:
+        raise ValueError(f'no snapshots in file: {path}')
+    return ret[index]
+
+def retaining_paths(s: Snapshot, depth: int) -> dict[int, str]:
+    '''\
+Shortest path from a root to each object, truncated to `depth` edges.
+
+Paths are computed with a breadth-first search from the roots, in the order
+they were recorded.  Numeric indices are replaced with `[*]` so that elements
+of the same array share a path.  Objects which cannot be reached are not
+included.\
+'''
+    ret: dict[int, str] = {}
+    q: collections.deque = collections.deque()
+    for addr, name in s.roots:
+        if addr not in ret and addr in s.objects:
+            ret[addr] = name
+            q.append((addr, name, 0))
+    while q:
+        addr, path, d = q.popleft()
+        for x, label in s.objects[addr].refs:
+            if x in ret or x not in s.objects:
+                continue
+            if d < depth:
+                p = f'{path}/{INDEX_RE.sub("[*]", label)}'
+            else:
+                p = path
+            ret[x] = p
+            q.append((x, p, d + 1))
+    return ret
+
+class Summary(object):
+    'Object counts and sizes of a snapshot, grouped in several ways.'
+    def __init__(self, s: Snapshot, depth: int):
+        self.by_kind = _group(
+            (o.kind, o.size) for o in s.objects.values())
+        self.by_site = _group(
+            (o.site, o.size) for o in s.objects.values() if o.site)
+        paths = retaining_paths(s, depth)
+        self.by_path = _group(
+            (paths.get(addr, UNREACHABLE), o.size)
+            for addr, o in s.objects.items())
+
+def _group(it: typing.Iterable[tuple[typing.Any, int]]) \
+    -> dict[typing.Any, tuple[int, int]] \
+:
+    count: collections.Counter = collections.Counter()
+    size: collections.Counter = collections.Counter()
+    for k, n in it:
+        count[k] += 1
+        size[k] += n
+    return {k: (count[k], size[k]) for k in count}
+
+def _diff(
+    a: dict[typing.Any, tuple[int, int]],
+    b: dict[typing.Any, tuple[int, int]],
+) -> list[tuple[int, int, typing.Any]]:
+    'Growth in size and count per key, largest size growth first.'
+    ret = []
+    for k in a.keys() | b.keys():
+        ac, asz = a.get(k, (0, 0))
+        bc, bsz = b.get(k, (0, 0))
+        ret.append((bsz - asz, bc - ac, k))
+    ret.sort(key=lambda x: (-x[0], -x[1], str(x[2])))
+    return ret
+
+def diff(a: Snapshot, b: Snapshot, depth: int, top: int, out: typing.TextIO):
+    sa, sb = Summary(a, depth), Summary(b, depth)
+    out.write(
+        f'{"type":<14}{"count A":>12}{"count B":>12}{"delta":>12}'
+        f'{"bytes A":>14}{"bytes B":>14}{"delta":>14}\n')
+    for dsize, dcount, kind in _diff(sa.by_kind, sb.by_kind):
+        ac, asz = sa.by_kind.get(kind, (0, 0))
+        bc, bsz = sb.by_kind.get(kind, (0, 0))
+        out.write(
+            f'{kind:<14}{ac:>12}{bc:>12}{dcount:>+12}'
+            f'{asz:>14}{bsz:>14}{dsize:>+14}\n')
+    for title, da, db in (
+        ('site', sa.by_site, sb.by_site),
+        ('retaining path', sa.by_path, sb.by_path),
+    ):
+        out.write(f'\ngrowth by {title}:\n')
+        for dsize, dcount, k in _diff(da, db)[:top]:
+            if dsize <= 0 and dcount <= 0:
+                break
+            out.write(f'{dsize:>+14} bytes {dcount:>+10} objects  {k}\n')
+
+def main(args: typing.Sequence[str]) -> int:
+    p = argparse.ArgumentParser(
+        prog='python -m gdb_lua.snapshot',
+        description='Analyze heap snapshots written by `lua snapshot`.')
+    sub = p.add_subparsers(dest='cmd', required=True)
+    d = sub.add_parser('diff', help='compare two snapshots')
+    d.add_argument('a', help='snapshot file of the baseline')
+    d.add_argument('b', help='snapshot file to compare to the baseline')
+    d.add_argument(
+        '--depth', type=int, default=4,
+        help='maximum number of edges in retaining paths (default: 4)')
+    d.add_argument(
+        '--top', type=int, default=20,
+        help='number of sites and paths listed (default: 20)')
+    opts = p.parse_args(args)
+    diff(load(opts.a), load(opts.b), opts.depth, opts.top, sys.stdout)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
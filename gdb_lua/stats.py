@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+'''\
+Instrumentation of the hot paths of the extension itself.
+
+With `set lua instrumentation on`, the functions in `TARGETS` are replaced by
+wrappers which count calls, inclusive wall time and, for the memory backends,
+bytes read.  Functions which return iterators are also timed while the
+iterator is consumed, excluding the consumer.  Statistics are kept separately
+for each command, which is recorded while it runs, so that the work done by
+each can be told apart.  The original functions are restored when
+instrumentation is disabled, so that it costs nothing when off; only the
+commands check a flag at each invocation.\
+'''
+import collections
+import functools
+import importlib
+import json
+import time
+import typing
+
+import gdb
+
+# Module, attribute and kind of each instrumented function: `call`, `iter`
+# (returns an iterator) or `read` (a `Memory.read`, counts bytes).  Methods are
+# replaced in the class which defines them and in every subclass which
+# overrides them.
+TARGETS = (
+    ('lua', 'lua', 'call'),
+    ('lua', 'Lua.gc', 'call'),
+    ('lua', 'Lua.string_contents', 'call'),
+    ('lua', '_iter_call_stack', 'iter'),
+    ('printing', '_iter_array', 'iter'),
+    ('printing', '_iter_hash', 'iter'),
+    ('printing', '_raw_child', 'call'),
+    ('printing', 'TValuePrinter.create', 'call'),
+    ('printing', 'NodeKeyPrinter.create', 'call'),
+    ('printing', 'ValuePrinter.to_string', 'call'),
+    ('printing', 'ValuePrinter.children', 'iter'),
+    ('backend', 'InferiorMemory.read', 'read'),
+    ('backend', 'ProcMemory.read', 'read'),
+    ('backend', 'CoreMemory.read', 'read'),
+)
+
+class Stat(object):
+    __slots__ = ('calls', 'seconds', 'bytes')
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.bytes = 0
+
+# Label of the totals of a command and of the calls made outside of any.
+TOTAL = 'total'
+NO_COMMAND = '(no command)'
+
+# Statistics by command and function.
+STATS: collections.defaultdict[tuple[str, str], Stat] = \
+    collections.defaultdict(Stat)
+ENABLED = False
+_COMMAND = NO_COMMAND
+# Attributes replaced while enabled: owner, name and original value.
+_PATCHED: list[tuple[typing.Any, str, typing.Any]] = []
+
+def _call(name: str, f: typing.Callable) -> typing.Callable:
+    @functools.wraps(f)
+    def ret(*args, **kwargs):
+        s = STATS[_COMMAND, name]
+        s.calls += 1
+        t = time.perf_counter()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            s.seconds += time.perf_counter() - t
+    return ret
+
+def _read(name: str, f: typing.Callable) -> typing.Callable:
+    @functools.wraps(f)
+    def ret(self, addr: int, n: int) -> bytes:
+        s = STATS[_COMMAND, name]
+        s.calls += 1
+        s.bytes += n
+        STATS[_COMMAND, TOTAL].bytes += n
+        t = time.perf_counter()
+        try:
+            return f(self, addr, n)
+        finally:
+            s.seconds += time.perf_counter() - t
+    return ret
+
+def _timed_iter(s: Stat, it: typing.Iterable) -> typing.Iterator:
+    it = iter(it)
+    while True:
+        t = time.perf_counter()
+        try:
+            x = next(it)
+        except StopIteration:
+            return
+        finally:
+            s.seconds += time.perf_counter() - t
+        yield x
+
+def _iter(name: str, f: typing.Callable) -> typing.Callable:
+    @functools.wraps(f)
+    def ret(*args, **kwargs):
+        s = STATS[_COMMAND, name]
+        s.calls += 1
+        t = time.perf_counter()
+        try:
+            it = f(*args, **kwargs)
+        finally:
+            s.seconds += time.perf_counter() - t
+        return _timed_iter(s, it)
+    return ret
+
+_WRAPPERS = {'call': _call, 'iter': _iter, 'read': _read}
+
+def _owners(module: typing.Any, path: str) -> list[tuple[typing.Any, str]]:
+    'Objects which define the attribute at `path`, relative to `module`.'
+    *names, attr = path.split('.')
+    if not names:
+        return [(module, attr)]
+    cls = module
+    for x in names:
+        cls = getattr(cls, x)
+    ret, todo = [], [cls]
+    while todo:
+        c = todo.pop()
+        if attr in vars(c):
+            ret.append((c, attr))
+        todo.extend(c.__subclasses__())
+    return ret
+
+def _wrap(v: typing.Any, wrap: typing.Callable) -> typing.Any:
+    if isinstance(v, staticmethod):
+        return staticmethod(wrap(v.__func__))
+    if isinstance(v, classmethod):
+        return classmethod(wrap(v.__func__))
+    return wrap(v)
+
+def _patch():
+    for module, path, kind in TARGETS:
+        m = importlib.import_module(f'{__package__}.{module}')
+        name = f'{module}.{path}'
+        for owner, attr in _owners(m, path):
+            v = vars(owner)[attr]
+            _PATCHED.append((owner, attr, v))
+            wrap = functools.partial(_WRAPPERS[kind], name)
+            setattr(owner, attr, _wrap(v, wrap))
+
+def _unpatch():
+    while _PATCHED:
+        owner, attr, v = _PATCHED.pop()
+        setattr(owner, attr, v)
+
+def set_enabled(v: bool):
+    global ENABLED
+    if v == ENABLED:
+        return
+    ENABLED = v
+    if v:
+        _patch()
+    else:
+        _unpatch()
+
+def reset():
+    STATS.clear()
+
+def command(name: str, f: typing.Callable) -> typing.Callable:
+    '''\
+Wraps the `invoke` method of a command to record its wall time and attribute
+the calls made while it runs to it.\
+'''
+    def invoke(*args):
+        global _COMMAND
+        if not ENABLED:
+            return f(*args)
+        prev, _COMMAND = _COMMAND, name
+        s = STATS[name, TOTAL]
+        s.calls += 1
+        t = time.perf_counter()
+        try:
+            return f(*args)
+        finally:
+            s.seconds += time.perf_counter() - t
+            _COMMAND = prev
+    return invoke
+
+def as_dict() -> dict[str, dict[str, dict[str, typing.Union[int, float]]]]:
+    'Statistics by command and function, `total` being those of the command.'
+    ret: dict[str, dict[str, dict[str, typing.Union[int, float]]]] = {}
+    for (cmd, name), v in STATS.items():
+        # Bytes read outside of commands are counted without a call.
+        if v.calls or v.bytes:
+            ret.setdefault(cmd, {})[name] = {
+                'calls': v.calls, 'seconds': v.seconds, 'bytes': v.bytes}
+    return ret
+
+def dump_json(path: typing.Optional[str]=None):
+    s = json.dumps(as_dict(), indent=2, sort_keys=True) + '\n'
+    if path is None:
+        gdb.write(s)
+    else:
+        with open(path, 'w') as f:
+            f.write(s)
+
+def dump():
+    if not ENABLED:
+        gdb.write('instrumentation is off, see `set lua instrumentation`\n')
+    cmds = as_dict()
+    def seconds(cmd: str) -> float:
+        total = cmds[cmd].get(TOTAL)
+        return total['seconds'] if total else 0.0
+    sep = ''
+    for cmd in sorted(cmds, key=lambda x: -seconds(x)):
+        rows = sorted(cmds[cmd].items(), key=lambda x: -x[1]['seconds'])
+        gdb.write(
+            f'{sep}{cmd}\n{"calls":>10}{"seconds":>12}{"per call":>12}'
+            f'{"bytes":>14}  function\n')
+        for k, v in rows:
+            per = v['seconds'] / v['calls'] * 1e6 if v['calls'] else 0.0
+            gdb.write(
+                f'{v["calls"]:>10}{v["seconds"]:>12.4f}{per:>10.1f}us'
+                f'{v["bytes"]:>14}  {k}\n')
+        sep = '\n'
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+import collections
+import heapq
+import typing
+
+import gdb
+
+from . import debug
+from . import heap
+from . import memory
+from . import types
+
+if typing.TYPE_CHECKING:
+    from . import lua
+
+STATUS_NAMES = ('ok', 'yield', 'errrun', 'errsyntax', 'errmem')
+MAX_ADDRESSES = 8
+DEFAULT_TOP = 20
+# Bound on the length of open upvalue lists, in case of corruption.
+MAX_UPVALUES = 1 << 20
+HISTOGRAM_WIDTH = 40
+
+# Identity of a frame: raw type tag, function (the `Proto` for Lua
+# functions), current instruction and whether it was tail called.
+Frame = tuple[int, int, int, bool]
+Stack = tuple[int, tuple[Frame, ...]]
+
+def iter_threads(
+    lua: 'lua.Lua', r: memory.BlockReader, g: dict[str, int],
+) -> typing.Iterator[int]:
+    'Addresses of every thread, from the collector lists and `twups`.'
+    seen = set()
+    for addr, tt in heap.iter_objects(lua, r, g):
+        if tt & types.TTYPE_MASK == types.LUA_TTHREAD:
+            seen.add(addr)
+            yield addr
+    # Threads which are not in the list point to themselves.
+    s, p = lua.layout.lua_state_twups, g['twups']
+    visited = set()
+    while p and p not in visited:
+        visited.add(p)
+        if p not in seen:
+            seen.add(p)
+            yield p
+        p, = r.unpack(s, p)
+
+ProtoFn = typing.Callable[['lua.Lua', int], debug.Proto]
+
+def _frame(
+    lua: 'lua.Lua', r: memory.BlockReader, proto: ProtoFn,
+    tt: int, bits: int, savedpc: int, tail: bool,
+) -> Frame:
+    l = lua.layout
+    if tt == types.LUA_VLCL | types.BIT_ISCOLLECTABLE:
+        _, p = r.unpack(l.lclosure, l.pointer(bits))
+        pc = debug.current_pc(lua, proto(lua, p), savedpc)
+        return tt, p, pc, tail
+    if tt == types.LUA_VCCL | types.BIT_ISCOLLECTABLE:
+        _, f = r.unpack(l.cclosure, l.pointer(bits))
+        return tt, f, 0, tail
+    if tt == types.LUA_VLCF:
+        return tt, l.pointer(bits), 0, tail
+    return tt, 0, 0, tail
+
+def _frames(
+    lua: 'lua.Lua', r: memory.BlockReader, L: int, ci: int, proto: ProtoFn,
+) -> typing.Iterator[Frame]:
+    l = lua.layout
+    base = L + l.lua_state_base_ci
+    while ci and ci != base:
+        func, prev, callstatus, savedpc = r.unpack(l.callinfo, ci)
+        tt, bits = r.unpack(l.stack_value, func)
+        tail = lua.is_tail(types.CallStatus(callstatus))
+        yield _frame(lua, r, proto, tt, bits, savedpc, tail)
+        ci = prev
+
+def stack(
+    lua: 'lua.Lua', r: memory.BlockReader, L: int,
+    proto: ProtoFn=debug.proto,
+) -> Stack:
+    '''\
+Status and frames of a thread, read directly from memory.
+
+Frames are identified by their functions and current instructions rather than
+by the address of each closure, so that threads executing the same code
+compare equal.  Prototypes are decoded with `proto`.\
+'''
+    status, _, _, _, ci, _, _, _ = r.unpack(lua.layout.lua_state, L)
+    return status, tuple(_frames(lua, r, L, ci, proto))
+
+def lua_frame(
+    lua: 'lua.Lua', r: memory.BlockReader, L: int,
+    proto: ProtoFn=debug.proto,
+) -> typing.Optional[tuple[int, int]]:
+    'Prototype and current instruction of the innermost Lua function.'
+    _, _, _, _, ci, _, _, _ = r.unpack(lua.layout.lua_state, L)
+    for tt, fn, pc, _ in _frames(lua, r, L, ci, proto):
+        if tt == types.LUA_VLCL | types.BIT_ISCOLLECTABLE:
+            return fn, pc
+    return None
+
+def _status_name(status: int) -> str:
+    return STATUS_NAMES[status] if status < len(STATUS_NAMES) else str(status)
+
+def dump_all(lua: 'lua.Lua', L: types.LuaState):
+    'Prints the call stack of every thread, grouping identical stacks.'
+    r = memory.BlockReader()
+    groups: dict[Stack, list[int]] = collections.defaultdict(list)
+    for addr in iter_threads(lua, r, heap.global_state(lua, L)):
+        groups[stack(lua, r, addr)].append(addr)
+    total = sum(map(len, groups.values()))
+    gdb.write(f'{total} threads, {len(groups)} distinct stacks\n')
+    t = lua.lua_state.pointer()
+    for (status, _), addrs in sorted(groups.items(), key=lambda x: -len(x[1])):
+        shown = ', '.join(f'{x:#x}' for x in addrs[:MAX_ADDRESSES])
+        if len(addrs) > MAX_ADDRESSES:
+            shown += f' (and {len(addrs) - MAX_ADDRESSES} more)'
+        n = len(addrs)
+        gdb.write(
+            f'\n{n} thread{"s" if n != 1 else ""}'
+            f' ({_status_name(status)}): {shown}\n')
+        lua.dump_call_stack(types.LuaState(gdb.Value(addrs[0]).cast(t)))
+
+class Footprint(typing.NamedTuple):
+    addr: int
+    status: int
+    # Allocated and used stack slots.
+    stacksize: int
+    used: int
+    nci: int
+    upvalues: int
+    # Sizes of the stack and `CallInfo` list, in bytes.
+    stack_bytes: int
+    ci_bytes: int
+
+    def bytes(self, sizes: dict[str, int]) -> int:
+        return sizes['thread'] + self.stack_bytes + self.ci_bytes
+
+def _open_upvalues(lua: 'lua.Lua', r: memory.BlockReader, p: int) -> int:
+    s, ret = lua.layout.upval_next, 0
+    while p and ret < MAX_UPVALUES:
+        ret += 1
+        p, = r.unpack(s, p)
+    return ret
+
+def footprint(lua: 'lua.Lua', r: memory.BlockReader, L: int) -> Footprint:
+    '''\
+Memory used by a thread, read directly from memory.
+
+`StkIdRel` fields only hold offsets while the stack is being reallocated, so
+`top`, `stack` and `stack_last` are read as pointers in every version.\
+'''
+    l = lua.layout
+    sizes = l.sizes
+    status, nci, top, _, _, stack_last, stack, openupval = \
+        r.unpack(l.lua_state, L)
+    slot = sizes['stack']
+    n = used = 0
+    if stack:
+        n = (stack_last - stack) // slot + heap.EXTRA_STACK
+        used = (top - stack) // slot
+    return Footprint(
+        L, status, n, used, nci, _open_upvalues(lua, r, openupval),
+        n * slot, nci * sizes['callinfo'])
+
+def _size_bucket(n: int) -> int:
+    'Smallest power of two greater than or equal to `n`.'
+    return 1 << max(0, n - 1).bit_length()
+
+def dump_footprints(lua: 'lua.Lua', L: types.LuaState, top: int=DEFAULT_TOP):
+    '''\
+Prints the memory used by the stacks and `CallInfo` lists of every thread,
+largest first, with totals per status and a histogram of sizes.\
+'''
+    r = memory.BlockReader()
+    sizes = lua.layout.sizes
+    count = total = stack_bytes = ci_bytes = upvalues = 0
+    statuses: collections.Counter = collections.Counter()
+    hist: collections.Counter = collections.Counter()
+    largest: list[tuple[int, int, Footprint]] = []
+    for addr in iter_threads(lua, r, heap.global_state(lua, L)):
+        f = footprint(lua, r, addr)
+        n = f.bytes(sizes)
+        count += 1
+        total += n
+        stack_bytes += f.stack_bytes
+        ci_bytes += f.ci_bytes
+        upvalues += f.upvalues
+        statuses[f.status] += 1
+        hist[_size_bucket(n)] += 1
+        x = (n, -count, f)
+        if len(largest) < top:
+            heapq.heappush(largest, x)
+        elif x > largest[0]:
+            heapq.heapreplace(largest, x)
+    gdb.write(
+        f'{count} threads, {total} bytes: {stack_bytes} in stacks,'
+        f' {ci_bytes} in CallInfo lists, {upvalues} open upvalues\n')
+    gdb.write('status: ' + ', '.join(
+        f'{_status_name(k)} {v}' for k, v in sorted(statuses.items())) + '\n')
+    if hist:
+        gdb.write('bytes:\n')
+        width = max(hist.values())
+        for k, v in sorted(hist.items()):
+            bar = '#' * max(1, v * HISTOGRAM_WIDTH // width)
+            gdb.write(f'{"<= " + str(k):>14}{v:>10}  {bar}\n')
+    if not largest:
+        return
+    gdb.write(
+        f'\n{"address":<18}{"status":<10}{"stack":>10}{"used":>10}'
+        f'{"nci":>8}{"upvals":>8}{"bytes":>12}\n')
+    for n, _, f in sorted(largest, reverse=True):
+        gdb.write(
+            f'{f.addr:<#18x}{_status_name(f.status):<10}{f.stacksize:>10}'
+            f'{f.used:>10}{f.nci:>8}{f.upvalues:>8}{n:>12}\n')
@@ -1,12 +1,18 @@
 #!/usr/bin/env python3
+import operator
+import struct
 import typing
 
 import gdb
 
+from . import backend
+from . import cache
+
 if typing.TYPE_CHECKING:
     from . import lua
 
 TTYPE_MASK = 0b1111
+BIT_ISCOLLECTABLE = 1 << 6
 VARIANT_SHIFT = 4
 VARIANT_MASK = 0b11
 
@@ -19,11 +25,21 @@ LUA_TTABLE = 5
 LUA_TFUNCTION = 6
 LUA_TUSERDATA = 7
 LUA_TTHREAD = 8
+LUA_NUMTAGS = 9
+
+READ_CHUNK = 1 << 22
+_UINT_CODES = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+_FLT_CODES = {4: 'f', 8: 'd'}
 
 VARIANT_LUA_CLOSURE = 0
 VARIANT_LIGHT_CFUNCTION = 1
 VARIANT_C_CLOSURE = 2
 
+LUA_VLNGSTR = LUA_TSTRING | (1 << VARIANT_SHIFT)
+LUA_VLCL = LUA_TFUNCTION | (VARIANT_LUA_CLOSURE << VARIANT_SHIFT)
+LUA_VLCF = LUA_TFUNCTION | (VARIANT_LIGHT_CFUNCTION << VARIANT_SHIFT)
+LUA_VCCL = LUA_TFUNCTION | (VARIANT_C_CLOSURE << VARIANT_SHIFT)
+
 TYPE_NAMES = (
     'nil',
     'boolean',
@@ -66,6 +82,96 @@ class TypeVariant(object):
     def __init__(self, tt: RawTypeTag):
         self.v = (tt.v >> VARIANT_SHIFT) & VARIANT_MASK
 
+class RawTValue(typing.NamedTuple):
+    'A tagged value decoded from raw memory: address, raw type tag, value bits.'
+    addr: int
+    tt: int
+    bits: int
+
+class RawStruct(object):
+    '''\
+Decoder for a subset of the fields of a C type, read from raw memory.
+
+Fields are given as dotted paths and unpacked in the order they are given,
+regardless of their order in memory.\
+'''
+    __slots__ = ('s', 'size', 'get', 'names', 'offsets')
+
+    def __init__(
+        self, order: str, t: gdb.Type, *paths: str,
+        signed: typing.Container[str]=(),
+    ):
+        fields = sorted(
+            ((offsetof(t, p), i, p) for i, p in enumerate(paths)),
+            key=lambda x: (x[0][0], x[1]))
+        fmt, pos = [order], 0
+        for (off, ft), _, p in fields:
+            if off < pos:
+                raise LuaInitializationFailed(f'overlapping field: {p}')
+            if pos < off:
+                fmt.append(f'{off - pos}x')
+            code = _field_code(ft)
+            fmt.append(code.lower() if p in signed else code)
+            pos = off + ft.sizeof
+        if pos < t.sizeof:
+            fmt.append(f'{t.sizeof - pos}x')
+        self.s = struct.Struct(''.join(fmt))
+        self.size = t.sizeof
+        self.names = paths
+        self.offsets = {p: off for (off, _), _, p in fields}
+        self.get = self._getter()
+
+    def _getter(self) -> typing.Optional[typing.Callable]:
+        'Reorders fields unpacked in memory order to the order of `names`.'
+        fields = sorted(
+            enumerate(self.names), key=lambda x: (self.offsets[x[1]], x[0]))
+        idx = [0] * len(fields)
+        for j, (i, _) in enumerate(fields):
+            idx[i] = j
+        return None if idx == sorted(idx) else operator.itemgetter(*idx)
+
+    def as_dict(self) -> dict[str, typing.Any]:
+        'Serializable form of the decoder, see `from_dict`.'
+        return {
+            'format': self.s.format, 'size': self.size,
+            'names': list(self.names), 'offsets': self.offsets}
+
+    @classmethod
+    def from_dict(cls, d: typing.Any) -> 'RawStruct':
+        'Decoder saved with `as_dict`, raises `ValueError` if it is invalid.'
+        try:
+            fmt, size, names, offsets = \
+                d['format'], d['size'], d['names'], d['offsets']
+            s = struct.Struct(fmt)
+        except (TypeError, KeyError, struct.error) as e:
+            raise ValueError(f'invalid struct: {e}')
+        # Sizes are bounded before the format is used to decode anything.
+        if type(size) is not int or s.size != size or size > 1 << 16 \
+                or not isinstance(names, list) \
+                or not all(isinstance(x, str) for x in names) \
+                or not isinstance(offsets, dict) \
+                or sorted(offsets) != sorted(names) \
+                or not all(
+                    type(x) is int and 0 <= x < size
+                    for x in offsets.values()) \
+                or len(s.unpack_from(bytes(size))) != len(names):
+            raise ValueError(f'invalid struct: {d}')
+        ret = cls.__new__(cls)
+        ret.s, ret.size, ret.names, ret.offsets = s, size, tuple(names), offsets
+        ret.get = ret._getter()
+        return ret
+
+    def unpack_from(self, buf, off: int=0) -> tuple:
+        ret = self.s.unpack_from(buf, off)
+        return self.get(ret) if self.get else ret
+
+    def iter_unpack(self, buf) -> typing.Iterator[tuple]:
+        ret = self.s.iter_unpack(buf)
+        return map(self.get, ret) if self.get else ret
+
+# Decoders accepted where only `size` and the `unpack` methods are used.
+Struct = typing.Union[RawStruct, struct.Struct]
+
 class GC(GDBValue):
     def to_string(self) -> TString: return TString(self.v['ts'])
     def to_hash(self) -> 'Hash': return Hash(self.v['h'])
@@ -90,25 +196,94 @@ class LClosure(GDBValue):
        self.v = lua.gc(v).to_lclosure()
 
     def location(self, lua: 'lua.Lua') -> typing.Optional[str]:
-        proto = self.v['p']
-        src = lua.string_contents(
-            TString(proto['source'].dereference())).string()
-        if src and src[0] == '@':
-            ret = src[1:]
-        else:
-            ret = '[string "{}"]'.format(src.replace('\n', '\\n'))
-        line = proto['linedefined']
-        if line == 0:
-            ret += ' in main chunk'
-        else:
-            # TODO getcurrentline
-            ret += ':' + str(line)
-        return ret
+        p = int(self.v['p'])
+        return proto_location(lua, p)
 
 class CallInfo(GDBValue):
     def callstatus(self) -> CallStatus:
         return CallStatus(self.v['callstatus'])
 
+def _field_code(t: gdb.Type) -> str:
+    t = t.strip_typedefs()
+    if t.code == gdb.TYPE_CODE_FLT:
+        return _FLT_CODES[t.sizeof]
+    return _UINT_CODES[t.sizeof]
+
+def uint_struct(order: str, size: int) -> struct.Struct:
+    return struct.Struct(order + _UINT_CODES[size])
+
+def int_struct(order: str, size: int) -> struct.Struct:
+    return struct.Struct(order + _UINT_CODES[size].lower())
+
+def offsetof(t: gdb.Type, path: str) -> tuple[int, gdb.Type]:
+    'Byte offset and type of the (possibly nested) field `path` of `t`.'
+    off = 0
+    for name in path.split('.'):
+        f = next(
+            (f for f in t.strip_typedefs().fields() if f.name == name), None)
+        if f is None:
+            raise LuaInitializationFailed(f'field not found: {t}.{name}')
+        off += f.bitpos // 8
+        t = f.type
+    return off, t
+
+def byte_order() -> str:
+    'Returns the `struct` byte order character for the current target.'
+    s = gdb.execute('show endian', to_string=True)
+    return '>' if 'big endian' in s else '<'
+
+def read_struct(s: Struct, addr: int) -> tuple:
+    return s.unpack_from(backend.current().read(addr, s.size))
+
+def read_fields(s: RawStruct, addr: int) -> dict[str, int]:
+    return dict(zip(s.names, read_struct(s, addr)))
+
+def read_array(s: Struct, addr: int, n: int, first: int=0) \
+    -> typing.Iterator[tuple] \
+:
+    '''\
+Decodes `n` contiguous `s` objects, reading memory in large blocks.
+
+If `first` is not zero, the first block contains that many objects and the
+size of each subsequent block doubles, so that consumers which stop early do
+not read the entire array.\
+'''
+    if not n:
+        return
+    max_step = max(1, READ_CHUNK // s.size)
+    step = min(first, max_step) if first else max_step
+    mem = backend.current()
+    i = 0
+    while i < n:
+        k = min(step, n - i)
+        buf = mem.read(addr + i * s.size, k * s.size)
+        yield from s.iter_unpack(buf)
+        i += k
+        step = min(2 * step, max_step)
+
+def proto_location(lua: 'lua.Lua', p: int) -> str:
+    'Source and line where the function of a `Proto` is defined.'
+    return cache.OBJECTS.get('location', p, lambda: _location(lua, p))
+
+def chunk_name(lua: 'lua.Lua', source: int) -> str:
+    'Formats the `source` string of a `Proto` for messages.'
+    if not source:
+        return '?'
+    src = lua.read_string(source).decode(errors='replace')
+    if src and src[0] == '@':
+        return src[1:]
+    return '[string "{}"]'.format(src.replace('\n', '\\n'))
+
+def _location(lua: 'lua.Lua', p: int) -> str:
+    proto = read_fields(lua.layout.proto, p)
+    ret = chunk_name(lua, proto['source'])
+    line = proto['linedefined']
+    if line == 0:
+        ret += ' in main chunk'
+    else:
+        ret += ':' + str(line)
+    return ret
+
 def tt(v: TValue) -> RawTypeTag: return RawTypeTag(int(v.v['tt_']))
 def ttype(v: TValue) -> TypeTag: return TypeTag(tt(v))
 def tvalue(v: TValue) -> Value: return Value(v.v['value_'])
@@ -119,6 +294,7 @@ def array_cap(l: 'lua.Lua', h: Hash) -> int:
 def hash_cap(h: Hash) -> int:
     return 1 << int(h.v['lsizenode'])
 
+def is_collectable(tt: int) -> bool: return bool(tt & BIT_ISCOLLECTABLE)
 def is_nil(tt: TypeTag): return tt.v == LUA_TNIL
 def is_string(tt: TypeTag): return tt.v == LUA_TSTRING
 def is_table(tt: TypeTag): return tt.v == LUA_TTABLE
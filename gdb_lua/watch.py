@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+'''\
+Incremental display of a Lua stack at each stop.
+
+The slots between `stack` and `top` are read in a single block at each stop
+and compared with those of the previous stop by index, so that only pushed,
+popped and modified slots are printed.  Call frames are compared by
+`CallInfo` address and function, outermost first.\
+'''
+import typing
+
+import gdb
+
+from . import backend
+from . import debug
+from . import lua
+from . import memory
+from . import printing
+from . import types
+
+# Raw type tag and value bits of each slot, and `(CallInfo, func)` of each
+# frame, innermost first.
+Slots = list[tuple[int, int]]
+Frames = list[tuple[int, int]]
+
+class Snapshot(typing.NamedTuple):
+    stack: int
+    slots: Slots
+    frames: Frames
+
+def snapshot(lua: 'lua.Lua', L: int) -> Snapshot:
+    l = lua.layout
+    s = types.read_fields(l.lua_state, L)
+    stack, top, ci = s['stack'], s['top'], s['ci']
+    size = l.stack_value.size
+    n = (top - stack) // size
+    slots: Slots = []
+    if n > 0:
+        buf = backend.current().read(stack, n * size)
+        slots = list(l.stack_value.iter_unpack(buf))
+    r = memory.BlockReader()
+    frames = []
+    base = L + l.lua_state_base_ci
+    while ci and ci != base:
+        func, prev, _, _ = r.unpack(l.callinfo, ci)
+        frames.append((ci, func))
+        ci = prev
+    return Snapshot(stack, slots, frames)
+
+def _format(lua: 'lua.Lua', addr: int, tt: int, bits: int) -> str:
+    t = tt & types.TTYPE_MASK
+    name = types.TYPE_NAMES[t] if t < len(types.TYPE_NAMES) else str(tt)
+    try:
+        v = printing.format_value(lua, types.RawTValue(addr, tt, bits))
+    except gdb.error:
+        # e.g. popped values which have since been collected.
+        return name
+    return f'{name} {v}'
+
+def _frame(lua: 'lua.Lua', ci: int, func: int) -> str:
+    l = lua.layout
+    tt, bits = types.read_struct(l.stack_value, func)
+    ret = f'{ci:#x} {_format(lua, func, tt, bits)}'
+    if tt == types.LUA_VLCL | types.BIT_ISCOLLECTABLE:
+        _, p = types.read_struct(l.lclosure, l.pointer(bits))
+        _, _, _, savedpc = types.read_struct(l.callinfo, ci)
+        p = debug.proto(lua, p)
+        line = debug.current_line(p, debug.current_pc(lua, p, savedpc))
+        ret += f' {p.source}:{"?" if line is None else line}'
+    return ret
+
+def write_diff(
+    lua: 'lua.Lua', old: Snapshot, new: Snapshot,
+    write: typing.Callable[[str], typing.Any]=gdb.write,
+) -> bool:
+    '''\
+Prints the slots and frames which differ between two snapshots, returns
+whether there were any.\
+'''
+    changed = False
+    def out(s: str):
+        nonlocal changed
+        changed = True
+        write(s)
+    size = lua.layout.stack_value.size
+    if old.stack != new.stack:
+        out(f'stack moved: {old.stack:#x} -> {new.stack:#x}\n')
+    n0, n1 = len(old.slots), len(new.slots)
+    if n0 != n1:
+        out(f'top: {n0 - 1} -> {n1 - 1} ({n1 - n0:+})\n')
+    for i in range(1, max(n0, n1)):
+        v0 = old.slots[i] if i < n0 else None
+        v1 = new.slots[i] if i < n1 else None
+        if v0 == v1:
+            continue
+        s0 = None if v0 is None else _format(lua, old.stack + i * size, *v0)
+        s1 = None if v1 is None else _format(lua, new.stack + i * size, *v1)
+        if s1 is None:
+            out(f'- {i}: {s0}\n')
+        elif s0 is None:
+            out(f'+ {i}: {s1}\n')
+        else:
+            out(f'~ {i}: {s1} (was {s0})\n')
+    # Frames are compared from the outermost, which are the most stable.
+    f0, f1 = old.frames[::-1], new.frames[::-1]
+    common = 0
+    for a, b in zip(f0, f1):
+        if a != b:
+            break
+        common += 1
+    for i in range(len(f0) - 1, common - 1, -1):
+        out(f'- #{len(f0) - 1 - i} {f0[i][0]:#x}\n')
+    for i in range(common, len(f1)):
+        out(f'+ #{len(f1) - 1 - i} {_frame(lua, *f1[i])}\n')
+    return changed
+
+class Watch(object):
+    'Prints the differences in the stack of a state at each stop.'
+    def __init__(self, lua: 'lua.Lua', L: int):
+        self.L = L
+        self.last = snapshot(lua, L)
+        gdb.events.stop.connect(self.on_stop)
+        gdb.events.exited.connect(self.on_exit)
+
+    def stop(self):
+        gdb.events.stop.disconnect(self.on_stop)
+        gdb.events.exited.disconnect(self.on_exit)
+
+    def on_stop(self, _):
+        l = lua.lua()
+        try:
+            s = snapshot(l, self.L)
+            gdb.write(f'lua stack {self.L:#x}:\n')
+            if not write_diff(l, self.last, s):
+                gdb.write('(no changes)\n')
+        except (gdb.error, gdb.MemoryError) as e:
+            gdb.write(f'lua stack {self.L:#x}: {e}\n')
+            return
+        self.last = s
+
+    def on_exit(self, _):
+        stop()
+
+WATCH: typing.Optional[Watch] = None
+
+def start(lua: 'lua.Lua', L: types.LuaState):
+    global WATCH
+    if WATCH is not None:
+        WATCH.stop()
+    WATCH = Watch(lua, int(L.v))
+    n = len(WATCH.last.slots) - 1
+    gdb.write(f'watching lua stack {WATCH.L:#x} ({n} slots)\n')
+
+def stop():
+    global WATCH
+    if WATCH is None:
+        raise Exception('lua stack not being watched')
+    WATCH.stop()
+    WATCH = None
@@ -0,0 +1,71 @@
+#!/usr/bin/env bash
+set -euo pipefail
+
+. "${BASH_SOURCE[0]%/*}/test_versions.sh"
+
+# Table entries, call depth, coroutines and string length of each state.
+PARAMS=(
+    "1000 190 10 1000"
+    "100000 190 100 100000"
+    "10000000 190 1000 10000000"
+)
+# Configurations with deep call stacks.  Lua calls count towards the limit of
+# nested C calls (`LUAI_MAXCCALLS`, 200) in 5.4.0 to 5.4.2, which is why the
+# others use a depth of 190, so these only run on the other versions.
+DEEP_PARAMS=(
+    "1000 10000 10 1000"
+    "1000 100000 10 1000"
+)
+
+deep_calls() {
+    case "$1" in
+    5.4.[012]) return 1;;
+    esac
+}
+
+bench_main() {
+    [[ "$#" -lt 2 ]] && bench_usage
+    local dir=$1 output=$2; shift 2
+    [[ "$#" -eq 0 ]] && set -- "${VERSIONS[@]}"
+    local pwd=$PWD v
+    for v; do
+        echo "$v"
+        checkout "$dir" "$v"
+        build_so "$pwd" "$dir" "$v"
+        build "$dir/$v"
+        exec_bench "$dir" "$v" "$output"
+    done
+}
+
+bench_usage() {
+    cat >&2 <<EOF2
+Usage: $0 DIR OUTPUT [VERSION...]
+
+Results are appended to OUTPUT as JSON lines, compare them with:
+
+    python3 test/bench/bench.py compare OLD NEW
+EOF2
+    return 1
+}
+
+exec_bench() {
+    local dir=$1 v=$2 output=$3 p
+    local params=("${PARAMS[@]}")
+    deep_calls "$v" && params+=("${DEEP_PARAMS[@]}")
+    for p in "${params[@]}"; do
+        echo "$v" "$p"
+        # Word splitting of `$p` is intended.
+        # shellcheck disable=SC2086
+        exec_with_version "$dir" "$v" \
+            gdb --batch \
+                -ex 'python import gdb_lua' \
+                -ex 'break stop' \
+                -ex run \
+                -ex 'python import sys; sys.path.insert(0, "test/bench")' \
+                -ex "python import bench; bench.run('$output', '$v', '$p')" \
+                --args test/bench/bench $p \
+            > /dev/null
+    done
+}
+
+bench_main "$@"
@@ -3,7 +3,7 @@ set -euo pipefail
 
 MAKE="make --jobs"
 VERSIONS=(5.3.6 5.4.0 5.4.1 5.4.2 5.4.3 5.4.4 5.4.5 5.4.6)
-TESTS=(backtrace stack type)
+TESTS=(allocprof backtrace profile stack type)
 
 main() {
     [[ "$#" -lt 1 ]] && usage
@@ -97,4 +97,7 @@ process_output() {
         --expression '/^\[Inferior 1 (process [0-9]\+) exited normally\]$/d'
 }
 
-main "$@"
+# Functions are reused by `bench_versions.sh`.
+if [[ "${BASH_SOURCE[0]}" == "$0" ]]; then
+    main "$@"
+fi
@@ -0,0 +1,14 @@
+#include <lauxlib.h>
+#include <lualib.h>
+
+static int mark(lua_State *L) {
+    return lua_gettop(L);
+}
+
+int main(int argc, char **argv) {
+    lua_State *const L = luaL_newstate();
+    luaL_openlibs(L);
+    lua_register(L, "mark", mark);
+    luaL_dofile(L, "test/allocprof/allocprof.lua");
+    lua_close(L);
+}
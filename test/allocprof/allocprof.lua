@@ -0,0 +1,20 @@
+local t = {}
+
+function first()
+    for i = 1, 100 do t[i] = {} end
+end
+
+function second()
+    for i = 1, 100 do t[i] = {} end
+end
+
+function third()
+    local u = {}
+    for i = 1, 100 do u[i] = i end
+end
+
+mark()
+first()
+second()
+third()
+mark()
@@ -0,0 +1,56 @@
+#include <stdio.h>
+#include <stdlib.h>
+
+#include <lauxlib.h>
+#include <lualib.h>
+
+/* Stack at the breakpoint: the array table, the hash table, the long string
+ * and the table of coroutines, under `DEPTH` Lua frames. */
+static const char *const SCRIPT =
+    "local array, hash = {}, {}\n"
+    "for i = 1, N do array[i] = i end\n"
+    "for i = 1, N do hash['k' .. i] = i end\n"
+    "local long = string.rep('x', LEN)\n"
+    "local threads = {}\n"
+    "for i = 1, THREADS do\n"
+    "    local co = coroutine.create(function(x)\n"
+    "        coroutine.yield(x)\n"
+    "    end)\n"
+    "    coroutine.resume(co, i)\n"
+    "    threads[i] = co\n"
+    "end\n"
+    "local function rec(d)\n"
+    "    if d == 0 then\n"
+    "        stop(array, hash, long, threads)\n"
+    "        return 0\n"
+    "    end\n"
+    "    local ret = rec(d - 1)\n"
+    "    return ret + 1\n"
+    "end\n"
+    "rec(DEPTH)\n";
+
+static int stop(lua_State *L) {
+    (void)L;
+    return 0;
+}
+
+static void set(lua_State *L, const char *name, int argc, char **argv, int i) {
+    lua_pushinteger(L, i < argc ? atoll(argv[i]) : 0);
+    lua_setglobal(L, name);
+}
+
+/* Usage: bench ENTRIES DEPTH THREADS LEN */
+int main(int argc, char **argv) {
+    lua_State *const L = luaL_newstate();
+    luaL_openlibs(L);
+    set(L, "N", argc, argv, 1);
+    set(L, "DEPTH", argc, argv, 2);
+    set(L, "THREADS", argc, argv, 3);
+    set(L, "LEN", argc, argv, 4);
+    lua_register(L, "stop", stop);
+    if(luaL_dostring(L, SCRIPT)) {
+        fprintf(stderr, "%s\n", lua_tostring(L, -1));
+        return 1;
+    }
+    lua_close(L);
+}
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+'''\
+Benchmarks of the commands and printers on large Lua states.
+
+Inside gdb, stopped at the `stop` breakpoint of `bench`, `run` times each
+command in `COMMANDS` and counts the calls made into the gdb module (and the
+memory reads among them), then appends the results to a JSON lines file:
+
+    gdb --batch -ex 'python import gdb_lua' -ex 'break stop' -ex run \
+        -ex 'python import sys; sys.path.insert(0, "test/bench")' \
+        -ex 'python import bench; bench.run("out.jsonl", "5.4.6", "1000")' \
+        --args test/bench/bench 1000 190 100 1000
+
+Outside of gdb, results of two commits can be compared:
+
+    python3 test/bench/bench.py compare old.jsonl new.jsonl\
+'''
+import argparse
+import collections
+import json
+import statistics
+import sys
+import time
+import typing
+
+REPEAT = 5
+# Relative slowdown reported as a regression by `compare`.
+THRESHOLD = 0.2
+
+# Name and command, run in the frame of `stop`, whose arguments are the last
+# four slots of the stack.
+COMMANDS = (
+    ('stack', 'lua stack'),
+    ('bt', 'lua bt'),
+    ('bt all', 'lua bt all'),
+    ('print array', 'lua stack L -4'),
+    ('print hash', 'lua stack L -3'),
+    ('print string', 'lua stack L -2'),
+    ('heap', 'lua heap'),
+)
+
+class Counter(object):
+    'Counts calls into the gdb module, through `sys.setprofile`.'
+    def __init__(self):
+        self.calls: collections.Counter = collections.Counter()
+
+    def __call__(self, _frame, event: str, f: typing.Any):
+        if event != 'c_call':
+            return
+        owner = getattr(f, '__self__', None)
+        module = getattr(f, '__module__', None) \
+            or type(owner).__module__
+        if module == 'gdb' or module.startswith('gdb.'):
+            self.calls[f.__name__] += 1
+
+def _clear():
+    from gdb_lua import backend, cache
+    cache.OBJECTS.clear()
+    cache.INDEXES.clear()
+    backend.reset()
+
+def _execute(cmd: str):
+    import gdb
+    gdb.execute(cmd, to_string=True)
+
+def measure(cmd: str, repeat: int=REPEAT) -> dict[str, typing.Any]:
+    '''\
+Times `repeat` cold runs of `cmd`, then counts the calls into gdb made by one
+more, untimed since profiling slows it down.  The latter also records the
+breakdown of `set lua instrumentation`.\
+'''
+    seconds = []
+    for _ in range(repeat):
+        _clear()
+        t = time.perf_counter()
+        _execute(cmd)
+        seconds.append(time.perf_counter() - t)
+    from gdb_lua import stats
+    _clear()
+    c = Counter()
+    stats.set_enabled(True)
+    stats.reset()
+    sys.setprofile(c)
+    try:
+        _execute(cmd)
+    finally:
+        sys.setprofile(None)
+        stats.set_enabled(False)
+    return {
+        'seconds': min(seconds),
+        'median': statistics.median(seconds),
+        'gdb_calls': sum(c.calls.values()),
+        'memory_reads': c.calls['read_memory'],
+        'stats': stats.as_dict(),
+    }
+
+def run(output: str, version: str, params: str, repeat: int=REPEAT):
+    'Measures every command and appends the results to `output`.'
+    with open(output, 'a') as f:
+        for name, cmd in COMMANDS:
+            try:
+                r = measure(cmd, repeat)
+            except Exception as e:
+                r = {'error': f'{type(e).__name__}: {e}'}
+            r.update(version=version, params=params, command=name)
+            f.write(json.dumps(r) + '\n')
+
+Key = tuple[str, str, str]
+
+def load(path: str) -> dict[Key, dict[str, typing.Any]]:
+    with open(path) as f:
+        rs = (json.loads(x) for x in f)
+        return {(x['version'], x['params'], x['command']): x for x in rs}
+
+def compare(
+    old: str, new: str, threshold: float=THRESHOLD,
+    out: typing.TextIO=sys.stdout,
+) -> int:
+    'Prints the ratio of each measure, returns the number of regressions.'
+    a, b = load(old), load(new)
+    out.write(
+        f'{"version":<8}{"params":<24}{"command":<14}'
+        f'{"seconds":>18}{"gdb calls":>22}{"reads":>18}\n')
+    ret = 0
+    for k in sorted(a.keys() & b.keys()):
+        x, y = a[k], b[k]
+        if 'error' in x or 'error' in y:
+            out.write(f'{k[0]:<8}{k[1]:<24}{k[2]:<14}  error\n')
+            continue
+        cols = []
+        for m in ('seconds', 'gdb_calls', 'memory_reads'):
+            v0, v1 = x[m], y[m]
+            ratio = v1 / v0 if v0 else 1.0 if not v1 else float('inf')
+            cols.append(f'{v1:.4g} ({ratio:.2f}x)')
+            if ratio > 1 + threshold:
+                ret += 1
+        out.write(
+            f'{k[0]:<8}{k[1]:<24}{k[2]:<14}'
+            f'{cols[0]:>18}{cols[1]:>22}{cols[2]:>18}\n')
+    for k in sorted(a.keys() ^ b.keys()):
+        out.write(f'{k[0]:<8}{k[1]:<24}{k[2]:<14}  only in one file\n')
+    return ret
+
+def main(args: typing.Sequence[str]) -> int:
+    p = argparse.ArgumentParser(prog='bench.py')
+    sub = p.add_subparsers(dest='cmd', required=True)
+    c = sub.add_parser('compare', help='compare the results of two runs')
+    c.add_argument('old')
+    c.add_argument('new')
+    c.add_argument(
+        '--threshold', type=float, default=THRESHOLD,
+        help='relative increase reported as a regression (default: 0.2)')
+    opts = p.parse_args(args)
+    n = compare(opts.old, opts.new, opts.threshold)
+    if n:
+        sys.stderr.write(f'{n} regressions\n')
+    return 1 if n else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,13 @@
+local function inner()
+    mark()
+end
+
+local co = coroutine.create(function()
+    inner()
+end)
+
+function outer()
+    coroutine.resume(co)
+end
+
+outer()